@@ -1,5 +1,9 @@
 #Alunos: Bruno Machado Ferreira(181276), Ernani Neto(180914), Fábio Gomes(181274) e Ryan Nantes(180901)
 #Filtro de partículas(Código principal)
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
 from pfilter import (
     ParticleFilter,
     gaussian_noise,
@@ -7,6 +11,7 @@ from pfilter import (
     t_noise,
     squared_error,
     independent_sample,
+    stamp,
 )
 import numpy as np
 
@@ -22,18 +27,18 @@ import cv2
 img_size = 100
 
 
-def blob(x):
+def blob(x, scale=1):
     """Dada uma matriz de 3 colunas, com as posicoes e tamanho do blob, 
     cria uma imagens de dimensões img_size x img_size, com blobs inseridos
     a partir do valor das fileiras de x
     
-    One row of x = [x,y,radius]."""
-    y = np.zeros((x.shape[0], img_size, img_size))
-    for i, particle in enumerate(x):
-        rr, cc = skimage.draw.circle(
-            particle[0], particle[1], max(particle[2], 1), shape=(img_size, img_size)
-        )
-        y[i, rr, cc] = 1
+    One row of x = [x,y,radius]. Com scale > 1, a imagem tem 1/scale do tamanho
+    (para a pirâmide de imagens do filtro, pyramid_levels)."""
+    y = np.zeros((x.shape[0], img_size // scale, img_size // scale))
+    # centros dos pixels grossos: o centro de cada bloco scale x scale de pixels
+    shift = (scale - 1) / 2
+    # desenha todos os discos de uma vez, reutilizando os moldes em cache
+    stamp(y, (x[:, 0] - shift) / scale, (x[:, 1] - shift) / scale, np.maximum(x[:, 2], 1) / scale)
     return y
 
 columns = ["x", "y", "radius", "dx", "dy"]
@@ -81,6 +86,9 @@ def example_filter():
         weight_fn=lambda x, y: squared_error(x, y, sigma=2),
         resample_proportion=0.1,
         column_names=columns,
+        # avalia as partículas primeiro em 1/4 da resolução, e só as melhores em resolução total
+        pyramid_levels=3,
+        pyramid_keep=0.5,
     )
 
     # np.random.seed(2018)
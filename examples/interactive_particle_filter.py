@@ -2,7 +2,7 @@
 #Filtro de partículas interativo com desenho de paredes
 import sys
 import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from pfilter import (
     ParticleFilter,
@@ -11,7 +11,12 @@ from pfilter import (
     t_noise,
     squared_error,
     independent_sample,
+    CollisionMap,
+    collision_dynamics,
+    HAVE_NUMBA,
+    stamp,
 )
+from functools import partial
 import numpy as np
 from scipy.stats import norm, gamma, uniform
 import skimage.draw
@@ -31,8 +36,9 @@ class InteractiveParticleFilter:
         self.last_point = None
         self.wall_thickness = 2
         
-        # Matriz para armazenar as paredes
-        self.wall_map = np.zeros((img_size, img_size), dtype=np.uint8)
+        # Matriz para armazenar as paredes (atualizada pelo mapa de colisão)
+        self.collision_map = CollisionMap((img_size, img_size))
+        self.wall_map = self.collision_map.wall_map
         
         # Estado do blob
         self.blob_x = img_size // 2
@@ -80,95 +86,43 @@ class InteractiveParticleFilter:
     
     def add_wall_point(self, x, y):
         """Adiciona um ponto de parede"""
-        for i in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-            for j in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                wall_x = np.clip(x + i, 0, self.img_size - 1)
-                wall_y = np.clip(y + j, 0, self.img_size - 1)
-                self.wall_map[wall_y, wall_x] = 1
+        self.collision_map.add_point(x, y, self.wall_thickness)
     
     def draw_wall_line(self, x1, y1, x2, y2):
         """Desenha uma linha de parede entre dois pontos"""
-        # Usar algoritmo de Bresenham para desenhar linha
-        rr, cc = line(y1, x1, y2, x2)
-        
-        # Aplicar espessura à linha
-        for r, c in zip(rr, cc):
-            for i in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                for j in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                    wall_r = np.clip(r + i, 0, self.img_size - 1)
-                    wall_c = np.clip(c + j, 0, self.img_size - 1)
-                    self.wall_map[wall_r, wall_c] = 1
+        # Linha com espessura, atualizando o mapa de colisão incrementalmente
+        self.collision_map.add_line(x1, y1, x2, y2, self.wall_thickness)
     
     def clear_walls(self):
         """Limpa todas as paredes"""
-        self.wall_map = np.zeros((self.img_size, self.img_size), dtype=np.uint8)
+        self.collision_map.clear()
         self.walls = []
     
     def check_wall_collision(self, x, y, radius=1):
         """Verifica se há colisão com parede em uma posição"""
-        # Verificar área ao redor da posição
-        x_int, y_int = int(round(x)), int(round(y))
-        radius_int = int(round(radius))
-        
-        # Verificar limites da tela
-        if x_int < radius_int or x_int >= self.img_size - radius_int or \
-           y_int < radius_int or y_int >= self.img_size - radius_int:
-            return True
-            
-        # Verificar colisão com paredes desenhadas
-        for i in range(-radius_int, radius_int + 1):
-            for j in range(-radius_int, radius_int + 1):
-                check_x = np.clip(x_int + i, 0, self.img_size - 1)
-                check_y = np.clip(y_int + j, 0, self.img_size - 1)
-                if self.wall_map[check_y, check_x] == 1:
-                    return True
-        return False
+        # Verifica limites da tela e paredes na área ao redor da posição
+        return bool(self.collision_map.collides(x, y, radius))
     
-    def blob_with_walls(self, x):
-        """Função blob modificada que considera as paredes"""
-        y = np.zeros((x.shape[0], self.img_size, self.img_size))
-        for i, particle in enumerate(x):
-            # Verificar se a partícula não está colidindo com parede
-            if not self.check_wall_collision(particle[0], particle[1], max(particle[2], 1)):
-                rr, cc = disk(
-                    (particle[0], particle[1]), max(particle[2], 1), 
-                    shape=(self.img_size, self.img_size)
-                )
-                y[i, rr, cc] = 1
+    def blob_with_walls(self, x, scale=1):
+        """Função blob modificada que considera as paredes (com scale > 1, em 1/scale do tamanho)"""
+        y = np.zeros((x.shape[0], self.img_size // scale, self.img_size // scale))
+        # Verificar de uma vez quais partículas não estão colidindo com parede
+        visible = np.flatnonzero(
+            ~self.collision_map.collides(x[:, 0], x[:, 1], np.maximum(x[:, 2], 1))
+        )
+        # Desenhar os discos visíveis de uma vez, reutilizando os moldes em cache
+        shift = (scale - 1) / 2
+        stamp(
+            y, (x[visible, 0] - shift) / scale, (x[visible, 1] - shift) / scale,
+            np.maximum(x[visible, 2], 1) / scale, index=visible
+        )
         return y
     
-    def velocity_with_collision(self, x):
-        """Função de velocidade modificada que considera colisões com paredes"""
-        dt = 1.0
-        new_x = np.copy(x)
-        
-        for i in range(x.shape[0]):
-            # Calcular nova posição
-            new_pos_x = x[i, 0] + x[i, 3] * dt
-            new_pos_y = x[i, 1] + x[i, 4] * dt
-            
-            # Verificar colisão na nova posição
-            if self.check_wall_collision(new_pos_x, new_pos_y, max(x[i, 2], 1)):
-                # Colisão detectada - inverter velocidade e aplicar amortecimento
-                if self.check_wall_collision(x[i, 0] + x[i, 3] * dt, x[i, 1], max(x[i, 2], 1)):
-                    new_x[i, 3] = -x[i, 3] * 0.8  # Inverter e amortecer velocidade X
-                if self.check_wall_collision(x[i, 0], x[i, 1] + x[i, 4] * dt, max(x[i, 2], 1)):
-                    new_x[i, 4] = -x[i, 4] * 0.8  # Inverter e amortecer velocidade Y
-                    
-                # Manter posição atual se houver colisão
-                new_x[i, 0] = x[i, 0]
-                new_x[i, 1] = x[i, 1]
-            else:
-                # Sem colisão - aplicar movimento normal
-                new_x[i, 0] = new_pos_x
-                new_x[i, 1] = new_pos_y
-                new_x[i, 3] = x[i, 3]  # Manter velocidade X
-                new_x[i, 4] = x[i, 4]  # Manter velocidade Y
-            
-            # Manter raio constante
-            new_x[i, 2] = x[i, 2]
-            
-        return new_x
+    def outside_walls(self, x, observed):
+        """Peso interno: zero para partículas com o centro dentro de uma parede ou fora da tela
+        (as que apenas encostam numa parede continuam possíveis, para que uma nuvem apertada
+        contra a parede não fique toda com peso zero)"""
+        return (~self.collision_map.collides(x[:, 0], x[:, 1], 0)).astype(float)
     
     def update_blob_position(self):
         """Atualiza a posição do blob considerando colisões com paredes"""
@@ -218,11 +172,17 @@ class InteractiveParticleFilter:
             prior_fn=prior_fn,
             observe_fn=self.blob_with_walls,
             n_particles=150,
-            dynamics_fn=self.velocity_with_collision,
-            noise_fn=lambda x: t_noise(x, sigmas=[0.2, 0.2, 0.05, 0.1, 0.1], df=100.0),
+            # Dinâmica com colisão: partículas bloqueadas mantêm a posição, e a
+            # velocidade é invertida e amortecida (compilada com Numba, se instalado)
+            dynamics_fn=partial(collision_dynamics, collision_map=self.collision_map, damping=0.8),
+            noise_fn=partial(t_noise, sigmas=[0.2, 0.2, 0.05, 0.1, 0.1], df=100.0),
             weight_fn=lambda x, y: squared_error(x, y, sigma=2),
+            internal_weight_fn=self.outside_walls,
+            gate_internal_weight=True,
             resample_proportion=0.1,
+            prior_pool=4096,
             column_names=columns,
+            backend="numba" if HAVE_NUMBA else "numpy",
         )
     
     def run(self):
@@ -261,30 +221,26 @@ class InteractiveParticleFilter:
             )
             display_img[blob_rr, blob_cc] = [0, 1, 1]  # Amarelo (BGR)
             
-            # Desenhar partículas em azul
-            for particle in self.pf.original_particles:
-                px, py, pr, _, _ = particle
-                if 0 <= px < self.img_size and 0 <= py < self.img_size:
-                    try:
-                        part_rr, part_cc = circle_perimeter(
-                            int(py), int(px), max(int(pr), 1),
-                            shape=(self.img_size, self.img_size)
-                        )
-                        display_img[part_rr, part_cc] = [1, 0, 0]  # Azul
-                    except:
-                        pass
+            # Desenhar partículas em azul (todos os contornos de uma vez)
+            particles = self.pf.original_particles
+            px, py, pr = particles[:, 0], particles[:, 1], particles[:, 2]
+            inside = (px >= 0) & (px < self.img_size) & (py >= 0) & (py < self.img_size)
+            outlines = np.zeros((1, self.img_size, self.img_size), dtype=bool)
+            stamp(
+                outlines, py[inside].astype(int), px[inside].astype(int),
+                np.maximum(pr[inside].astype(int), 1), kind="perimeter", index=0
+            )
+            display_img[outlines[0]] = [1, 0, 0]  # Azul
             
             # Desenhar estimativa média em verde
             x_hat, y_hat, s_hat, dx_hat, dy_hat = self.pf.mean_state
             if 0 <= x_hat < self.img_size and 0 <= y_hat < self.img_size:
-                try:
-                    mean_rr, mean_cc = circle_perimeter(
-                        int(y_hat), int(x_hat), max(int(s_hat), 1),
-                        shape=(self.img_size, self.img_size)
-                    )
-                    display_img[mean_rr, mean_cc] = [0, 1, 0]  # Verde
-                except:
-                    pass
+                outlines[:] = False
+                stamp(
+                    outlines, int(y_hat), int(x_hat), max(int(s_hat), 1),
+                    kind="perimeter", index=0
+                )
+                display_img[outlines[0]] = [0, 1, 0]  # Verde
             
             # Redimensionar para exibição
             display_img_scaled = cv2.resize(
@@ -2,7 +2,7 @@
 #Filtro de partículas profissional com simulação realista de múltiplas partículas
 import sys
 import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from pfilter import (
     ParticleFilter,
@@ -11,6 +11,8 @@ from pfilter import (
     t_noise,
     squared_error,
     independent_sample,
+    CollisionMap,
+    stamp,
 )
 import numpy as np
 from scipy.stats import norm, gamma, uniform
@@ -36,8 +38,9 @@ class ProfessionalParticleFilter:
         self.last_point = None
         self.wall_thickness = 3
         
-        # Matriz para paredes
-        self.wall_map = np.zeros((self.img_size, self.img_size), dtype=np.uint8)
+        # Matriz para paredes (atualizada pelo mapa de colisão)
+        self.collision_map = CollisionMap((self.img_size, self.img_size))
+        self.wall_map = self.collision_map.wall_map
         
         # Sistema de múltiplas partículas ambientais
         self.micro_particles = self.initialize_micro_particles()
@@ -220,111 +223,68 @@ class ProfessionalParticleFilter:
     
     def add_wall_point(self, x, y):
         """Adiciona ponto de parede"""
-        for i in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-            for j in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                wall_x = np.clip(x + i, 0, self.img_size - 1)
-                wall_y = np.clip(y + j, 0, self.img_size - 1)
-                self.wall_map[wall_y, wall_x] = 1
+        self.collision_map.add_point(x, y, self.wall_thickness)
     
     def draw_wall_line(self, x1, y1, x2, y2):
         """Desenha linha de parede"""
-        rr, cc = line(y1, x1, y2, x2)
-        for r, c in zip(rr, cc):
-            for i in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                for j in range(-self.wall_thickness//2, self.wall_thickness//2 + 1):
-                    wall_r = np.clip(r + i, 0, self.img_size - 1)
-                    wall_c = np.clip(c + j, 0, self.img_size - 1)
-                    self.wall_map[wall_r, wall_c] = 1
+        self.collision_map.add_line(x1, y1, x2, y2, self.wall_thickness)
     
     def clear_walls(self):
         """Limpa paredes"""
-        self.wall_map = np.zeros((self.img_size, self.img_size), dtype=np.uint8)
+        self.collision_map.clear()
     
     def check_wall_collision(self, x, y, radius=1):
         """Verifica colisão com paredes"""
-        x_int, y_int = int(round(x)), int(round(y))
-        radius_int = int(round(radius))
-        
-        if x_int < radius_int or x_int >= self.img_size - radius_int or \
-           y_int < radius_int or y_int >= self.img_size - radius_int:
-            return True
-            
-        for i in range(-radius_int, radius_int + 1):
-            for j in range(-radius_int, radius_int + 1):
-                check_x = np.clip(x_int + i, 0, self.img_size - 1)
-                check_y = np.clip(y_int + j, 0, self.img_size - 1)
-                if self.wall_map[check_y, check_x] == 1:
-                    return True
-        return False
+        return bool(self.collision_map.collides(x, y, radius))
     
     def target_observation_function(self, x):
         """Função de observação baseada no objeto alvo"""
         y = np.zeros((x.shape[0], self.img_size, self.img_size))
         
-        # Criar observação baseada nas partículas do alvo
-        target_obs = np.zeros((self.img_size, self.img_size))
-        for particle in self.target_particles:
-            px, py = int(particle['x']), int(particle['y'])
-            if 0 <= px < self.img_size and 0 <= py < self.img_size:
-                size = int(particle['size'])
-                for i in range(-size, size + 1):
-                    for j in range(-size, size + 1):
-                        obs_x = np.clip(px + i, 0, self.img_size - 1)
-                        obs_y = np.clip(py + j, 0, self.img_size - 1)
-                        distance = np.sqrt(i*i + j*j)
-                        if distance <= size:
-                            target_obs[obs_y, obs_x] = max(target_obs[obs_y, obs_x], 
-                                                         1.0 - distance/size)
+        # Criar observação baseada nas partículas do alvo (todos os cones de uma vez)
+        target_obs = np.zeros((1, self.img_size, self.img_size))
+        px = np.array([int(p['x']) for p in self.target_particles])
+        py = np.array([int(p['y']) for p in self.target_particles])
+        size = np.array([int(p['size']) for p in self.target_particles])
+        inside = (px >= 0) & (px < self.img_size) & (py >= 0) & (py < self.img_size)
+        stamp(
+            target_obs, py[inside], px[inside], size[inside],
+            kind="cone", index=0, mode="max", edge="clip"
+        )
         
         # Aplicar observação para cada partícula do filtro
-        for i in range(x.shape[0]):
-            y[i] = target_obs
+        y[:] = target_obs
             
         return y
     
     def advanced_dynamics(self, x):
         """Dinâmica avançada com múltiplos comportamentos"""
         dt = 1.0
+        n = x.shape[0]
         new_x = np.copy(x)
         
-        for i in range(x.shape[0]):
-            # Movimento base
-            new_pos_x = x[i, 0] + x[i, 3] * dt
-            new_pos_y = x[i, 1] + x[i, 4] * dt
-            
-            # Adicionar ruído Browniano
-            brownian_x = np.random.normal(0, 0.2)
-            brownian_y = np.random.normal(0, 0.2)
-            
-            new_pos_x += brownian_x
-            new_pos_y += brownian_y
-            
-            # Verificar colisões
-            if self.check_wall_collision(new_pos_x, new_pos_y, max(x[i, 2], 1)):
-                if self.check_wall_collision(x[i, 0] + x[i, 3] * dt, x[i, 1], max(x[i, 2], 1)):
-                    new_x[i, 3] = -x[i, 3] * 0.7 + np.random.normal(0, 0.1)
-                if self.check_wall_collision(x[i, 0], x[i, 1] + x[i, 4] * dt, max(x[i, 2], 1)):
-                    new_x[i, 4] = -x[i, 4] * 0.7 + np.random.normal(0, 0.1)
-                new_x[i, 0] = x[i, 0]
-                new_x[i, 1] = x[i, 1]
-            else:
-                new_x[i, 0] = new_pos_x
-                new_x[i, 1] = new_pos_y
-            
-            # Atualizar velocidades com amortecimento
-            new_x[i, 3] = x[i, 3] * 0.98 + np.random.normal(0, 0.05)
-            new_x[i, 4] = x[i, 4] * 0.98 + np.random.normal(0, 0.05)
-            
-            # Limitar velocidade
-            max_speed = 1.5
-            speed = np.sqrt(new_x[i, 3]**2 + new_x[i, 4]**2)
-            if speed > max_speed:
-                new_x[i, 3] = (new_x[i, 3] / speed) * max_speed
-                new_x[i, 4] = (new_x[i, 4] / speed) * max_speed
-            
-            # Manter tamanho com pequena variação
-            new_x[i, 2] = x[i, 2] + np.random.normal(0, 0.02)
-            new_x[i, 2] = np.clip(new_x[i, 2], 0.5, 5.0)
+        # Movimento base com ruído Browniano
+        new_pos_x = x[:, 0] + x[:, 3] * dt + np.random.normal(0, 0.2, n)
+        new_pos_y = x[:, 1] + x[:, 4] * dt + np.random.normal(0, 0.2, n)
+        
+        # Verificar colisões de todas as partículas de uma vez:
+        # partículas bloqueadas mantêm a posição atual
+        blocked = self.collision_map.collides(new_pos_x, new_pos_y, np.maximum(x[:, 2], 1))
+        new_x[:, 0] = np.where(blocked, x[:, 0], new_pos_x)
+        new_x[:, 1] = np.where(blocked, x[:, 1], new_pos_y)
+        
+        # Atualizar velocidades com amortecimento
+        new_x[:, 3] = x[:, 3] * 0.98 + np.random.normal(0, 0.05, n)
+        new_x[:, 4] = x[:, 4] * 0.98 + np.random.normal(0, 0.05, n)
+        
+        # Limitar velocidade
+        max_speed = 1.5
+        speed = np.sqrt(new_x[:, 3]**2 + new_x[:, 4]**2)
+        too_fast = speed > max_speed
+        new_x[too_fast, 3:5] *= (max_speed / speed[too_fast])[:, None]
+        
+        # Manter tamanho com pequena variação
+        new_x[:, 2] = np.clip(x[:, 2] + np.random.normal(0, 0.02, n), 0.5, 5.0)
             
         return new_x
     
@@ -348,75 +308,63 @@ class ProfessionalParticleFilter:
             noise_fn=lambda x: t_noise(x, sigmas=[0.3, 0.3, 0.1, 0.15, 0.15], df=80.0),
             weight_fn=lambda x, y: squared_error(x, y, sigma=1.5),
             resample_proportion=0.05,
+            prior_pool=4096,
             column_names=columns,
         )
     
     def render_particles(self, display_img):
         """Renderiza partículas com diferentes estilos"""
+        # Planos de cor (vistas de display_img) onde os moldes são carimbados
+        channels = [display_img[None, :, :, c] for c in range(3)]
+        
         # Desenhar partículas microscópicas
-        for particle in self.micro_particles:
-            px, py = int(particle['x']), int(particle['y'])
-            if 0 <= px < self.img_size and 0 <= py < self.img_size:
-                color = self.particle_colors[particle['type']]
-                intensity = particle['life'] * (0.5 + 0.5 * np.sin(particle['phase']))
-                
-                # Desenhar partícula como ponto pequeno
-                size = max(1, int(particle['size']))
-                for i in range(-size//2, size//2 + 1):
-                    for j in range(-size//2, size//2 + 1):
-                        draw_x = np.clip(px + i, 0, self.img_size - 1)
-                        draw_y = np.clip(py + j, 0, self.img_size - 1)
-                        distance = np.sqrt(i*i + j*j)
-                        if distance <= size/2:
-                            alpha = intensity * (1.0 - distance/(size/2))
-                            for c in range(3):
-                                display_img[draw_y, draw_x, c] = min(1.0, 
-                                    display_img[draw_y, draw_x, c] + color[c] * alpha * 0.6)
+        px = np.array([int(p['x']) for p in self.micro_particles])
+        py = np.array([int(p['y']) for p in self.micro_particles])
+        inside = (px >= 0) & (px < self.img_size) & (py >= 0) & (py < self.img_size)
+        micro = [p for p, keep in zip(self.micro_particles, inside) if keep]
+        if micro:
+            # Desenhar partícula como ponto pequeno
+            size = np.array([max(1, int(p['size'])) for p in micro])
+            intensity = np.array([p['life'] * (0.5 + 0.5 * np.sin(p['phase'])) for p in micro])
+            colors = np.array([self.particle_colors[p['type']] for p in micro])
+            for c in range(3):
+                stamp(
+                    channels[c], py[inside], px[inside], size / 2, kind="cone", index=0,
+                    weights=intensity * colors[:, c] * 0.6, mode="add", edge="clip"
+                )
         
-        # Desenhar partículas do filtro
-        for particle in self.pf.original_particles:
-            px, py, pr, _, _ = particle
-            if 0 <= px < self.img_size and 0 <= py < self.img_size:
-                # Desenhar como pequenos círculos azuis
-                size = max(1, int(pr * 0.5))
-                for i in range(-size, size + 1):
-                    for j in range(-size, size + 1):
-                        draw_x = np.clip(int(px) + i, 0, self.img_size - 1)
-                        draw_y = np.clip(int(py) + j, 0, self.img_size - 1)
-                        distance = np.sqrt(i*i + j*j)
-                        if distance <= size:
-                            alpha = 0.4 * (1.0 - distance/size)
-                            display_img[draw_y, draw_x, 0] = min(1.0, 
-                                display_img[draw_y, draw_x, 0] + alpha)  # Azul
+        # Desenhar partículas do filtro como pequenos círculos azuis
+        particles = self.pf.original_particles
+        px, py, pr = particles[:, 0], particles[:, 1], particles[:, 2]
+        inside = (px >= 0) & (px < self.img_size) & (py >= 0) & (py < self.img_size)
+        stamp(
+            channels[0], py[inside].astype(int), px[inside].astype(int),
+            np.maximum((pr[inside] * 0.5).astype(int), 1), kind="cone", index=0,
+            weights=0.4, mode="add", edge="clip"
+        )
+        
+        # Desenhar objeto alvo (verde e amarelo)
+        px = np.array([int(p['x']) for p in self.target_particles])
+        py = np.array([int(p['y']) for p in self.target_particles])
+        size = np.array([max(1, int(p['size'])) for p in self.target_particles])
+        inside = (px >= 0) & (px < self.img_size) & (py >= 0) & (py < self.img_size)
+        for c in (1, 2):
+            stamp(
+                channels[c], py[inside], px[inside], size[inside], kind="cone", index=0,
+                weights=0.8, mode="add", edge="clip"
+            )
         
-        # Desenhar objeto alvo
-        for particle in self.target_particles:
-            px, py = int(particle['x']), int(particle['y'])
-            if 0 <= px < self.img_size and 0 <= py < self.img_size:
-                size = max(1, int(particle['size']))
-                for i in range(-size, size + 1):
-                    for j in range(-size, size + 1):
-                        draw_x = np.clip(px + i, 0, self.img_size - 1)
-                        draw_y = np.clip(py + j, 0, self.img_size - 1)
-                        distance = np.sqrt(i*i + j*j)
-                        if distance <= size:
-                            alpha = 0.8 * (1.0 - distance/size)
-                            display_img[draw_y, draw_x, 1] = min(1.0, 
-                                display_img[draw_y, draw_x, 1] + alpha)  # Verde
-                            display_img[draw_y, draw_x, 2] = min(1.0, 
-                                display_img[draw_y, draw_x, 2] + alpha)  # Amarelo
+        # Somas saturam em 1.0
+        np.minimum(display_img, 1.0, out=display_img)
         
         # Desenhar estimativa do filtro
         x_hat, y_hat, s_hat, _, _ = self.pf.mean_state
         if 0 <= x_hat < self.img_size and 0 <= y_hat < self.img_size:
             size = max(2, int(s_hat))
-            for i in range(-size, size + 1):
-                for j in range(-size, size + 1):
-                    draw_x = np.clip(int(x_hat) + i, 0, self.img_size - 1)
-                    draw_y = np.clip(int(y_hat) + j, 0, self.img_size - 1)
-                    distance = np.sqrt(i*i + j*j)
-                    if distance <= size and distance >= size - 1:
-                        display_img[draw_y, draw_x, 1] = 1.0  # Verde puro
+            stamp(
+                channels[1], int(y_hat), int(x_hat), size, kind="ring", index=0,
+                edge="clip"
+            )  # Verde puro
     
     def run(self):
         """Executa a simulação profissional"""
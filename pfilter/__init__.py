@@ -1 +1,16 @@
 from .pfilter import *
+from .resampling import *
+from .bank import *
+from .rng import *
+from .parallel import *
+from .profiling import *
+from .pool import *
+from .collision import *
+from .compiled import HAVE_NUMBA
+from .jaxfilter import HAVE_JAX, JaxParticleFilter, KeyGenerator, jit_filter
+from .binary import *
+from .disk import *
+from .templates import *
+from .kernels import *
+from .sparse import *
+from .pyramid import *
@@ -0,0 +1,347 @@
+import numpy as np
+from .pfilter import _cast_floating, identity, logsumexp, squared_error
+from .resampling import batch_resample
+from .rng import _rng_kwargs, make_rng, spawn_rngs
+
+
+class ParticleFilterBank(object):
+    """A bank of K independent particle filters, updated together as one batched array.
+
+    Every filter in the bank shares the same model functions, and each step calls them once
+    on the whole bank rather than once per filter, so the per-step cost scales with the
+    size of the arrays rather than with the number of filters.
+
+    Attributes:
+    -----------
+
+    n_filters : int
+        number of filters in the bank (K)
+    n_particles : int
+        number of particles used by each filter (N)
+    d : int
+        dimension of the internal state
+    particles : array
+        (K,N,D) array of particle states
+    original_particles : array
+        (K,N,D) array of particle states *before* any resampling or replenishment
+    weights : array
+        (K,N) array of weights, normalized for each filter
+    log_weights : array
+        (K,N) array of normalized log-weights (only if log_weight_fn is used)
+    hypotheses : array
+        The (K,N,...) array of hypotheses for each particle
+    mean_hypothesis : array
+        (K,...) mean hypothesized observation of each filter
+    map_hypothesis : array
+        (K,...) most likely hypothesized observation of each filter
+    mean_state : array
+        (K,D) mean hypothesized internal state of each filter
+    cov_state : array
+        (K,D,D) weighted covariance of the internal state of each filter
+    map_state : array
+        (K,D) most likely internal state of each filter
+    rng : np.random.Generator
+        The bank's own source of randomness.
+    n_eff : array
+        K-element vector of normalized effective sample sizes, in range 0.0 -> 1.0
+    weight_entropy : array
+        K-element vector of the entropies of each filter's weight distribution (in nats)
+    """
+
+    def __init__(
+        self,
+        prior_fn,
+        n_filters,
+        observe_fn=None,
+        resample_fn=None,
+        n_particles=200,
+        dynamics_fn=None,
+        noise_fn=None,
+        weight_fn=None,
+        resample_proportion=None,
+        column_names=None,
+        internal_weight_fn=None,
+        transform_fn=None,
+        n_eff_threshold=1.0,
+        log_weight_fn=None,
+        rng=None,
+        dtype=None,
+    ):
+        """
+
+        Parameters:
+        -----------
+
+        prior_fn : function(n) = > states
+                a function that generates n samples from the prior over internal states, as
+                an (n,D) particle array. Called once for all K*N particles.
+        n_filters : int
+                number of independent filters in the bank
+        observe_fn : function(states) => observations
+                    as for ParticleFilter; called once with the (K*N,D) array of all particles,
+                    returning a (K*N,...) array of hypotheses.
+        resample_fn : A batched resampling function weights (K,N) => indices (K,N)
+                    Defaults to `batch_resample`; see `pfilter.resampling` for the alternatives.
+        n_particles : int
+                     number of particles in each filter
+        dynamics_fn : function(states) => states
+                      as for ParticleFilter; called once with the (K*N,D) array of all particles.
+                      Must act on each row independently.
+        noise_fn : function(states) => states
+                    as for ParticleFilter; called once with the (K*N,D) array of all particles.
+        weight_fn :  function(hypothesized, real) => weights
+                    called with the (K,N,P) flattened hypotheses and the (K,1,P) flattened observations,
+                    returning a (K,N) array of strictly positive similarities. The built-in kernels
+                    (e.g. `squared_error`) reduce over the last axis and so work unchanged.
+        log_weight_fn :  function(hypothesized, real) => log_weights
+                    log-domain alternative to weight_fn, called in the same way (e.g. `log_squared_error`).
+                    If specified, weight_fn is ignored and the bank keeps log-weights.
+        internal_weight_fn :  function(states, observed) => weights
+                    takes the (K,N,D) array of internal states and the observations and returns
+                    a (K,N) array of strictly positive weights.
+        transform_fn: function(states, weights) => transformed_states
+                    Applied at the very end of the update step to the (K,N,D) states and (K,N) weights,
+                    if specified. Updates the attribute `transformed_particles`.
+        resample_proportion : float
+                    proportion of samples to draw from the prior on each iteration.
+        n_eff_threshold=1.0: float
+                    effective sample size at which resampling will be performed (0.0->1.0),
+                    tested separately for each filter.
+        column_names : list of strings
+                    names of each the columns of the state vector
+        rng : np.random.Generator, int or None
+                    source of randomness for the bank, or a seed to create one from. As for
+                    ParticleFilter, it is passed as `rng` to model functions that accept it.
+        dtype : numpy dtype, optional
+                    floating point type of the particles (and floating point observations), as for
+                    ParticleFilter; the weights and summaries are computed in float64.
+        """
+        self.rng = make_rng(rng)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.resample_fn = resample_fn or batch_resample
+        self.column_names = column_names
+        self.prior_fn = prior_fn
+        self.n_filters = n_filters
+        self.n_particles = n_particles
+        self.init_filter()
+        self.n_eff_threshold = n_eff_threshold
+        self.d = self.particles.shape[2]
+        self.observe_fn = observe_fn or identity
+        self.dynamics_fn = dynamics_fn or identity
+        self.noise_fn = noise_fn or identity
+        self.weight_fn = weight_fn or squared_error
+        self.log_weight_fn = log_weight_fn
+        self._reset_weights()
+        self.transform_fn = transform_fn
+        self.transformed_particles = None
+        self.resample_proportion = resample_proportion or 0.0
+        self.internal_weight_fn = internal_weight_fn
+        self.original_particles = np.array(self.particles)
+
+    def init_filter(self, mask=None):
+        """Initialise the bank by drawing samples from the prior.
+
+        Parameters:
+        -----------
+        mask : array, optional
+            (K,N) boolean mask specifying the particles to draw from the prior. None (default)
+            implies all particles of every filter will be resampled (i.e. a complete reset).
+            Only as many prior samples as there are masked particles are drawn.
+        """
+        k, n = self.n_filters, self.n_particles
+        if mask is None:
+            self.particles = np.asarray(
+                self.prior_fn(k * n, **_rng_kwargs(self.prior_fn, self.rng, {})),
+                dtype=self.dtype,
+            ).reshape(k, n, -1)
+        else:
+            n_masked = np.count_nonzero(mask)
+            if n_masked > 0:
+                self.particles[mask] = self.prior_fn(
+                    n_masked, **_rng_kwargs(self.prior_fn, self.rng, {})
+                )
+
+    def spawn_rngs(self, n):
+        """Split n independent Generators off this bank's random stream."""
+        return spawn_rngs(self.rng, n)
+
+    def _reset_weights(self, rows=None):
+        """Set the weights of the given filters (all if None) to uniform."""
+        uniform = 1.0 / self.n_particles
+        if rows is None:
+            self.weights = np.full((self.n_filters, self.n_particles), uniform)
+            if self.log_weight_fn is not None:
+                self.log_weights = np.log(self.weights)
+        else:
+            self.weights[rows] = uniform
+            if self.log_weight_fn is not None:
+                self.log_weights[rows] = np.log(uniform)
+
+    def _flat(self, states):
+        """View a (K,N,D) array of states as (K*N,D)."""
+        return states.reshape(self.n_filters * self.n_particles, -1)
+
+    def update(self, observed=None, **kwargs):
+        """Update the state of every filter in the bank given one observation per filter.
+
+        Parameters:
+        ----------
+
+        observed: array
+            (K,...) array, holding the observation for each filter in the format observe_fn()
+            produces for a single particle. If None, all filters run one step in
+            prediction-only mode.
+
+        kwargs: any keyword arguments specified will be passed on to the model functions,
+            as for ParticleFilter.update.
+        """
+        k, n = self.n_filters, self.n_particles
+        observed = _cast_floating(observed, self.dtype)
+
+        # apply dynamics and noise to all filters at once
+        self.particles = np.asarray(
+            self.noise_fn(
+                self.dynamics_fn(
+                    self._flat(self.particles),
+                    **_rng_kwargs(self.dynamics_fn, self.rng, kwargs)
+                ),
+                **_rng_kwargs(self.noise_fn, self.rng, kwargs)
+            ),
+            dtype=self.dtype,
+        ).reshape(k, n, -1)
+
+        # hypothesise observations
+        hypotheses = self.observe_fn(self._flat(self.particles), **kwargs)
+        self.hypotheses = hypotheses.reshape((k, n) + hypotheses.shape[1:])
+
+        if self.log_weight_fn is not None:
+            self._log_weight(observed, **kwargs)
+        else:
+            self._weight(observed, **kwargs)
+
+        with np.errstate(invalid="ignore"):
+            self.weight_entropy = np.sum(
+                self.weights * self._log_normalised_weights(),
+                axis=1,
+                where=self.weights > 0,
+            )
+
+        # preserve current sample set before any replenishment
+        self.original_particles = self.particles
+        self.original_weights = self.weights
+
+        # weighted summaries, per filter
+        self.mean_hypothesis = np.einsum(
+            "kn,knp->kp", self.weights, self.hypotheses.reshape(k, n, -1)
+        ).reshape((k,) + self.hypotheses.shape[2:])
+        self.mean_state = np.einsum("kn,knd->kd", self.weights, self.particles)
+        deviation = self.particles - self.mean_state[:, None, :]
+        # unbiased weighted covariance, matching np.cov(..., aweights=weights)
+        self.cov_state = np.einsum(
+            "kn,kni,knj->kij", self.weights, deviation, deviation
+        ) / (1.0 - np.sum(self.weights ** 2, axis=1))[:, None, None]
+
+        rows = np.arange(k)
+        argmax_weight = np.argmax(self.weights, axis=1)
+        self.map_state = self.particles[rows, argmax_weight]
+        self.map_hypothesis = self.hypotheses[rows, argmax_weight]
+
+        # apply any post-processing
+        if self.transform_fn:
+            self.transformed_particles = self.transform_fn(
+                self.original_particles, self.weights, **kwargs
+            )
+        else:
+            self.transformed_particles = self.original_particles
+
+        # resample every filter whose effective sample size has dropped, in one pass
+        resample_rows = self.n_eff < self.n_eff_threshold
+        if np.any(resample_rows):
+            indices = self.resample_fn(
+                self.weights, **_rng_kwargs(self.resample_fn, self.rng, {})
+            )
+            indices = np.where(resample_rows[:, None], indices, np.arange(n))
+            self.particles = self._flat(self.particles)[
+                (indices + rows[:, None] * n).ravel()
+            ].reshape(k, n, -1)
+            self.weights = np.array(self.weights)
+            if self.log_weight_fn is not None:
+                self.log_weights = np.array(self.log_weights)
+            self._reset_weights(resample_rows)
+
+        # randomly resample some particles from the prior
+        if self.resample_proportion > 0:
+            random_mask = self.rng.random(size=(k, n)) < self.resample_proportion
+            self.resampled_particles = random_mask
+            if self.particles is self.original_particles:
+                self.particles = np.array(self.particles)
+            self.init_filter(mask=random_mask)
+
+    def _weight(self, observed, **kwargs):
+        """Reweight all filters in the linear domain and normalise each row."""
+        k, n = self.n_filters, self.n_particles
+        weights = self.weights
+        if observed is not None:
+            weights = np.clip(
+                weights * np.array(
+                    self.weight_fn(
+                        self.hypotheses.reshape(k, n, -1),
+                        observed.reshape(k, 1, -1),
+                        **kwargs
+                    )
+                ),
+                0,
+                np.inf,
+            )
+        if self.internal_weight_fn is not None:
+            internal_weights = np.clip(
+                self.internal_weight_fn(self.particles, observed, **kwargs), 0, np.inf
+            )
+            weights = weights * internal_weights
+
+        self.weight_normalisation = np.sum(weights, axis=1)
+        self.weights = weights / self.weight_normalisation[:, None]
+        self.n_eff = (1.0 / np.sum(self.weights ** 2, axis=1)) / n
+
+    def _log_weight(self, observed, **kwargs):
+        """Reweight all filters in the log domain and normalise each row with log-sum-exp."""
+        k, n = self.n_filters, self.n_particles
+        log_weights = self.log_weights
+        if observed is not None:
+            log_likelihood = np.array(
+                self.log_weight_fn(
+                    self.hypotheses.reshape(k, n, -1),
+                    observed.reshape(k, 1, -1),
+                    **kwargs
+                ),
+                dtype=float,
+            )
+            log_weights = log_weights + np.where(
+                np.isnan(log_likelihood), -np.inf, log_likelihood
+            )
+        if self.internal_weight_fn is not None:
+            internal_weights = np.clip(
+                self.internal_weight_fn(self.particles, observed, **kwargs), 0, np.inf
+            )
+            with np.errstate(divide="ignore"):
+                log_weights = log_weights + np.log(internal_weights)
+
+        log_normalisation = logsumexp(log_weights, axis=1)
+        # filters where every particle has zero probability fall back to uniform weights
+        dead = ~np.isfinite(log_normalisation)
+        if np.any(dead):
+            log_weights = np.where(dead[:, None], 0.0, log_weights)
+            log_normalisation = np.where(dead, np.log(n), log_normalisation)
+
+        self.log_weight_normalisation = log_normalisation
+        self.weight_normalisation = np.exp(log_normalisation)
+        self.log_weights = log_weights - log_normalisation[:, None]
+        self.weights = np.exp(self.log_weights)
+        self.n_eff = np.exp(-logsumexp(2.0 * self.log_weights, axis=1)) / n
+
+    def _log_normalised_weights(self):
+        """Log of the current normalised weights (-inf for zero weights)."""
+        if self.log_weight_fn is not None:
+            return self.log_weights
+        with np.errstate(divide="ignore"):
+            return np.log(self.weights)
@@ -0,0 +1,386 @@
+"""Benchmark suite for the particle filter.
+
+Times `ParticleFilter.update` and the resampling functions over a grid of particle counts,
+state dimensions and observation sizes, and reports throughput, peak memory and tracking
+error. Runs headless (no windows or drawing libraries), and is reproducible: every scenario
+is seeded. Results are written as JSON, so that runs on different commits can be compared:
+
+    python -m pfilter.benchmark --out before.json
+    (check out another commit)
+    python -m pfilter.benchmark --out after.json --compare before.json
+
+Scenarios:
+    resample : each resampler on random weights, for each particle count
+    linear   : a D-dimensional constant-velocity target observed through a random linear
+               projection to P values with Gaussian noise, for each N, D and P
+    blob     : the blob tracking problem of examples/example_filter.py: a disk moving across
+               a 100x100 binary image, with state [x, y, radius, dx, dy], in double and
+               single precision (the filter's dtype option), weighted at full resolution
+               and coarse to fine on a 3 level image pyramid (the pyramid_levels option)
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from .pfilter import ParticleFilter, gaussian_noise, squared_error
+from .resampling import (
+    multinomial_resample,
+    resample,
+    residual_resample,
+    stratified_resample,
+    systematic_resample,
+)
+
+RESAMPLERS = {
+    "resample": resample,
+    "systematic_resample": systematic_resample,
+    "stratified_resample": stratified_resample,
+    "residual_resample": residual_resample,
+    "multinomial_resample": multinomial_resample,
+}
+
+# (particle counts, state dimensions, observation sizes, blob particle counts, steps)
+GRIDS = {
+    "quick": ([100, 1000], [2, 8], [4, 64], [100], 20),
+    "full": ([100, 1000, 10000, 100000], [2, 4, 8, 16], [4, 64, 1024], [100, 500, 2000], 50),
+}
+
+
+def _timed(fn, repeats):
+    """Run fn repeats times, returning the list of wall times in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _peak_memory(fn):
+    """Peak bytes allocated (as traced by tracemalloc) while running fn once."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _time_summary(times, n_items):
+    """Timing statistics for a list of wall times, each processing n_items items."""
+    times = np.asarray(times)
+    return {
+        "median_s": float(np.median(times)),
+        "min_s": float(np.min(times)),
+        "max_s": float(np.max(times)),
+        "throughput": float(n_items / np.median(times)),
+    }
+
+
+def bench_resamplers(n_particles, repeats=20, seed=0):
+    """Time each resampler on a random (Dirichlet distributed) weight vector."""
+    results = []
+    for n in n_particles:
+        rng = np.random.default_rng(seed)
+        weights = rng.dirichlet(np.ones(n))
+        for name, fn in RESAMPLERS.items():
+            run = lambda: fn(weights, rng=rng)
+            run()  # warm up
+            record = {"scenario": "resample", "resampler": name, "n_particles": n}
+            record.update(_time_summary(_timed(run, repeats), n))
+            record["peak_bytes"] = _peak_memory(run)
+            results.append(record)
+    return results
+
+
+def _run_tracking(pf, observations, truth, columns):
+    """Update the filter with each observation, returning the update times and the RMSE
+    of the mean state (on the given columns) against the true states."""
+    times, errors = [], []
+    for observed, state in zip(observations, truth):
+        start = time.perf_counter()
+        pf.update(observed)
+        times.append(time.perf_counter() - start)
+        errors.append(pf.mean_state[columns] - state[columns])
+    return times, float(np.sqrt(np.mean(np.square(errors))))
+
+
+def _tracking_record(scenario, make_filter, observations, truth, columns, n, **params):
+    pf = make_filter()
+    times, rmse = _run_tracking(pf, observations, truth, columns)
+    record = {"scenario": scenario, "n_particles": n}
+    record.update(params)
+    record.update(_time_summary(times, n))
+    record["rmse"] = rmse
+    # peak memory of a separate run, as tracing slows the updates down
+    pf = make_filter()
+    record["peak_bytes"] = _peak_memory(lambda: _run_tracking(pf, observations, truth, columns))
+    return record
+
+
+def linear_scenario(n_steps, d, p, seed=0):
+    """Simulate a constant-velocity target with D/2 positions and D/2 velocities, observed
+    through a random (P,D/2) projection of its position plus Gaussian noise.
+    Returns the model functions and the (observations, true states)."""
+    rng = np.random.default_rng(seed)
+    k = max(d // 2, 1)
+    transition = np.eye(d)
+    if d >= 2:
+        transition[:k, k : 2 * k] = np.eye(k) * 0.1
+    projection = rng.normal(0, 1, (p, k))
+    state = np.concatenate([np.zeros(k), rng.normal(0, 1, d - k)])
+    truth, observations = [], []
+    for _ in range(n_steps):
+        state = state @ transition.T
+        truth.append(state)
+        observations.append(projection @ state[:k] + rng.normal(0, 0.5, p))
+    model = {
+        "prior_fn": lambda n, rng=None: rng.normal(0, 2, (n, d)),
+        "dynamics_fn": lambda x: x @ transition.T,
+        "noise_fn": lambda x, rng=None: gaussian_noise(x, np.full(d, 0.05), rng=rng),
+        "observe_fn": lambda x: x[:, :k] @ projection.T,
+        "weight_fn": lambda x, y: squared_error(x, y, sigma=0.5 * np.sqrt(p)),
+    }
+    return model, np.array(observations), np.array(truth)
+
+
+def bench_linear(n_particles, dims, obs_sizes, n_steps, seed=0):
+    """Time update on the linear scenario for each combination of N, D and P."""
+    results = []
+    for d in dims:
+        for p in obs_sizes:
+            model, observations, truth = linear_scenario(n_steps, d, p, seed)
+            columns = np.arange(max(d // 2, 1))
+            for n in n_particles:
+                make_filter = lambda: ParticleFilter(
+                    n_particles=n, resample_proportion=0.01, rng=seed, **model
+                )
+                results.append(
+                    _tracking_record(
+                        "linear", make_filter, observations, truth, columns, n, d=d, obs_size=p
+                    )
+                )
+    return results
+
+
+IMG_SIZE = 100
+
+
+def blob(x, dtype=np.float64, scale=1):
+    """Render (N,3) [x, y, radius] rows as (N,IMG_SIZE,IMG_SIZE) binary images of disks,
+    as `blob` in examples/example_filter.py, but without a drawing library. With scale > 1,
+    the images are rendered 1/scale the size, approximating the full size images downsampled
+    by scale (see `pfilter.pyramid`)."""
+    size = IMG_SIZE // scale
+    rows = np.arange(size)[None, :, None]
+    cols = np.arange(size)[None, None, :]
+    # position of the disk in units of the coarse pixels, whose centres are those of the
+    # scale x scale blocks of full size pixels they average
+    centre = (x[:, :2] - (scale - 1) / 2) / scale
+    radius = (np.maximum(x[:, 2], 1) / scale)[:, None, None]
+    # a pixel is inside when its centre is strictly inside the circle
+    inside = (rows - centre[:, 0, None, None]) ** 2 + (
+        cols - centre[:, 1, None, None]
+    ) ** 2 < radius ** 2
+    return inside.astype(dtype)
+
+
+def blob_scenario(n_steps, seed=0, dtype=np.float64):
+    """The blob tracking problem of examples/example_filter.py, with hypotheses rendered
+    in the given dtype. Returns the model functions and the (observations, true states)."""
+    rng = np.random.default_rng(seed)
+    dt = 1.1
+    transition = np.eye(5)
+    transition[0, 3] = transition[1, 4] = dt
+    size, dx, dy = rng.uniform(5, 10), rng.uniform(-0.25, 0.25), rng.uniform(-0.25, 0.25)
+    state = np.array([IMG_SIZE // 2, IMG_SIZE // 2, size, dx, dy], dtype=float)
+    truth, observations = [], []
+    for _ in range(n_steps):
+        truth.append(state.copy())
+        observations.append(blob(state[None, :3])[0])
+        state[:2] += [dx, dy]
+
+    def prior_fn(n, rng=None):
+        return np.column_stack(
+            [
+                rng.normal(IMG_SIZE / 2, IMG_SIZE / 2, n),
+                rng.normal(IMG_SIZE / 2, IMG_SIZE / 2, n),
+                rng.gamma(1, 10, n),
+                rng.normal(0, 0.5, n),
+                rng.normal(0, 0.5, n),
+            ]
+        )
+
+    model = {
+        "prior_fn": prior_fn,
+        "dynamics_fn": lambda x: x @ transition.T,
+        "noise_fn": lambda x, rng=None: gaussian_noise(
+            x, sigmas=[0.15, 0.15, 0.05, 0.05, 0.15], rng=rng
+        ),
+        "observe_fn": lambda x, scale=1: blob(x, dtype, scale),
+        "weight_fn": lambda x, y: squared_error(x, y, sigma=2),
+    }
+    return model, np.array(observations), np.array(truth)
+
+
+def bench_blob(
+    n_particles, n_steps, seed=0, dtypes=("float64", "float32"), pyramid_levels=(1, 3)
+):
+    """Time update on the blob tracking scenario for each particle count, dtype and number
+    of pyramid levels."""
+    results = []
+    for dtype in dtypes:
+        model, observations, truth = blob_scenario(n_steps, seed, dtype)
+        for levels in pyramid_levels:
+            for n in n_particles:
+                make_filter = lambda: ParticleFilter(
+                    n_particles=n,
+                    resample_proportion=0.1,
+                    rng=seed,
+                    dtype=dtype,
+                    pyramid_levels=levels,
+                    **model
+                )
+                results.append(
+                    _tracking_record(
+                        "blob",
+                        make_filter,
+                        observations,
+                        truth,
+                        np.arange(2),
+                        n,
+                        d=5,
+                        obs_size=IMG_SIZE * IMG_SIZE,
+                        dtype=dtype,
+                        pyramid_levels=levels,
+                    )
+                )
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(grid="quick", scenarios=("resample", "linear", "blob"), seed=0):
+    """Run the benchmark scenarios on one of the GRIDS.
+    Returns:
+    -------
+        results : dict
+            {"metadata": {...}, "results": [record, ...]}, one record per benchmark
+    """
+    n_particles, dims, obs_sizes, blob_particles, n_steps = GRIDS[grid]
+    results = []
+    if "resample" in scenarios:
+        results += bench_resamplers(n_particles, seed=seed)
+    if "linear" in scenarios:
+        results += bench_linear(n_particles, dims, obs_sizes, n_steps, seed=seed)
+    if "blob" in scenarios:
+        results += bench_blob(blob_particles, n_steps, seed=seed)
+    metadata = {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "grid": grid,
+        "seed": seed,
+    }
+    return {"metadata": metadata, "results": results}
+
+
+# parameters that identify a benchmark, as opposed to its measurements
+_KEY_FIELDS = (
+    "scenario",
+    "resampler",
+    "n_particles",
+    "d",
+    "obs_size",
+    "dtype",
+    "pyramid_levels",
+)
+# values of fields missing from the results of older runs
+_KEY_DEFAULTS = {"dtype": "float64", "pyramid_levels": 1}
+
+
+def _key(record):
+    return tuple(record.get(field, _KEY_DEFAULTS.get(field)) for field in _KEY_FIELDS)
+
+
+def _label(record):
+    return " ".join(
+        "{}={}".format(field, record[field]) for field in _KEY_FIELDS if field in record
+    )
+
+
+def compare(old, new):
+    """Pair up the benchmarks of two runs, returning (label, old median, new median,
+    speedup) for each benchmark present in both."""
+    old_records = {_key(record): record for record in old["results"]}
+    rows = []
+    for record in new["results"]:
+        previous = old_records.get(_key(record))
+        if previous is not None:
+            rows.append(
+                (
+                    _label(record),
+                    previous["median_s"],
+                    record["median_s"],
+                    previous["median_s"] / record["median_s"],
+                )
+            )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grid", choices=sorted(GRIDS), default="quick")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=["resample", "linear", "blob"],
+        help="scenario to run (may be repeated; default all)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args.grid, args.scenario or ("resample", "linear", "blob"), args.seed)
+    for record in results["results"]:
+        print(
+            "{:<68} {:>10.3f} ms {:>14.0f} particles/s {:>8.1f} MB{}".format(
+                _label(record),
+                record["median_s"] * 1e3,
+                record["throughput"],
+                record["peak_bytes"] / 1e6,
+                "  rmse={:.3f}".format(record["rmse"]) if "rmse" in record else "",
+            )
+        )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("\nspeedup relative to {}".format(old["metadata"].get("commit")))
+        for label, old_time, new_time, speedup in compare(old, results):
+            print(
+                "{:<68} {:>10.3f} ms -> {:>10.3f} ms  x{:.2f}".format(
+                    label, old_time * 1e3, new_time * 1e3, speedup
+                )
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
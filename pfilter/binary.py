@@ -0,0 +1,136 @@
+import numpy as np
+
+# Binary (silhouette) observations, stored as bitmaps packed eight pixels to a byte with
+# `np.packbits`. A (W,H) binary image then takes W*H/8 bytes instead of 8*W*H as float64,
+# and the distance between two images is an XOR (or AND/OR) followed by a population count,
+# rather than subtracting, squaring and summing every pixel. To use them, wrap the observation
+# function with `packed_observe`, pack the observed frame with `pack_binary`, and use one of
+# the weight functions below:
+#
+#   ParticleFilter(observe_fn=packed_observe(blob), weight_fn=hamming_error, ...)
+#   pf.update(pack_binary(frame))
+#
+# For binary images, the Hamming distance is exactly the summed squared error, so
+# `hamming_error` gives the same weights as `squared_error` on the unpacked images.
+# The weight functions score the last axis, so they also work with ParticleFilterBank.
+
+# number of set bits in each byte value, for numpy versions without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed, axis=-1):
+    """Number of set bits along an axis of an array of packed bytes (uint8)."""
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        counts = np.bitwise_count(packed)
+    else:
+        counts = _POPCOUNT[packed]
+    return np.sum(counts, axis=axis, dtype=np.int64)
+
+
+def pack_binary(images):
+    """Pack binary images into bitmaps.
+    Parameters:
+    -----------
+        images : array (N,...)
+            N images of any shape; nonzero values are set pixels
+    Returns:
+    -------
+        packed : array (N,B)
+            uint8 array with B = ceil(pixels / 8) bytes per image
+    """
+    images = np.asarray(images)
+    return np.packbits(images.reshape(images.shape[0], -1) != 0, axis=-1)
+
+
+def unpack_binary(packed, shape):
+    """Unpack (N,B) bitmaps from `pack_binary` back into (N,)+shape arrays of 0/1 (uint8)."""
+    n_pixels = int(np.prod(shape))
+    unpacked = np.unpackbits(packed, axis=-1, count=n_pixels)
+    return unpacked.reshape(packed.shape[:-1] + tuple(shape))
+
+
+def packed_observe(observe_fn):
+    """Wrap an observation function that renders binary images, so that it returns them as
+    packed bitmaps (see `pack_binary`). The hypotheses and map_hypothesis of the filter are
+    then packed bytes, which `unpack_binary` turns back into images. mean_hypothesis is not
+    available for packed observations: the filter averages the packed bytes themselves, which
+    gives numbers with no meaning as an image (leave it out of the filter's `summaries`).
+    Average the unpacked hypotheses instead, e.g.
+
+        np.average(unpack_binary(pf.hypotheses, shape), axis=0, weights=pf.original_weights)
+    """
+
+    def observe(x, **kwargs):
+        return pack_binary(observe_fn(x, **kwargs))
+
+    return observe
+
+
+def hamming_distance(x, y):
+    """Number of pixels that differ between packed bitmaps x and y (broadcast over
+    leading dimensions, e.g. x (N,B) against y (1,B))."""
+    return popcount(np.bitwise_xor(x, y))
+
+
+def hamming_error(x, y, sigma=1, out=None):
+    """
+        RBF kernel on the Hamming distance between packed binary images,
+        the packed equivalent of `squared_error`.
+        Parameters:
+        -----------
+        x : array (N,B) array of packed bitmaps
+        y : array (N,B) array of packed bitmaps
+            Any leading dimensions broadcast; the distance is over the last axis.
+        sigma : float
+            width of the kernel
+        out : array, optional
+            N-element array to write the similarities into
+
+        Returns:
+        -------
+
+        similarity : array
+            similarity of each pair of images, using the equation:
+
+                d(x,y) = e^(-hamming(x, y) / (2 * sigma ** 2))
+    """
+    d = hamming_distance(x, y)
+    return np.exp(d * (-1.0 / (2.0 * sigma ** 2)), out=out)
+
+
+def log_hamming_error(x, y, sigma=1, out=None):
+    """
+        Log-domain version of `hamming_error`, for use as log_weight_fn:
+
+            log d(x,y) = -hamming(x, y) / (2 * sigma ** 2)
+    """
+    d = hamming_distance(x, y)
+    return np.multiply(d, -1.0 / (2.0 * sigma ** 2), out=out)
+
+
+def iou_similarity(x, y, power=1.0, out=None):
+    """
+        Intersection over union of packed binary images, raised to a power
+        (higher powers make the weights more selective).
+        Parameters:
+        -----------
+        x : array (N,B) array of packed bitmaps
+        y : array (N,B) array of packed bitmaps
+            Any leading dimensions broadcast; the overlap is over the last axis.
+        power : float
+            exponent applied to the IoU
+        out : array, optional
+            N-element array to write the similarities into
+
+        Returns:
+        -------
+
+        similarity : array
+            IoU of each pair of images, in [0, 1]; two empty images have an IoU of 1.
+    """
+    intersection = popcount(np.bitwise_and(x, y))
+    union = popcount(np.bitwise_or(x, y))
+    iou = np.divide(
+        intersection, union, out=np.ones(np.shape(union)), where=union > 0
+    )
+    return np.power(iou, power, out=out)
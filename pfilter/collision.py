@@ -0,0 +1,208 @@
+import numpy as np
+
+# Collision queries against an occupancy grid of walls, for dynamics functions that bounce
+# particles off obstacles. A particle at (x, y) with radius r collides if any wall cell lies in
+# the (2r+1)x(2r+1) square centred on its (rounded) position, or if the square leaves the grid.
+# Equivalently, the Chebyshev distance from the particle's cell to the nearest wall is at most
+# r, where the cells just outside the grid count as walls. The map keeps that distance for
+# every cell (capped just beyond max_radius, as larger distances are never asked about), so a
+# query for all N particles is one gather and one comparison, whatever their radii. Drawing
+# walls lowers the distances in a window around each new wall cell, without a full rebuild.
+
+
+class CollisionMap(object):
+    """Occupancy grid of walls that answers batched collision queries.
+
+    Parameters:
+    -----------
+        shape : (H, W) tuple
+            size of the grid; cell [row, col] is at y=row, x=col
+        max_radius : int
+            largest (rounded) radius expected in queries. Larger radii still give the right
+            answer, but rebuild the distance map the first time they are seen.
+        wall_map : array (H,W), optional
+            initial occupancy, nonzero where there is a wall
+
+    Attributes:
+    -----------
+        wall_map : array (H,W)
+            uint8 occupancy grid (1 for walls). It is updated in place, so it can be kept and
+            read (e.g. for drawing) while walls are added or cleared.
+    """
+
+    def __init__(self, shape, max_radius=8, wall_map=None):
+        self.shape = tuple(shape)
+        self.wall_map = np.zeros(self.shape, dtype=np.uint8)
+        self._build(max_radius)
+        if wall_map is not None:
+            self.add_walls(*np.nonzero(wall_map))
+
+    def _build(self, max_radius):
+        """(Re)compute the distance map from wall_map, capped at max_radius + 1."""
+        self.max_radius = int(max_radius)
+        height, width = self.shape
+        # padded by one cell on each side; the border stands for the edge of the grid
+        self._distance = np.full(
+            (height + 2, width + 2), self.max_radius + 1, dtype=np.int32
+        )
+        self._distance[[0, -1], :] = 0
+        self._distance[:, [0, -1]] = 0
+        border = np.arange(1, max(height, width) + 1)
+        # distance to the nearest edge, which also caps the distance to any wall
+        edge = np.minimum.outer(
+            np.minimum(border[:height], border[:height][::-1]),
+            np.minimum(border[:width], border[:width][::-1]),
+        )
+        np.minimum(self._distance[1:-1, 1:-1], edge, out=self._distance[1:-1, 1:-1])
+        self._lower(*np.nonzero(self.wall_map))
+
+    def _lower(self, rows, cols):
+        """Lower the distance map around the given wall cells."""
+        if len(rows) == 0:
+            return
+        reach = self.max_radius + 1
+        offsets = np.arange(-reach, reach + 1)
+        d_row, d_col = np.meshgrid(offsets, offsets, indexing="ij")
+        d_row, d_col = d_row.ravel(), d_col.ravel()
+        target_rows = np.asarray(rows)[:, None] + d_row + 1
+        target_cols = np.asarray(cols)[:, None] + d_col + 1
+        distance = np.broadcast_to(np.maximum(np.abs(d_row), np.abs(d_col)), target_rows.shape)
+        # leave the padding border alone, and never index outside the padded grid
+        height, width = self.shape
+        valid = (
+            (target_rows >= 1)
+            & (target_rows <= height)
+            & (target_cols >= 1)
+            & (target_cols <= width)
+        )
+        np.minimum.at(
+            self._distance, (target_rows[valid], target_cols[valid]), distance[valid]
+        )
+
+    def add_walls(self, rows, cols):
+        """Mark the given cells as walls (coordinates are clipped to the grid)."""
+        rows = np.clip(np.asarray(rows, dtype=np.intp).ravel(), 0, self.shape[0] - 1)
+        cols = np.clip(np.asarray(cols, dtype=np.intp).ravel(), 0, self.shape[1] - 1)
+        new = self.wall_map[rows, cols] == 0
+        self.wall_map[rows, cols] = 1
+        self._lower(rows[new], cols[new])
+
+    def _thick(self, rows, cols, thickness):
+        """Cells covered by squares of the given thickness around each cell, with the same
+        offsets as the wall drawing in the examples: range(-thickness // 2, thickness // 2 + 1)."""
+        offsets = np.arange(-thickness // 2, thickness // 2 + 1)
+        rows = np.asarray(rows)[:, None, None] + offsets[None, :, None]
+        cols = np.asarray(cols)[:, None, None] + offsets[None, None, :]
+        rows, cols = np.broadcast_arrays(rows, cols)
+        return rows.ravel(), cols.ravel()
+
+    def add_point(self, x, y, thickness=1):
+        """Add a square wall of the given thickness centred on cell (x, y)."""
+        self.add_walls(*self._thick([y], [x], thickness))
+
+    def add_line(self, x1, y1, x2, y2, thickness=1):
+        """Add a wall of the given thickness along the straight line from (x1, y1) to (x2, y2)."""
+        rows, cols = line_cells(y1, x1, y2, x2)
+        self.add_walls(*self._thick(rows, cols, thickness))
+
+    def clear(self):
+        """Remove all walls."""
+        self.wall_map.fill(0)
+        self._build(self.max_radius)
+
+    def collides(self, x, y, radius=1):
+        """Whether particles at (x, y) with the given radius collide with a wall or the edge
+        of the grid. Positions and radii are rounded to whole cells.
+        Parameters:
+        -----------
+            x, y : array
+                positions (column and row), of any broadcastable shape, e.g. N-element vectors
+            radius : float or array
+                radius of each particle
+        Returns:
+        -------
+            collides : bool array
+                True where the particle's square touches a wall or leaves the grid
+        """
+        x, y, radius = np.broadcast_arrays(
+            np.round(x).astype(np.intp),
+            np.round(y).astype(np.intp),
+            np.round(radius).astype(np.intp),
+        )
+        largest = np.max(radius, initial=0)
+        if largest > self.max_radius:
+            self._build(largest)
+        height, width = self.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        distance = self._distance[
+            np.clip(y, -1, height) + 1, np.clip(x, -1, width) + 1
+        ]
+        return ~inside | (distance <= radius)
+
+    def blocked_moves(self, x, y, vx, vy, radius=1, dt=1.0):
+        """Collision tests for moving particles, as used to bounce them off walls.
+        Parameters:
+        -----------
+            x, y : array
+                current positions
+            vx, vy : array
+                velocities
+            radius : float or array
+                radius of each particle
+            dt : float
+                time step
+        Returns:
+        -------
+            blocked : bool array
+                whether the particle collides at its new position (x + vx*dt, y + vy*dt)
+            blocked_x : bool array
+                blocked, and collides when moving along x only (so vx should be reflected)
+            blocked_y : bool array
+                blocked, and collides when moving along y only (so vy should be reflected)
+        """
+        new_x, new_y = x + vx * dt, y + vy * dt
+        blocked = self.collides(new_x, new_y, radius)
+        blocked_x = blocked & self.collides(new_x, y, radius)
+        blocked_y = blocked & self.collides(x, new_y, radius)
+        return blocked, blocked_x, blocked_y
+
+
+def line_cells(r0, c0, r1, c1):
+    """Row and column indices of the cells on the straight line from (r0, c0) to (r1, c1),
+    one cell per step along the major axis (like `skimage.draw.line`)."""
+    n = int(max(abs(r1 - r0), abs(c1 - c0))) + 1
+    rows = np.round(np.linspace(r0, r1, n)).astype(np.intp)
+    cols = np.round(np.linspace(c0, c1, n)).astype(np.intp)
+    return rows, cols
+
+
+def collision_dynamics(x, collision_map, dt=1.0, damping=0.8, min_radius=1.0):
+    """Constant-velocity dynamics that bounce particles off the walls of a CollisionMap, for
+    [x, y, radius, dx, dy, ...] states: a particle that would collide keeps its position, and
+    the velocity components that caused the collision are reflected and damped.
+    Parameters:
+    -----------
+        x : array (N,D)
+            particle states, with D >= 5
+        collision_map : CollisionMap
+            the walls
+        dt : float
+            time step
+        damping : float
+            factor applied to a reflected velocity component
+        min_radius : float
+            particles are treated as at least this large
+    Returns:
+    -------
+        new_x : array (N,D)
+            the moved particles (other columns are copied unchanged)
+    """
+    new_x = np.copy(x)
+    blocked, blocked_x, blocked_y = collision_map.blocked_moves(
+        x[:, 0], x[:, 1], x[:, 3], x[:, 4], np.maximum(x[:, 2], min_radius), dt
+    )
+    new_x[:, 0] = np.where(blocked, x[:, 0], x[:, 0] + x[:, 3] * dt)
+    new_x[:, 1] = np.where(blocked, x[:, 1], x[:, 1] + x[:, 4] * dt)
+    new_x[:, 3] = np.where(blocked_x, -x[:, 3] * damping, x[:, 3])
+    new_x[:, 4] = np.where(blocked_y, -x[:, 4] * damping, x[:, 4])
+    return new_x
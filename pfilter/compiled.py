@@ -0,0 +1,258 @@
+import functools
+import warnings
+import numpy as np
+from . import collision, pfilter, resampling
+
+# Optional compiled backend. The kernels below are explicit loops over particles, compiled
+# with Numba (nopython mode, parallel over particles with prange) when it is installed. Each
+# public function has the same signature and draws exactly the same random numbers as its
+# NumPy counterpart: the random draws still come from the numpy Generator (or np.random), and
+# only the work done with them (searching the cumulative weights, copying residual indices,
+# scaling and adding noise, testing collisions) is compiled. So the two backends give the same
+# results for the same seed, up to floating point rounding.
+#
+# Without Numba, the public names below are the NumPy implementations, and selecting the
+# "numba" backend falls back to NumPy with a warning; the loop kernels themselves still run
+# (very slowly) as plain Python, which is how they are checked against NumPy.
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+if HAVE_NUMBA:
+    _kernel = functools.partial(numba.njit, parallel=True, cache=True)
+    prange = numba.prange
+else:
+    _kernel = lambda **options: (lambda fn: fn)
+    prange = range
+
+BACKENDS = ("numpy", "numba")
+
+
+@_kernel()
+def _search_kernel(cumsum, positions, right, out):
+    """out[i] = the first index whose cumulative weight exceeds positions[i] (or is at least
+    positions[i], if not right), clipped to the last particle; a binary search per position."""
+    n = len(cumsum)
+    for i in prange(len(positions)):
+        p = positions[i]
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumsum[mid] < p or (right and cumsum[mid] == p):
+                lo = mid + 1
+            else:
+                hi = mid
+        out[i] = min(lo, n - 1)
+    return out
+
+
+@_kernel()
+def _repeat_kernel(num_copies, starts, n, out):
+    """Write num_copies[i] copies of i from out[starts[i]], stopping at out[n - 1]."""
+    for i in prange(len(num_copies)):
+        stop = min(starts[i] + num_copies[i], n)
+        for k in range(starts[i], stop):
+            out[k] = i
+    return out
+
+
+@_kernel()
+def _scale_add_kernel(x, noise, sigmas, out):
+    """out = x + noise * sigmas, row by row."""
+    for i in prange(x.shape[0]):
+        for j in range(x.shape[1]):
+            out[i, j] = x[i, j] + noise[i, j] * sigmas[j]
+    return out
+
+
+@_kernel(parallel=False)
+def _collides(distance, height, width, x, y, radius):
+    """Scalar version of `CollisionMap.collides`, on the padded distance map."""
+    xi, yi, ri = round(x), round(y), round(radius)
+    if xi < 0 or xi >= width or yi < 0 or yi >= height:
+        return True
+    return distance[yi + 1, xi + 1] <= ri
+
+
+@_kernel()
+def _collision_dynamics_kernel(x, distance, height, width, dt, damping, min_radius, out):
+    for i in prange(x.shape[0]):
+        radius = max(x[i, 2], min_radius)
+        new_x = x[i, 0] + x[i, 3] * dt
+        new_y = x[i, 1] + x[i, 4] * dt
+        for j in range(x.shape[1]):
+            out[i, j] = x[i, j]
+        if _collides(distance, height, width, new_x, new_y, radius):
+            if _collides(distance, height, width, new_x, x[i, 1], radius):
+                out[i, 3] = -x[i, 3] * damping
+            if _collides(distance, height, width, x[i, 0], new_y, radius):
+                out[i, 4] = -x[i, 4] * damping
+        else:
+            out[i, 0] = new_x
+            out[i, 1] = new_y
+    return out
+
+
+def _search(cumsum, positions, right=True):
+    return _search_kernel(
+        cumsum, np.ascontiguousarray(positions), right, np.empty(len(positions), np.intp)
+    )
+
+
+def _create_indices(positions, weights):
+    return _search(resampling._cumulative_weights(weights), positions)
+
+
+def _systematic_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = (np.arange(n) + rng.uniform(0, 1)) / n
+    return _create_indices(positions, weights)
+
+
+def _stratified_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = (rng.uniform(0, 1, n) + np.arange(n)) / n
+    return _create_indices(positions, weights)
+
+
+def _multinomial_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = np.sort(rng.uniform(0, 1, n))
+    return _create_indices(positions, weights)
+
+
+def _resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = (rng.random() + np.arange(n)) / n
+    return _search(resampling._cumulative_weights(weights), positions, right=False)
+
+
+def _residual_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    scaled = n * np.asarray(weights)
+    num_copies = np.floor(scaled).astype(np.intp)
+    starts = np.cumsum(num_copies) - num_copies
+    k = min(int(np.sum(num_copies)), n)
+    indices = np.empty(n, np.intp)
+    _repeat_kernel(num_copies, starts, n, indices)
+    if k == n:
+        return indices
+    # fill up the rest with multinomial resampling on the residuals
+    cumsum = np.cumsum(scaled - num_copies)
+    cumsum /= cumsum[-1]
+    cumsum[-1] = 1.0
+    indices[k:] = _search(cumsum, rng.uniform(0, 1, n - k))
+    return indices
+
+
+def _noise(x, sigmas, draws, out):
+    """x plus draws scaled by sigmas, written into out (or a new array of x's dtype)."""
+    x = np.asarray(x)
+    if out is None:
+        out = np.empty(x.shape, np.result_type(x.dtype, np.float32))
+    sigmas = np.broadcast_to(np.asarray(sigmas, dtype=np.float64), (x.shape[1],))
+    return _scale_add_kernel(x, draws, np.ascontiguousarray(sigmas), out)
+
+
+def _gaussian_noise(x, sigmas, rng=None, out=None):
+    rng = np.random if rng is None else rng
+    # single precision draws for single precision results, as gaussian_noise does
+    single = (out if out is not None else np.asarray(x)).dtype == np.float32
+    draws = np.empty((x.shape[0], len(sigmas)), np.float32 if single else np.float64)
+    pfilter._standard_noise(rng, "standard_normal", draws)
+    return _noise(x, sigmas, draws, out)
+
+
+def _t_noise(x, sigmas, df=1.0, rng=None, out=None):
+    rng = np.random if rng is None else rng
+    return _noise(x, sigmas, rng.standard_t(df, size=(x.shape[0], len(sigmas))), out)
+
+
+def _cauchy_noise(x, sigmas, rng=None, out=None):
+    rng = np.random if rng is None else rng
+    return _noise(x, sigmas, rng.standard_cauchy(size=(x.shape[0], len(sigmas))), out)
+
+
+def _collision_dynamics(x, collision_map, dt=1.0, damping=0.8, min_radius=1.0):
+    x = np.ascontiguousarray(x)
+    largest = np.round(np.max(np.maximum(x[:, 2], min_radius), initial=0))
+    if largest > collision_map.max_radius:
+        collision_map._build(largest)
+    height, width = collision_map.shape
+    return _collision_dynamics_kernel(
+        x,
+        collision_map._distance,
+        height,
+        width,
+        float(dt),
+        float(damping),
+        float(min_radius),
+        np.empty_like(x),
+    )
+
+
+# the NumPy implementation of each function, and its compiled equivalent
+_IMPLEMENTATIONS = {
+    "create_indices": (resampling.create_indices, _create_indices),
+    "systematic_resample": (resampling.systematic_resample, _systematic_resample),
+    "stratified_resample": (resampling.stratified_resample, _stratified_resample),
+    "residual_resample": (resampling.residual_resample, _residual_resample),
+    "multinomial_resample": (resampling.multinomial_resample, _multinomial_resample),
+    "resample": (resampling.resample, _resample),
+    "gaussian_noise": (pfilter.gaussian_noise, _gaussian_noise),
+    "t_noise": (pfilter.t_noise, _t_noise),
+    "cauchy_noise": (pfilter.cauchy_noise, _cauchy_noise),
+    "collision_dynamics": (collision.collision_dynamics, _collision_dynamics),
+}
+
+# the public names are the compiled functions if Numba is installed, and NumPy's otherwise
+_PREFERRED = BACKENDS.index("numba" if HAVE_NUMBA else "numpy")
+create_indices = _IMPLEMENTATIONS["create_indices"][_PREFERRED]
+systematic_resample = _IMPLEMENTATIONS["systematic_resample"][_PREFERRED]
+stratified_resample = _IMPLEMENTATIONS["stratified_resample"][_PREFERRED]
+residual_resample = _IMPLEMENTATIONS["residual_resample"][_PREFERRED]
+multinomial_resample = _IMPLEMENTATIONS["multinomial_resample"][_PREFERRED]
+resample = _IMPLEMENTATIONS["resample"][_PREFERRED]
+gaussian_noise = _IMPLEMENTATIONS["gaussian_noise"][_PREFERRED]
+t_noise = _IMPLEMENTATIONS["t_noise"][_PREFERRED]
+cauchy_noise = _IMPLEMENTATIONS["cauchy_noise"][_PREFERRED]
+collision_dynamics = _IMPLEMENTATIONS["collision_dynamics"][_PREFERRED]
+
+
+def resolve_backend(backend):
+    """The backend that will actually be used for the requested one: "numba" falls back to
+    "numpy" (with a warning) when Numba is not installed."""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}; expected one of {}".format(backend, BACKENDS))
+    if backend == "numba" and not HAVE_NUMBA:
+        warnings.warn(
+            "numba is not installed; using the NumPy implementations", RuntimeWarning
+        )
+        return "numpy"
+    return backend
+
+
+def backend_function(fn, backend):
+    """The equivalent of a built-in function in the given backend. Works on the built-in
+    resampling, noise and collision dynamics functions, and on `functools.partial` objects
+    wrapping them (e.g. partial(gaussian_noise, sigmas=[...])); any other function (such as a
+    lambda calling a built-in) is returned unchanged."""
+    column = BACKENDS.index(resolve_backend(backend))
+    if isinstance(fn, functools.partial):
+        inner = backend_function(fn.func, backend)
+        if inner is fn.func:
+            return fn
+        return functools.partial(inner, *fn.args, **fn.keywords)
+    for implementations in _IMPLEMENTATIONS.values():
+        if any(fn is implementation for implementation in implementations):
+            return implementations[column]
+    return fn
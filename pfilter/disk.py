@@ -0,0 +1,168 @@
+import numpy as np
+
+# Likelihood of disk-shaped targets (the [x, y, radius, ...] blob state of the examples)
+# without rendering an image per particle. If h is the binary image of a disk D and o the
+# observed image, the summed squared error is
+#
+#   sum (h - o)^2 = |D| - 2 * sum_D o + sum o^2
+#
+# so each particle needs only the area of its disk and the sum of the observation over it.
+# Both come from a summed-area table of the observation, cumulative along each row: a
+# rasterised disk is a stack of row spans, and the sum over a span is the difference of two
+# table entries. Building the tables costs O(W*H) once per update, and scoring N particles
+# is one vectorized gather of N*(2R+1) entries, with no (N,W,H) hypotheses tensor. The filter
+# passes the weight functions an `observation_key` token for each update, and the tables are
+# kept for as long as the token is the same, so that scoring the particles in chunks
+# (chunk_size, chunk_memory) builds them only once per update. The key is not the observation
+# array, which a capture loop may overwrite in place with each new frame.
+
+
+def _row_tables(frames):
+    """Row-wise summed-area tables of (M,H,W) frames: (M,H,W+1), with a leading zero column,
+    so that the sum of frames[m, i, a:b] is table[m, i, b] - table[m, i, a]."""
+    m, h, w = frames.shape
+    table = np.zeros((m, h, w + 1))
+    np.cumsum(frames, axis=2, out=table[:, :, 1:])
+    return table
+
+
+def disk_spans(centre_rows, centre_cols, radii, shape):
+    """The row spans of rasterised disks: each disk covers the pixels whose centres are
+    strictly inside its circle (as `skimage.draw.disk`), clipped to the image.
+    Parameters:
+    -----------
+        centre_rows, centre_cols, radii : array (N,)
+            disk centres (row, column) and radii
+        shape : (H, W) tuple
+            image size
+    Returns:
+    -------
+        rows : array (N,S)
+            row index of each span (clipped into the image; check `valid`)
+        starts, stops : array (N,S)
+            first column and one past the last column of each span
+        valid : bool array (N,S)
+            which spans are inside the image and non-empty
+    """
+    height, width = shape
+    top = np.floor(centre_rows - radii) + 1
+    n_spans = int(np.max(np.ceil(2 * radii), initial=0)) + 1
+    rows = top[:, None] + np.arange(n_spans)
+    half_width_sq = radii[:, None] ** 2 - (rows - centre_rows[:, None]) ** 2
+    half_width = np.sqrt(np.maximum(half_width_sq, 0.0))
+    starts = np.floor(centre_cols[:, None] - half_width) + 1
+    stops = np.ceil(centre_cols[:, None] + half_width)
+    starts = np.clip(starts, 0, width).astype(np.intp)
+    stops = np.clip(stops, 0, width).astype(np.intp)
+    valid = (half_width_sq > 0) & (rows >= 0) & (rows < height) & (stops > starts)
+    rows = np.clip(rows, 0, height - 1).astype(np.intp)
+    return rows, starts, stops, valid
+
+
+class DiskLikelihood(object):
+    """Observation model for disk-shaped targets that scores particles directly against the
+    observed image, without rendering a hypothesis image per particle.
+
+    Use `observe` as the filter's observe_fn (the hypotheses are then just the (N,3) disk
+    parameters) and `weight` as its weight_fn, or `log_weight` as its log_weight_fn:
+
+        disk = DiskLikelihood((100, 100), sigma=2)
+        ParticleFilter(observe_fn=disk.observe, weight_fn=disk.weight, ...)
+
+    The weights equal `squared_error(blob(x), observed, sigma)` for disks rendered with
+    `render`, i.e. pixels whose centres are strictly inside the circle.
+
+    Parameters:
+    -----------
+        shape : (H, W) tuple
+            size of the observed images
+        sigma : float
+            width of the RBF kernel on the summed squared error, as for `squared_error`
+        columns : 3 ints
+            state columns holding the disk centre row, centre column and radius
+        min_radius : float
+            radii are clamped to at least this (the examples draw max(radius, 1))
+
+    The tables of an observation are reused by the calls given the same observation_key
+    (which the filter passes for each update); without a key they are built on every call.
+    """
+
+    def __init__(self, shape, sigma=1.0, columns=(0, 1, 2), min_radius=1.0):
+        self.shape = tuple(shape)
+        self.sigma = sigma
+        self.columns = list(columns)
+        self.min_radius = min_radius
+        self._cache = None
+
+    def _tables(self, observed, observation_key=None):
+        """The row tables and the sums of squares of the observed frames, reusing those of
+        the previous call when it was given the same observation_key."""
+        if observation_key is not None and self._cache is not None:
+            if self._cache[0] is observation_key:
+                return self._cache[1], self._cache[2]
+        frames = np.reshape(observed, (-1,) + self.shape)
+        table = _row_tables(frames)
+        total_sq = np.sum(np.square(frames.reshape(len(frames), -1)), axis=1)
+        if observation_key is not None:
+            self._cache = (observation_key, table, total_sq)
+        return table, total_sq
+
+    def observe(self, x):
+        """The (N,3) disk parameters [row, column, radius] of (N,D) states."""
+        disks = np.array(x[..., self.columns], dtype=float)
+        np.maximum(disks[..., 2], self.min_radius, out=disks[..., 2])
+        return disks
+
+    def squared_errors(self, disks, observed, observation_key=None):
+        """Summed squared error between each disk's binary image and the observation.
+        Parameters:
+        -----------
+            disks : array (N,3), or (K,N,3) with one observation per filter of a bank
+                disk parameters from `observe`
+            observed : array
+                the observed image(s), of (or flattened from) shape (H,W), or (K,1,H*W)
+            observation_key : object, optional
+                token identifying the observation, passed by the filter; calls with the same
+                key reuse the tables built from it
+        Returns:
+        -------
+            errors : array (N,) or (K,N)
+        """
+        table, total_sq = self._tables(observed, observation_key)
+        disks = np.asarray(disks)
+        grouped = disks.reshape(len(table), -1, 3)
+        m, n = grouped.shape[:2]
+        flat = grouped.reshape(m * n, 3)
+        rows, starts, stops, valid = disk_spans(
+            flat[:, 0], flat[:, 1], flat[:, 2], self.shape
+        )
+        frame = np.repeat(np.arange(m), n)[:, None]
+        inside = np.where(
+            valid, table[frame, rows, stops] - table[frame, rows, starts], 0.0
+        ).sum(axis=1)
+        area = np.where(valid, stops - starts, 0).sum(axis=1)
+        errors = area - 2.0 * inside + np.repeat(total_sq, n)
+        return errors.reshape(disks.shape[:-1])
+
+    def weight(self, disks, observed, out=None, observation_key=None):
+        """RBF similarity of each disk to the observation, as `squared_error` on rendered disks."""
+        errors = self.squared_errors(disks, observed, observation_key)
+        return np.exp(errors * (-1.0 / (2.0 * self.sigma ** 2)), out=out)
+
+    def log_weight(self, disks, observed, out=None, observation_key=None):
+        """Log-domain version of `weight`, for use as log_weight_fn."""
+        errors = self.squared_errors(disks, observed, observation_key)
+        return np.multiply(errors, -1.0 / (2.0 * self.sigma ** 2), out=out)
+
+    def render(self, x):
+        """Render (N,D) states as (N,H,W) binary disk images, e.g. for display."""
+        disks = self.observe(x)
+        rows, starts, stops, valid = disk_spans(
+            disks[:, 0], disks[:, 1], disks[:, 2], self.shape
+        )
+        images = np.zeros((len(disks),) + self.shape)
+        cols = np.arange(self.shape[1])
+        for s in range(rows.shape[1]):
+            span = valid[:, s, None] & (cols >= starts[:, s, None]) & (cols < stops[:, s, None])
+            images[np.arange(len(disks)), rows[:, s]] += span
+        return images
@@ -0,0 +1,352 @@
+import functools
+import inspect
+import warnings
+import numpy as np
+from .pfilter import ParticleFilter, identity, log_squared_error, squared_error
+from .rng import _accepts_keyword, _accepts_rng, make_rng
+
+# A particle filter whose whole update is one compiled function. ParticleFilter.update is a
+# sequence of separate NumPy calls, each dispatched from Python and each with its own
+# temporary arrays; for a few thousand particles that overhead can cost more than the
+# arithmetic. JaxParticleFilter instead traces dynamics, noise, observation, weighting, the
+# posterior summaries, resampling and replenishment into a single function, which `jax.jit`
+# compiles with XLA (fusing the elementwise work into a few loops) the first time it is called
+# with a given observation shape. Later updates are one call into compiled code.
+#
+# The model functions are traced, so they must be written with array operations that JAX can
+# trace: operators and array methods, or the `xp` namespace, which is passed (as jax.numpy)
+# to any model function with an `xp` parameter. Functions with an `rng` parameter are given a
+# `KeyGenerator`, which offers the common np.random.Generator methods on top of JAX's explicit
+# keys, so that e.g.
+#
+#     def noise_fn(x, rng=None):
+#         return x + rng.normal(0, sigmas, size=x.shape)
+#
+# works unchanged in both filters (including the built-in gaussian_noise, t_noise and
+# cauchy_noise). The built-in squared_error and log_squared_error are replaced by traceable
+# equivalents when given directly (or as a functools.partial). Functions that cannot be traced
+# include `independent_sample` over scipy.stats distributions, whose `rvs` needs a NumPy random
+# state and writes into a NumPy array.
+#
+# `jit_filter` creates a JaxParticleFilter if JAX is installed, and an ordinary ParticleFilter
+# with the same model functions otherwise. It also falls back to ParticleFilter (with a
+# warning) when given options only ParticleFilter has, or when the model functions fail to
+# trace: the update is traced once, on a stand-in observation shaped like a hypothesis, when
+# the filter is created, rather than failing in its first update.
+
+try:
+    import jax
+    import jax.numpy as jnp
+except ImportError:
+    jax = jnp = None
+
+HAVE_JAX = jax is not None
+
+
+def _jax_log_squared_error(x, y, sigma=1):
+    return -jnp.sum((x - y) ** 2, axis=-1) / (2.0 * sigma ** 2)
+
+
+def _jax_squared_error(x, y, sigma=1):
+    return jnp.exp(_jax_log_squared_error(x, y, sigma))
+
+
+# built-in functions that cannot be traced, and their JAX equivalents
+_TRACEABLE = {
+    squared_error: _jax_squared_error,
+    log_squared_error: _jax_log_squared_error,
+}
+
+
+def _traceable(fn):
+    """The JAX equivalent of a built-in kernel (or a partial of one), or fn unchanged."""
+    if isinstance(fn, functools.partial):
+        inner = _traceable(fn.func)
+        if inner is fn.func:
+            return fn
+        return functools.partial(inner, *fn.args, **fn.keywords)
+    for builtin, equivalent in _TRACEABLE.items():
+        if fn is builtin:
+            return equivalent
+    return fn
+
+
+def _shape(size, *params):
+    if size is None:
+        return jnp.broadcast_shapes(*(jnp.shape(p) for p in params)) if params else ()
+    return tuple(np.atleast_1d(size))
+
+
+class KeyGenerator(object):
+    """A JAX PRNG key, presented with the np.random.Generator methods the model functions
+    commonly use. Each draw consumes a fresh subkey, so repeated draws are independent.
+    out= arguments are not supported (JAX arrays are immutable)."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def _next(self):
+        self.key, key = jax.random.split(self.key)
+        return key
+
+    def random(self, size=None):
+        return jax.random.uniform(self._next(), _shape(size))
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        shape = _shape(size, low, high)
+        return low + (high - low) * jax.random.uniform(self._next(), shape)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        shape = _shape(size, loc, scale)
+        return loc + scale * jax.random.normal(self._next(), shape)
+
+    def standard_normal(self, size=None):
+        return jax.random.normal(self._next(), _shape(size))
+
+    def standard_t(self, df, size=None):
+        return jax.random.t(self._next(), df, _shape(size, df))
+
+    def standard_cauchy(self, size=None):
+        return jax.random.cauchy(self._next(), _shape(size))
+
+    def gamma(self, shape, scale=1.0, size=None):
+        return scale * jax.random.gamma(self._next(), shape, _shape(size, shape, scale))
+
+    def exponential(self, scale=1.0, size=None):
+        return scale * jax.random.exponential(self._next(), _shape(size, scale))
+
+
+def _call(fn, *args, rng=None, kwargs=None):
+    """Call a model function with the update's kwargs, passing `rng` and `xp` to it if it
+    takes them."""
+    kwargs = dict(kwargs or {})
+    if rng is not None and _accepts_rng(fn):
+        kwargs["rng"] = rng
+    if _accepts_keyword(fn, "xp"):
+        kwargs["xp"] = jnp
+    return fn(*args, **kwargs)
+
+
+class JaxParticleFilter(object):
+    """A particle filter whose update is compiled, as a whole, with JAX.
+
+    Takes the same model functions as ParticleFilter (see the notes at the top of this module
+    on writing them so that they can be traced), and updates in the same way: the weights
+    are kept in the log domain, particles are resampled with `resample` when n_eff drops
+    below n_eff_threshold, and a resample_proportion of them are replaced by prior samples.
+
+    Attributes:
+    -----------
+    particles, original_particles : array (N,D)
+        the particles after, and before, resampling and replenishment
+    weights, log_weights : array (N,)
+        normalised (log-)weights of `particles`
+    original_weights : array (N,)
+        normalised weights of `original_particles`
+    hypotheses : array (N,...)
+        the hypotheses of `original_particles`
+    mean_state, cov_state, map_state, mean_hypothesis, map_hypothesis, n_eff, weight_entropy :
+        as for ParticleFilter, computed as part of every update
+    transformed_particles : array
+        the result of transform_fn, or original_particles
+    The arrays are JAX arrays; np.asarray converts them.
+    """
+
+    def __init__(
+        self,
+        prior_fn,
+        observe_fn=None,
+        n_particles=200,
+        dynamics_fn=None,
+        noise_fn=None,
+        weight_fn=None,
+        resample_proportion=None,
+        column_names=None,
+        internal_weight_fn=None,
+        transform_fn=None,
+        n_eff_threshold=1.0,
+        log_weight_fn=None,
+        rng=None,
+    ):
+        """
+        Parameters:
+        -----------
+        As for ParticleFilter, with the model functions traced by JAX. rng is a seed (or a
+        np.random.Generator to draw one from) for the filter's PRNG key.
+        """
+        if not HAVE_JAX:
+            raise ImportError(
+                "JaxParticleFilter needs jax; use jit_filter to fall back to ParticleFilter"
+            )
+        self.prior_fn = prior_fn
+        self.observe_fn = observe_fn or identity
+        self.n_particles = n_particles
+        self.dynamics_fn = dynamics_fn or identity
+        self.noise_fn = noise_fn or identity
+        self.log_weight_fn = None if log_weight_fn is None else _traceable(log_weight_fn)
+        self.weight_fn = _traceable(weight_fn or squared_error)
+        self.resample_proportion = resample_proportion or 0.0
+        self.column_names = column_names
+        self.internal_weight_fn = internal_weight_fn
+        self.transform_fn = transform_fn
+        self.n_eff_threshold = n_eff_threshold
+        self.key = jax.random.PRNGKey(int(make_rng(rng).integers(2 ** 31)))
+        self._compiled_step = jax.jit(self._step)
+        self.init_filter()
+
+    def init_filter(self):
+        """Initialise the filter by drawing all the particles from the prior."""
+        self.key, key = jax.random.split(self.key)
+        self.particles = jnp.asarray(
+            _call(self.prior_fn, self.n_particles, rng=KeyGenerator(key))
+        )
+        self.d = self.particles.shape[1]
+        self.log_weights = jnp.full(self.n_particles, -np.log(self.n_particles))
+        self.weights = jnp.exp(self.log_weights)
+        self.original_particles = self.transformed_particles = self.particles
+        self.original_weights = self.weights
+
+    def _log_likelihood(self, hypotheses, observed, kwargs):
+        flat = hypotheses.reshape(hypotheses.shape[0], -1)
+        observed = jnp.reshape(observed, (1, -1))
+        if self.log_weight_fn is not None:
+            log_likelihood = _call(self.log_weight_fn, flat, observed, kwargs=kwargs)
+        else:
+            likelihood = _call(self.weight_fn, flat, observed, kwargs=kwargs)
+            log_likelihood = jnp.log(jnp.clip(likelihood, 0, jnp.inf))
+        # undefined similarities count as impossible
+        return jnp.where(jnp.isnan(log_likelihood), -jnp.inf, log_likelihood)
+
+    def _step(self, particles, log_weights, key, observed=None, kwargs=None):
+        """One whole update, traced and compiled by jax.jit. Returns the new
+        (particles, log_weights, key) and the summaries of the update."""
+        n = self.n_particles
+        key, dynamics_key, noise_key, resample_key, mask_key, prior_key = jax.random.split(
+            key, 6
+        )
+        particles = _call(
+            self.dynamics_fn, particles, rng=KeyGenerator(dynamics_key), kwargs=kwargs
+        )
+        particles = _call(self.noise_fn, particles, rng=KeyGenerator(noise_key), kwargs=kwargs)
+
+        if self.internal_weight_fn is not None:
+            internal_weights = jnp.clip(
+                _call(self.internal_weight_fn, particles, observed, kwargs=kwargs), 0, jnp.inf
+            )
+            log_weights = log_weights + jnp.log(internal_weights)
+        hypotheses = _call(self.observe_fn, particles, kwargs=kwargs)
+        if observed is not None:
+            log_weights = log_weights + self._log_likelihood(hypotheses, observed, kwargs)
+
+        # normalise with log-sum-exp, falling back to uniform weights if every particle
+        # has zero probability
+        shift = jnp.max(log_weights)
+        shift = jnp.where(jnp.isfinite(shift), shift, 0.0)
+        log_normalisation = shift + jnp.log(jnp.sum(jnp.exp(log_weights - shift)))
+        dead = ~jnp.isfinite(log_normalisation)
+        log_weights = jnp.where(dead, -np.log(n), log_weights - log_normalisation)
+        log_normalisation = jnp.where(dead, np.log(n), log_normalisation)
+        weights = jnp.exp(log_weights)
+        sum_sq = jnp.sum(weights ** 2)
+
+        # posterior summaries
+        mean_state = weights @ particles
+        deviation = particles - mean_state
+        map_index = jnp.argmax(weights)
+        flat = hypotheses.reshape(n, -1)
+        summaries = {
+            "original_particles": particles,
+            "original_weights": weights,
+            "hypotheses": hypotheses,
+            "n_eff": (1.0 / sum_sq) / n,
+            "weight_normalisation": jnp.exp(log_normalisation),
+            "mean_state": mean_state,
+            # unbiased weighted covariance, matching np.cov(..., aweights=weights)
+            "cov_state": (weights[:, None] * deviation).T @ deviation / (1.0 - sum_sq),
+            "map_state": particles[map_index],
+            "mean_hypothesis": (weights @ flat).reshape(hypotheses.shape[1:]),
+            "map_hypothesis": hypotheses[map_index],
+            "weight_entropy": jnp.sum(jnp.where(weights > 0, weights * log_weights, 0.0)),
+            "transformed_particles": particles
+            if self.transform_fn is None
+            else _call(self.transform_fn, particles, weights, kwargs=kwargs),
+        }
+
+        # resample (as `resample`) when the effective sample size has dropped
+        positions = (jax.random.uniform(resample_key) + jnp.arange(n)) / n
+        cumsum = jnp.concatenate([jnp.cumsum(weights)[:-1], jnp.ones(1)])
+        indices = jnp.minimum(jnp.searchsorted(cumsum, positions, side="left"), n - 1)
+        resampled = summaries["n_eff"] < self.n_eff_threshold
+        particles = jnp.where(resampled, particles[indices], particles)
+        log_weights = jnp.where(resampled, -np.log(n), log_weights)
+
+        # randomly replace some particles with samples from the prior
+        if self.resample_proportion > 0:
+            mask = jax.random.uniform(mask_key, (n,)) < self.resample_proportion
+            prior = _call(self.prior_fn, n, rng=KeyGenerator(prior_key))
+            particles = jnp.where(mask[:, None], prior, particles)
+            summaries["resampled_particles"] = mask
+        return (particles, log_weights, key), summaries
+
+    def update(self, observed=None, **kwargs):
+        """Update the state of the particle filter given an observation (or, if observed is
+        None, one step in prediction-only mode), as ParticleFilter.update.
+
+        kwargs are passed on to the model functions as for ParticleFilter.update. They are
+        arguments of the compiled update, so they must be arrays or numbers; the update is
+        compiled again for each new set of keyword names (or shapes)."""
+        if observed is not None:
+            observed = jnp.asarray(observed)
+        (self.particles, self.log_weights, self.key), summaries = self._compiled_step(
+            self.particles, self.log_weights, self.key, observed, kwargs
+        )
+        self.weights = jnp.exp(self.log_weights)
+        for name, value in summaries.items():
+            setattr(self, name, value)
+
+    def check_traceable(self):
+        """Trace (without compiling or running) an update with and without an observation,
+        the observation being a stand-in shaped like one hypothesis. Raises the error of any
+        model function that JAX cannot trace."""
+        hypotheses = jax.eval_shape(
+            lambda particles: _call(self.observe_fn, particles), self.particles
+        )
+        observed = jax.ShapeDtypeStruct(hypotheses.shape[1:], hypotheses.dtype)
+        for stand_in in (None, observed):
+            jax.eval_shape(self._step, self.particles, self.log_weights, self.key, stand_in, {})
+
+
+# the options JaxParticleFilter accepts; ParticleFilter takes these and more
+_JAX_OPTIONS = set(inspect.signature(JaxParticleFilter.__init__).parameters) - {
+    "self",
+    "prior_fn",
+}
+
+
+def jit_filter(prior_fn, **kwargs):
+    """Create a JaxParticleFilter if JAX is installed, or else (with a warning) a
+    ParticleFilter with the same arguments. The model functions must then work with both
+    NumPy and JAX arrays (see the notes at the top of this module).
+
+    A ParticleFilter is also created, with a warning, if kwargs include options that only
+    ParticleFilter has (resample_fn, chunk_size, in_place, ...), or if creating the
+    JaxParticleFilter or tracing its update fails with a TypeError (which JAX's tracer
+    conversion errors are) or a ValueError, e.g. for a prior_fn made by
+    `independent_sample`. Errors that are not JAX's then recur in the ParticleFilter."""
+    if not HAVE_JAX:
+        reason = "jax is not installed"
+    elif set(kwargs) - _JAX_OPTIONS:
+        reason = "JaxParticleFilter does not support {}".format(
+            ", ".join(sorted(set(kwargs) - _JAX_OPTIONS))
+        )
+    else:
+        try:
+            pf = JaxParticleFilter(prior_fn, **kwargs)
+            pf.check_traceable()
+            return pf
+        except (TypeError, ValueError) as error:
+            reason = "the model functions cannot be traced by jax ({}: {})".format(
+                type(error).__name__, error
+            )
+    warnings.warn("{}; using the NumPy ParticleFilter".format(reason), RuntimeWarning)
+    return ParticleFilter(prior_fn, **kwargs)
@@ -0,0 +1,305 @@
+import numpy as np
+
+# Similarity kernels for weight_fn / log_weight_fn that compute distances with matrix
+# products instead of an (N,P) array of differences. The squared distance between a
+# hypothesis x and an observation y is expanded as
+#
+#   ||x - y||^2 = ||x||^2 - 2 x.y + ||y||^2
+#
+# so scoring N hypotheses is one pass to get the norms ||x||^2 (np.einsum, without a
+# temporary), one matrix-vector product (BLAS) and an O(N) combination, rather than
+# subtracting, squaring and summing all N*P values. The norms of the observation are computed
+# once per call, however many hypotheses are scored. Several observations (M,P) can be scored
+# against the same hypotheses at once, as one matrix-matrix product giving an (N,M) result.
+#
+# The Poisson and Bernoulli pixel likelihoods are linear in the observation once the
+# hypotheses are in log form, so they are matrix products too. Masked observations (missing
+# pixels) are handled by giving the masked pixels zero weight in the same products; only
+# masked *hypotheses* fall back to numpy.ma. The expansion loses some precision when x and y
+# are very close relative to their norms; distances are clamped at zero.
+#
+# All the kernels take hypotheses x of shape (N,P) and an observation y of shape (P,) or
+# (1,P), returning an N-vector, as the filter calls them; or observations (M,P), returning
+# (N,M); or, in a ParticleFilterBank, (K,N,P) and (K,1,P), returning (K,N).
+
+
+def _observation(y):
+    """The observation as a (...,M,P) array and its (...,M,P) validity weights (or None if
+    nothing is masked)."""
+    valid = None
+    if np.ma.isMaskedArray(y):
+        valid = ~np.ma.getmaskarray(y)
+        y = np.ma.getdata(y)
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y[None, :]
+        valid = None if valid is None else valid[None, :]
+    return y, valid
+
+
+def _result(scores, y, out):
+    """Drop the observation axis of (...,N,M) scores for a single observation, and copy
+    them into out if given."""
+    if y.shape[-2] == 1:
+        scores = scores[..., 0]
+    if out is None:
+        return scores
+    out[...] = scores
+    return out
+
+
+def _transpose(y):
+    return np.swapaxes(y, -1, -2)
+
+
+def squared_distances(x, y, precision=None):
+    """Weighted squared distances sum(precision * (x - y) ** 2) between every hypothesis
+    and every observation.
+    Parameters:
+    -----------
+        x : array (...,N,P)
+            hypotheses
+        y : array (...,M,P) or (P,)
+            observations; masked pixels are left out of the sum
+        precision : float or array (P,), optional
+            weight of each pixel (the inverse of its variance); 1 if None
+    Returns:
+    -------
+        distances : array (...,N,M)
+    """
+    y, valid = _observation(y)
+    if np.ma.isMaskedArray(x):
+        # masked hypotheses: the direct (N,M,P) computation
+        diff = x[..., :, None, :] - y[..., None, :, :]
+        weights = 1.0 if precision is None else precision
+        if valid is not None:
+            weights = weights * valid[..., None, :, :]
+        return np.ma.filled(np.ma.sum(weights * diff * diff, axis=-1), 0.0)
+    x = np.asarray(x)
+    if valid is None and precision is None:
+        x_norms = np.einsum("...p,...p->...", x, x)[..., :, None]
+        y_norms = np.einsum("...p,...p->...", y, y)[..., None, :]
+        cross = np.matmul(x, _transpose(y))
+    else:
+        weights = np.broadcast_to(1.0 if precision is None else precision, y.shape)
+        if valid is not None:
+            weights = np.where(valid, weights, 0.0)
+        x_norms = np.matmul(x * x, _transpose(weights))
+        y_norms = np.sum(weights * y * y, axis=-1)[..., None, :]
+        cross = np.matmul(x, _transpose(weights * y))
+    distances = x_norms - 2.0 * cross
+    distances += y_norms
+    return np.maximum(distances, 0.0, out=distances)
+
+
+def rbf(x, y, sigma=1, out=None):
+    """RBF kernel e^(-||x - y||^2 / (2 sigma^2)), as `squared_error`, for use as weight_fn."""
+    distances = squared_distances(x, y)
+    scores = np.exp(distances * (-1.0 / (2.0 * sigma ** 2)))
+    return _result(scores, _observation(y)[0], out)
+
+
+def log_rbf(x, y, sigma=1, out=None):
+    """Log of the RBF kernel, -||x - y||^2 / (2 sigma^2), as `log_squared_error`, for use
+    as log_weight_fn."""
+    distances = squared_distances(x, y)
+    return _result(distances * (-1.0 / (2.0 * sigma ** 2)), _observation(y)[0], out)
+
+
+def log_mahalanobis(x, y, variances=1.0, out=None):
+    """Gaussian log-likelihood with diagonal covariance, -0.5 * sum((x - y) ** 2 / variances)
+    (without the normalising constant, which is the same for every hypothesis).
+    Parameters:
+    -----------
+        variances : float or array (P,)
+            variance of each observed value"""
+    distances = squared_distances(x, y, precision=1.0 / np.asarray(variances, dtype=float))
+    return _result(-0.5 * distances, _observation(y)[0], out)
+
+
+def make_log_mahalanobis(cov):
+    """Gaussian log-likelihood with a full (P,P) covariance, -0.5 (x - y)^T cov^-1 (x - y).
+    The covariance is factorised once, as cov^-1 = L L^T, and the returned function
+    log_weight(x, y, out=None) scores ||x L - y L||^2 with the same matrix products as
+    `squared_distances`. Masked observations are not supported."""
+    factor = np.linalg.cholesky(np.linalg.inv(np.asarray(cov, dtype=float)))
+
+    def log_weight(x, y, out=None):
+        y, valid = _observation(y)
+        if valid is not None:
+            raise ValueError("masked observations need a diagonal covariance")
+        distances = squared_distances(np.matmul(x, factor), np.matmul(y, factor))
+        return _result(-0.5 * distances, y, out)
+
+    return log_weight
+
+
+def _pixel_weights(y, valid):
+    """The observation with its masked pixels zeroed, and the (...,M,P) validity weights."""
+    if valid is None:
+        return y, None
+    return np.where(valid, y, 0), valid.astype(float)
+
+
+def log_poisson(x, y, floor=1e-12, out=None):
+    """Poisson log-likelihood of observed counts y given expected counts (rates) x,
+    sum(y log x - x), without the log(y!) term, which is the same for every hypothesis.
+    Parameters:
+    -----------
+        floor : float
+            rates are clamped to at least this, so that a zero rate is unlikely rather than
+            impossible"""
+    y, valid = _observation(y)
+    rates = np.maximum(x, floor)
+    counts, weights = _pixel_weights(y, valid)
+    scores = np.matmul(np.log(rates), _transpose(counts))
+    if weights is None:
+        scores -= np.sum(rates, axis=-1)[..., :, None]
+    else:
+        scores -= np.matmul(rates, _transpose(weights))
+    return _result(scores, y, out)
+
+
+def log_bernoulli(x, y, eps=1e-6, out=None):
+    """Bernoulli log-likelihood of binary pixels y given pixel probabilities x,
+    sum(y log x + (1 - y) log(1 - x)) = sum(y logit(x)) + sum(log(1 - x)).
+    Parameters:
+    -----------
+        eps : float
+            probabilities are clipped to [eps, 1 - eps]"""
+    y, valid = _observation(y)
+    p = np.clip(x, eps, 1.0 - eps)
+    log_not = np.log1p(-p)
+    logit = np.log(p)
+    logit -= log_not
+    hits, weights = _pixel_weights(y, valid)
+    scores = np.matmul(logit, _transpose(hits))
+    if weights is None:
+        scores += np.sum(log_not, axis=-1)[..., :, None]
+    else:
+        scores += np.matmul(log_not, _transpose(weights))
+    return _result(scores, y, out)
+
+
+def _columns(pixels, block):
+    """The columns of a block of (valid) pixels: a slice, or the indices of the valid ones."""
+    if isinstance(pixels, slice):
+        return block
+    return pixels[block]
+
+
+def _gather(x, rows, columns):
+    """x[rows, columns] for rows (all if None) and a slice or array of columns, copying only
+    those values."""
+    if rows is None:
+        return x[:, columns]
+    if isinstance(columns, slice):
+        return x[rows, columns]
+    return x[np.ix_(rows, columns)]
+
+
+def _block_order(n_blocks):
+    """An order to visit n_blocks consecutive blocks in that spreads the first few out over
+    the whole range: every stride-th block, for a stride of about sqrt(n_blocks), then the
+    ones after those, and so on."""
+    stride = max(1, int(np.ceil(np.sqrt(n_blocks))))
+    return [k for offset in range(stride) for k in range(offset, n_blocks, stride)]
+
+
+class BoundedSquaredError(object):
+    """The RBF kernel of `squared_error` (or, with log_domain, `log_squared_error`), summing
+    the squared differences a block of pixels at a time and stopping early for particles that
+    are bound to have negligible weight.
+
+    After the first block, the complete distances of the n_seeds particles closest so far are
+    computed, which bounds the distance of the best particle from above. After each later
+    block, the complete distance of the particle closest so far is computed too, if it is not
+    one of those already known, and the bound is the smallest of them (so at most one extra
+    hypothesis is compared in full per block). A particle whose
+    partial distance exceeds that bound by margin nats (2 sigma^2 margin in squared distance)
+    has a likelihood below e^-margin times the best one's, however the rest of its pixels turn
+    out, and is dropped from the remaining blocks, with a likelihood of zero (-inf in the log
+    domain). The blocks are contiguous runs of pixels (e.g. a few rows of an image), visited in
+    an order that spreads the first few over the whole image, so that far away particles are
+    dropped early. The likelihoods of the particles that are not dropped are exact.
+
+    Parameters:
+    -----------
+        sigma : float
+            width of the kernel, as for squared_error
+        margin : float
+            log-likelihood below the best particle's beyond which a particle is dropped
+        block_size : int
+            number of pixels summed at a time
+        log_domain : bool
+            if True, returns log-likelihoods, for use as log_weight_fn
+        n_seeds : int
+            number of particles whose complete distances bound the best one
+
+    Attributes:
+    -----------
+        n_pruned : int
+            number of particles dropped before their last block in the most recent call
+
+    Hypotheses x are (N,P) and the observation y is (P,) or (1,P); masked pixels of y are
+    left out of the sum, and the blocks are runs of its valid pixels, which are gathered from
+    the hypotheses of the particles still active one block at a time.
+    """
+
+    def __init__(self, sigma=1, margin=40.0, block_size=1024, log_domain=True, n_seeds=4):
+        self.sigma = sigma
+        self.margin = margin
+        self.block_size = block_size
+        self.log_domain = log_domain
+        self.n_seeds = n_seeds
+        self.n_pruned = 0
+
+    def distances(self, x, y):
+        """Squared distances of the hypotheses from the observation, and the boolean mask of
+        the particles that were dropped (whose distances are only partial sums)."""
+        y, valid = _observation(y)
+        y = y[0]
+        x = np.asarray(x)
+        # the valid pixels are gathered from x a block at a time, as the blocks are visited
+        pixels = slice(None) if valid is None else np.flatnonzero(valid[0])
+        y = y[pixels]
+        n, p = len(x), len(y)
+        n_blocks = max(1, -(-p // self.block_size))
+        slack = 2.0 * self.sigma ** 2 * self.margin
+        distances = np.zeros(n)
+        active = np.arange(n)
+        bound = np.inf
+        known = np.zeros(n, dtype=bool)
+        for i, k in enumerate(_block_order(n_blocks) if n > 0 else []):
+            block = slice(k * self.block_size, (k + 1) * self.block_size)
+            rows = None if len(active) == n else active
+            diff = _gather(x, rows, _columns(pixels, block)) - y[block]
+            distances[active] += np.einsum("ij,ij->i", diff, diff, dtype=np.float64)
+            if i == n_blocks - 1:
+                break
+            # tighten the bound with the complete distances of the seeds, and then of the
+            # particle closest so far whenever that is a new one
+            if i == 0:
+                closest = active[np.argsort(distances[active])[: self.n_seeds]]
+            else:
+                closest = active[[np.argmin(distances[active])]]
+            closest = closest[~known[closest]]
+            if len(closest):
+                known[closest] = True
+                diff = _gather(x, closest, pixels) - y
+                bound = min(bound, np.min(np.einsum("ij,ij->i", diff, diff, dtype=np.float64)))
+            active = active[distances[active] <= bound + slack]
+        dropped = np.ones(n, dtype=bool)
+        dropped[active] = False
+        return distances, dropped
+
+    def __call__(self, x, y, out=None):
+        distances, dropped = self.distances(x, y)
+        self.n_pruned = int(np.count_nonzero(dropped))
+        scores = np.multiply(distances, -1.0 / (2.0 * self.sigma ** 2), out=out)
+        if self.log_domain:
+            scores[dropped] = -np.inf
+            return scores
+        np.exp(scores, out=scores)
+        scores[dropped] = 0.0
+        return scores
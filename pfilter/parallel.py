@@ -0,0 +1,222 @@
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from .pfilter import _WeightedHypothesisSum, _clean_likelihood, _log_posterior
+
+# Parallel evaluation of the observation model. observe_fn is often an expensive Python-level
+# renderer (a loop over particles, or an image drawn per particle), so vectorising it is not
+# always possible; instead the particles are split into contiguous shards and each shard is
+# observed and weighted on a worker process. The particles and the observation are written
+# once per update to shared memory blocks that the workers map directly, so nothing
+# proportional to N*D is pickled, and only the N likelihoods (plus, optionally, the partial
+# sums for the weighted mean hypothesis) are sent back. The worker pool is kept alive
+# between updates, so the model functions are only sent to the workers once.
+
+
+class _SharedArray(object):
+    """A named shared memory block holding one array, regrown when a larger array is stored."""
+
+    def __init__(self, role):
+        self.role = role
+        self.block = None
+
+    def store(self, array):
+        """Copy array into the block, and return the descriptor the workers attach with."""
+        array = np.ascontiguousarray(array)
+        if self.block is None or self.block.size < array.nbytes:
+            self.close()
+            self.block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=self.block.buf)[...] = array
+        return (self.role, self.block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+# state of each worker process, set once by the pool initializer
+_worker = {}
+
+
+def _init_worker(observe_fn, likelihood_fn, log_domain):
+    _worker.update(
+        observe_fn=observe_fn,
+        likelihood_fn=likelihood_fn,
+        log_domain=log_domain,
+        blocks={},
+    )
+
+
+def _open_shared_memory(name):
+    try:
+        # the parent owns (and unlinks) the block, so the worker must not track it
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+def _attach(descriptor):
+    """View a shared array in this worker, mapping its block only when it has changed."""
+    if descriptor is None:
+        return None
+    role, name, shape, dtype = descriptor
+    blocks = _worker["blocks"]
+    block = blocks.get(role)
+    if block is None or block.name != name:
+        if block is not None:
+            block.close()
+        block = blocks[role] = _open_shared_memory(name)
+    return np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def _observe_shard(task):
+    """Observe and weight particles[start:stop]; runs on a worker process."""
+    start, stop, particles, observed, indices, log_prior, kwargs, observe_kwargs = task
+    particles = _attach(particles)
+    observed = _attach(observed)
+    indices = _attach(indices)
+    hypotheses = _worker["observe_fn"](particles[start:stop], **observe_kwargs)
+    likelihood = None
+    if observed is not None:
+        compared = hypotheses.reshape(stop - start, -1)
+        if indices is not None:
+            compared = compared[:, indices]
+        likelihood = np.array(
+            _worker["likelihood_fn"](compared, observed.reshape(1, -1), **kwargs),
+            dtype=float if _worker["log_domain"] else None,
+        )
+        likelihood = _clean_likelihood(likelihood, _worker["log_domain"])
+    hypothesis_sum = None
+    if log_prior is not None:
+        hypothesis_sum = _WeightedHypothesisSum(_worker["log_domain"])
+        hypothesis_sum.add(
+            _log_posterior(log_prior, likelihood, _worker["log_domain"]), hypotheses
+        )
+    return start, stop, likelihood, hypothesis_sum
+
+
+def _shutdown(executor, shared):
+    executor.shutdown(wait=True)
+    for array in shared.values():
+        array.close()
+
+
+class ProcessPoolObserver(object):
+    """Evaluates an observation model on a persistent pool of worker processes.
+
+    Parameters:
+    -----------
+        observe_fn : function(states, **kwargs) => observations
+            as for ParticleFilter
+        likelihood_fn : function(hypotheses, observed, **kwargs) => likelihoods
+            the weight_fn of the filter, or its log_weight_fn if log_domain is True
+        log_domain : bool
+            whether likelihood_fn returns log-likelihoods
+        n_workers : int, optional
+            number of worker processes (default: the number of CPUs)
+        n_shards : int, optional
+            number of contiguous shards the particles are split into on each update
+            (default: n_workers). More shards than workers balances uneven per-particle costs.
+
+    observe_fn and likelihood_fn (and any keyword arguments passed to `likelihood`) must be
+    picklable, e.g. module-level functions rather than lambdas or closures.
+    The pool must be shut down with `close()`, or by using the observer as a context manager.
+    """
+
+    def __init__(
+        self, observe_fn, likelihood_fn, log_domain=False, n_workers=None, n_shards=None
+    ):
+        self.log_domain = log_domain
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.n_shards = n_shards or self.n_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            initializer=_init_worker,
+            initargs=(observe_fn, likelihood_fn, log_domain),
+        )
+        self._shared = {
+            "particles": _SharedArray("particles"),
+            "observed": _SharedArray("observed"),
+            "indices": _SharedArray("indices"),
+        }
+        self._finalizer = weakref.finalize(self, _shutdown, self._executor, self._shared)
+
+    def likelihood(
+        self, particles, observed, log_prior=None, kwargs=None, observe_kwargs=None, indices=None
+    ):
+        """Observe and weight all the particles on the worker processes.
+
+        Parameters:
+        -----------
+            particles : array (N,D)
+                the particle states
+            observed : array or None
+                the observation; if None, no likelihood is computed
+            log_prior : array (N,), optional
+                unnormalised log-weights of the particles before this observation. If given,
+                the workers also accumulate the posterior-weighted mean of the hypotheses.
+            kwargs : dict, optional
+                keyword arguments passed on to observe_fn and likelihood_fn
+            observe_kwargs : dict, optional
+                keyword arguments for observe_fn, if they differ from kwargs (e.g. the `indices`
+                of a sparse observation)
+            indices : int array (K,), optional
+                flat indices of the observed values in a sparse observation: the hypotheses are
+                gathered at them before likelihood_fn compares them to observed
+        Returns:
+        -------
+            likelihood : array (N,) or None
+                the likelihood (or log-likelihood) of each particle
+            hypothesis_sum : _WeightedHypothesisSum or None
+                the merged partial sums for the mean hypothesis, if log_prior was given
+        """
+        if not self._finalizer.alive:
+            raise ValueError("ProcessPoolObserver has been closed")
+        kwargs = {} if kwargs is None else kwargs
+        observe_kwargs = kwargs if observe_kwargs is None else observe_kwargs
+        n = len(particles)
+        particles = self._shared["particles"].store(particles)
+        if observed is not None:
+            observed = self._shared["observed"].store(observed)
+        if indices is not None:
+            indices = self._shared["indices"].store(indices)
+
+        bounds = np.linspace(0, n, min(self.n_shards, n) + 1).astype(int)
+        tasks = [
+            (
+                start,
+                stop,
+                particles,
+                observed,
+                indices,
+                None if log_prior is None else log_prior[start:stop],
+                kwargs,
+                observe_kwargs,
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+        likelihood = None if observed is None else np.empty(n)
+        hypothesis_sum = None if log_prior is None else _WeightedHypothesisSum(self.log_domain)
+        for start, stop, shard_likelihood, shard_sum in self._executor.map(
+            _observe_shard, tasks
+        ):
+            if likelihood is not None:
+                likelihood[start:stop] = shard_likelihood
+            if hypothesis_sum is not None:
+                hypothesis_sum.merge(shard_sum)
+        return likelihood, hypothesis_sum
+
+    def close(self):
+        """Shut down the worker processes and release the shared memory."""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
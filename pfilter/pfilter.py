@@ -1,5 +1,22 @@
+import contextlib
 import numpy as np
 import numpy.ma as ma
+from .resampling import (
+    create_indices,
+    kld_bound,
+    kld_sample_size,
+    multinomial_resample,
+    resample,
+    residual_resample,
+    state_bins,
+    stratified_resample,
+    systematic_resample,
+)
+from .pool import PriorPool
+from .profiling import StageProfiler
+from .pyramid import downsample, image_pyramid, pyramid_scales
+from .rng import _accepts_keyword, _accepts_rng, _rng_kwargs, make_rng, spawn_rngs
+from .sparse import SparseObservation, _split_observation
 print ('hello')
 
 # return a new function that has the heat kernel (given by delta) applied.
@@ -10,85 +27,82 @@ def make_heat_adjusted(sigma):
     return heat_distance
 
 
-## Resampling based on the examples at: https://github.com/rlabbe/Kalman-and-Bayesian-Filters-in-Python/blob/master/12-Particle-Filters.ipynb
-## originally by Roger Labbe, under an MIT License
-def systematic_resample(weights):
-    n = len(weights)
-    positions = (np.arange(n) + np.random.uniform(0, 1)) / n
-    return create_indices(positions, weights)
-
-
-def stratified_resample(weights):
-    n = len(weights)
-    positions = (np.random.uniform(0, 1, n) + np.arange(n)) / n
-    return create_indices(positions, weights)
-
-
-def residual_resample(weights):
-    n = len(weights)
-    indices = np.zeros(n, np.uint32)
-    # take int(N*w) copies of each weight
-    num_copies = (n * weights).astype(np.uint32)
-    k = 0
-    for i in range(n):
-        for _ in range(num_copies[i]):  # make n copies
-            indices[k] = i
-            k += 1
-    # use multinormial resample on the residual to fill up the rest.
-    residual = weights - num_copies  # get fractional part
-    residual /= np.sum(residual)
-    cumsum = np.cumsum(residual)
-    cumsum[-1] = 1
-    indices[k:n] = np.searchsorted(cumsum, np.random.uniform(0, 1, n - k))
-    return indices
-
-
-def create_indices(positions, weights):
-    n = len(weights)
-    indices = np.zeros(n, np.uint32)
-    cumsum = np.cumsum(weights)
-    i, j = 0, 0
-    while i < n:
-        if positions[i] < cumsum[j]:
-            indices[i] = j
-            i += 1
-        else:
-            j += 1
+# log-domain version of make_heat_adjusted, for use with log_weight_fn
+def make_log_heat_adjusted(sigma):
+    def log_heat_distance(d):
+        return -d ** 2 / (2.0 * sigma ** 2)
 
-    return indices
+    return log_heat_distance
 
 
-### end rlabbe's resampling functions
+def logsumexp(x, axis=None):
+    """Numerically stable log(sum(exp(x))) along the given axis.
+    Entries of -inf (zero probability) are allowed; if every entry is -inf the
+    result is -inf.
+    """
+    x = np.asarray(x)
+    x_max = np.max(x, axis=axis, keepdims=True)
+    x_max = np.where(np.isfinite(x_max), x_max, 0.0)
+    with np.errstate(divide="ignore"):
+        out = np.log(np.sum(np.exp(x - x_max), axis=axis, keepdims=True)) + x_max
+    if axis is None:
+        return out.reshape(())[()]
+    return np.squeeze(out, axis=axis)
 
 
-def multinomial_resample(weights):
-    return np.random.choice(np.arange(len(weights)), p=weights, size=len(weights))
+# identity function for clearer naming
+identity = lambda x: x
 
 
-# resample function from http://scipy-cookbook.readthedocs.io/items/ParticleFilter.html
-def resample(weights):
-    n = len(weights)
-    indices = []
-    C = [0.0] + [np.sum(weights[: i + 1]) for i in range(n)]
-    u0, j = np.random.random(), 0
-    for u in [(u0 + i) / n for i in range(n)]:
-        while u > C[j]:
-            j += 1
-        indices.append(j - 1)
-    return indices
+def _sum_last(values):
+    """Sum over the last axis, going through numpy.ma only when some values are masked
+    (np.ma.sum is several times slower than np.sum, even on a plain array)."""
+    if isinstance(values, ma.MaskedArray):
+        return ma.sum(values, axis=-1)
+    return np.sum(values, axis=-1)
 
 
-# identity function for clearer naming
-identity = lambda x: x
+# number of values of x - y held at once when a kernel writes into `out`, so that its
+# scratch space is bounded rather than proportional to N*P
+_BLOCK_ELEMENTS = 1 << 16
 
 
-def squared_error(x, y, sigma=1):
+def _sum_squared_differences(x, y, out):
+    """Write sum((x - y) ** 2, axis=-1) into out, a few rows of x at a time through a
+    bounded scratch block, instead of computing x - y as one (N,P) temporary. Returns out, or
+    None (leaving out alone) for masked inputs, or a y that is not a single observation,
+    which are left to the direct computation."""
+    if isinstance(x, ma.MaskedArray) or isinstance(y, ma.MaskedArray):
+        return None
+    x, y = np.asarray(x), np.asarray(y)
+    p = x.shape[-1] if x.ndim > 0 else 0
+    if p == 0 or y.size != p or out.size * p != x.size:
+        return None
+    rows = x.reshape(-1, p)
+    sums = out.reshape(-1)
+    y = y.reshape(p)
+    block = max(1, _BLOCK_ELEMENTS // p)
+    scratch = np.empty((min(block, len(rows)), p), np.result_type(x.dtype, y.dtype))
+    for start in range(0, len(rows), block):
+        stop = min(start + block, len(rows))
+        diff = np.subtract(rows[start:stop], y, out=scratch[: stop - start])
+        np.einsum("ij,ij->i", diff, diff, out=sums[start:stop])
+    return out
+
+
+def squared_error(x, y, sigma=1, out=None):
     """
         RBF kernel, supporting masked values in the observation
         Parameters:
         -----------
         x : array (N,D) array of values
         y : array (N,D) array of values
+            Any leading dimensions broadcast; the sum is over the last axis.
+        sigma : float
+            width of the kernel
+        out : array, optional
+            N-element array to write the similarities into. The differences are then
+            computed a block of rows at a time, without an (N,P) temporary.
 
         Returns:
         -------
@@ -100,12 +114,53 @@ def squared_error(x, y, sigma=1):
 
             summed over all samples. Supports masked arrays.
     """
-    dx = (x - y) ** 2
-    d = np.ma.sum(dx, axis=1)
-    return np.exp(-d / (2.0 * sigma ** 2))
+    if out is not None and _sum_squared_differences(x, y, out) is not None:
+        np.multiply(out, -1.0 / (2.0 * sigma ** 2), out=out)
+        return np.exp(out, out=out)
+    dx = x - y
+    dx *= dx
+    # summed in the precision of the inputs, exponentiated in double precision
+    d = _sum_last(dx).astype(np.float64)
+    if out is None:
+        return np.exp(-d / (2.0 * sigma ** 2))
+    # rows with every value masked have zero similarity
+    np.multiply(np.ma.filled(d, np.inf), -1.0 / (2.0 * sigma ** 2), out=out)
+    return np.exp(out, out=out)
+
+
+def log_squared_error(x, y, sigma=1, out=None):
+    """
+        Log of the RBF kernel computed by `squared_error`, for use as a `log_weight_fn`.
+        Working in the log domain avoids the underflow to zero that `squared_error`
+        suffers when summing over many dimensions (e.g. all the pixels of an image).
+        Parameters:
+        -----------
+        x : array (N,D) array of values
+        y : array (N,D) array of values
+            Any leading dimensions broadcast; the sum is over the last axis.
+        sigma : float
+            width of the kernel
+        out : array, optional
+            N-element array to write the log similarities into. The differences are then
+            computed a block of rows at a time, without an (N,P) temporary.
 
+        Returns:
+        -------
 
-def gaussian_noise(x, sigmas):
+        log_similarity : array
+            N-element vector of -sum((x - y) ** 2) / (2 * sigma ** 2). Supports masked arrays.
+    """
+    if out is not None and _sum_squared_differences(x, y, out) is not None:
+        return np.multiply(out, -1.0 / (2.0 * sigma ** 2), out=out)
+    dx = x - y
+    dx *= dx
+    d = _sum_last(dx).astype(np.float64)
+    if out is None:
+        return np.ma.filled(-d / (2.0 * sigma ** 2), -np.inf)
+    return np.multiply(np.ma.filled(d, np.inf), -1.0 / (2.0 * sigma ** 2), out=out)
+
+
+def gaussian_noise(x, sigmas, rng=None, out=None):
     """Apply diagonal covaraiance normally-distributed noise to the N,D array x.
     Parameters:
     -----------
@@ -113,12 +168,25 @@ def gaussian_noise(x, sigmas):
             (N,D) array of values
         sigmas : array
             D-element vector of std. dev. for each column of x
+        rng : np.random.Generator, optional
+            source of randomness; the global np.random state if None
+        out : array, optional
+            (N,D) array to write the result into, which must not overlap x. No temporary
+            arrays are allocated if rng is a Generator and out is float32 or float64.
+    The result has the dtype of x if x is single precision.
     """
-    n = np.random.normal(np.zeros(len(sigmas)), sigmas, size=(x.shape[0], len(sigmas)))
-    return x + n
+    rng = np.random if rng is None else rng
+    out = _noise_out(x, out)
+    if out is None:
+        n = rng.normal(np.zeros(len(sigmas)), sigmas, size=(x.shape[0], len(sigmas)))
+        return x + n
+    _standard_noise(rng, "standard_normal", out)
+    out *= sigmas
+    out += x
+    return out
 
 
-def t_noise(x, sigmas, df=1.0):
+def t_noise(x, sigmas, df=1.0, rng=None, out=None):
     """Apply diagonal covaraiance t-distributed noise to the N,D array x.
     Parameters:
     -----------
@@ -128,14 +196,23 @@ def t_noise(x, sigmas, df=1.0):
             D-element vector of std. dev. for each column of x
         df : degrees of freedom (shape of the t distribution)
             Must be a scalar
+        rng : np.random.Generator, optional
+            source of randomness; the global np.random state if None
+        out : array, optional
+            (N,D) array to write the result into, which must not overlap x
+    The result has the dtype of x if x is single precision.
     """
-    n = np.random.standard_t(df, size=(x.shape[0], len(sigmas))) * sigmas
-    return x + n
-
-
+    rng = np.random if rng is None else rng
+    out = _noise_out(x, out)
+    if out is None:
+        n = rng.standard_t(df, size=(x.shape[0], len(sigmas))) * sigmas
+        return x + n
+    np.multiply(rng.standard_t(df, size=out.shape), sigmas, out=out)
+    out += x
+    return out
 
 
-def cauchy_noise(x, sigmas):
+def cauchy_noise(x, sigmas, rng=None, out=None):
     """Apply diagonal covaraiance Cauchy-distributed noise to the N,D array x.
     Parameters:
     -----------
@@ -143,9 +220,66 @@ def cauchy_noise(x, sigmas):
             (N,D) array of values
         sigmas : array
             D-element vector of std. dev. for each column of x
+        rng : np.random.Generator, optional
+            source of randomness; the global np.random state if None
+        out : array, optional
+            (N,D) array to write the result into, which must not overlap x
+    The result has the dtype of x if x is single precision.
     """
-    n = np.random.standard_cauchy(size=(x.shape[0], len(sigmas))) * np.array(sigmas)
-    return x + n
+    rng = np.random if rng is None else rng
+    out = _noise_out(x, out)
+    if out is None:
+        n = rng.standard_cauchy(size=(x.shape[0], len(sigmas))) * np.array(sigmas)
+        return x + n
+    np.multiply(rng.standard_cauchy(size=out.shape), sigmas, out=out)
+    out += x
+    return out
+
+
+def _noise_out(x, out):
+    """The array to write noise added to x into: out if given, or a new array of x's dtype
+    if x is single precision, so that the result is not promoted to float64."""
+    if out is None and isinstance(x, np.ndarray) and x.dtype == np.float32:
+        return np.empty_like(x)
+    return out
+
+
+def _standard_noise(rng, method, out):
+    """Fill out with draws from rng.<method> (e.g. "standard_normal"), directly into out
+    when rng is a Generator that supports it."""
+    if isinstance(rng, np.random.Generator) and out.dtype in (np.float32, np.float64):
+        getattr(rng, method)(dtype=out.dtype, out=out)
+    else:
+        out[...] = getattr(rng, method)(size=out.shape)
+
+
+def linear_dynamics(x, transition, out=None):
+    """Apply linear dynamics x' = A x to each row of the N,D array x.
+    Parameters:
+    -----------
+        x : array
+            (N,D) array of values
+        transition : array
+            (D,D) transition matrix A
+        out : array, optional
+            (N,D) array to write the result into, which must not overlap x
+    The result has the dtype of x if x is single precision.
+    """
+    dtype = np.float32 if getattr(x, "dtype", None) == np.float32 else None
+    transition = np.asarray(transition, dtype=dtype)
+    if out is None:
+        # the operator also works on other array types (e.g. traced JAX arrays)
+        return x @ transition.T
+    return np.matmul(x, transition.T, out=out)
+
+
+def _sample_with_rng(fn, n, rng):
+    """Call a sampling function fn(n), passing rng on if fn accepts it."""
+    if _accepts_keyword(fn, "random_state"):
+        return fn(n, random_state=rng)
+    if _accepts_rng(fn):
+        return fn(n, rng=rng)
+    return fn(n)
 
 
 def independent_sample(fn_list):
@@ -158,16 +292,115 @@ def independent_sample(fn_list):
                 from a distribution.
     Returns:
     -------
-        sample_fn: a function that will sample from all of the functions and concatenate 
-        them
+        sample_fn: a function `sample_fn(n, rng=None, out=None)` that will sample from all of the
+        functions and write them as the columns of an (n, d) array (`out`, if given). If rng is
+        given it is passed on as `random_state` (as accepted by scipy.stats `rvs`) or `rng` to the
+        functions that take it. sample_fn fills a NumPy array, so it cannot be traced by JAX:
+        `jit_filter` falls back to the NumPy ParticleFilter for a prior_fn made this way.
     """
 
-    def sample_fn(n):
-        return np.stack([fn(n) for fn in fn_list]).T
+    def sample_fn(n, rng=None, out=None):
+        if out is None:
+            out = np.empty((n, len(fn_list)))
+        for i, fn in enumerate(fn_list):
+            out[:, i] = fn(n) if rng is None else _sample_with_rng(fn, n, rng)
+        return out
 
     return sample_fn
 
 
+def _cast_floating(array, dtype):
+    """array converted to dtype, if dtype is given and array holds floating point values
+    (other arrays, e.g. packed bitmaps, are left alone). Masked arrays stay masked."""
+    if dtype is None or array is None:
+        return array
+    if not isinstance(array, np.ndarray):
+        array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating):
+        return array
+    return array.astype(dtype, copy=False)
+
+
+def _weights_like(weights, hypotheses):
+    """Weights to combine hypotheses with: in single precision for single precision
+    hypotheses, so that they are not promoted to (and copied as) float64."""
+    if hypotheses.dtype == np.float32:
+        return weights.astype(np.float32)
+    return weights
+
+
+def _clean_likelihood(likelihood, log_domain):
+    """In the log domain, treat undefined (nan) similarities as impossible."""
+    if log_domain:
+        likelihood[np.isnan(likelihood)] = -np.inf
+    return likelihood
+
+
+def _log_posterior(log_prior, likelihood, log_domain):
+    """Unnormalised log-weights: the log prior weights plus the log of the likelihood."""
+    if likelihood is None:
+        return log_prior
+    if not log_domain:
+        with np.errstate(divide="ignore"):
+            likelihood = np.log(np.clip(likelihood, 0, np.inf))
+    return log_prior + likelihood
+
+
+class _WeightedHypothesisSum(object):
+    """Running sum of hypotheses weighted by exp(log_weight), for computing the mean hypothesis
+    without holding all the hypotheses at once. The sums are kept relative to the largest
+    log-weight seen so far (the shift), so they cannot overflow or underflow, and partial sums
+    over different particles can be merged."""
+
+    def __init__(self, log_domain):
+        self.log_domain = log_domain
+        self.shift, self.weighted_sum, self.total = -np.inf, 0.0, 0.0
+        self.plain_sum, self.count, self.shape = 0.0, 0, None
+
+    def _rescale(self, shift):
+        if shift > self.shift:
+            rescale = np.exp(self.shift - shift)
+            self.weighted_sum = self.weighted_sum * rescale
+            self.total *= rescale
+            self.shift = shift
+
+    def add(self, log_weights, hypotheses):
+        flat = hypotheses.reshape(len(hypotheses), -1)
+        self.shape = hypotheses.shape[1:]
+        self.count += len(flat)
+        self._rescale(np.max(log_weights))
+        if np.isfinite(self.shift):
+            scaled = np.exp(log_weights - self.shift)
+            self.weighted_sum = self.weighted_sum + _weights_like(scaled, flat) @ flat
+            self.total += np.sum(scaled)
+        if self.log_domain:
+            self.plain_sum = self.plain_sum + np.sum(flat, axis=0)
+
+    def merge(self, other):
+        self.shape = other.shape if other.shape is not None else self.shape
+        self.count += other.count
+        self._rescale(other.shift)
+        if np.isfinite(other.shift):
+            factor = np.exp(other.shift - self.shift)
+            self.weighted_sum = self.weighted_sum + other.weighted_sum * factor
+            self.total += other.total * factor
+        self.plain_sum = self.plain_sum + other.plain_sum
+
+    def mean(self):
+        if self.total > 0:
+            mean = self.weighted_sum / self.total
+        elif self.log_domain:
+            # every particle has zero probability, and the weights will fall back to uniform
+            mean = self.plain_sum / self.count
+        else:
+            mean = np.full(int(np.prod(self.shape)), np.nan)
+        return np.reshape(mean, self.shape)
+
+
+# stands in for a profiler stage when profiling is off
+_NOT_PROFILED = contextlib.nullcontext()
+
+
 class ParticleFilter(object):
     """A particle filter object which maintains the internal state of a population of particles, and can
     be updated given observations.
@@ -176,7 +409,7 @@ class ParticleFilter(object):
     -----------
     
     n_particles : int
-        number of particles used (N)
+        number of particles used (N); changes at each resampling step if kld_bin_size is set
     d : int
         dimension of the internal state
     resample_proportion : float
@@ -200,9 +433,23 @@ class ParticleFilter(object):
     weight_entropy:
         Entropy of the weight distribution (in nats)
     hypotheses : array
-        The (N,...) array of hypotheses for each particle
+        The (N,...) array of hypotheses for each particle (None when observing in chunks or in parallel,
+        and after `predict` until mean_hypothesis is read)
     weights : array
         N-element vector of normalized weights for each particle.
+    rng : np.random.Generator
+        The filter's own source of randomness.
+    profiler : StageProfiler
+        Per-stage timings of recent updates (None unless profile is set).
+    log_weights : array
+        N-element vector of normalized log-weights for each particle (only if log_weight_fn is used).
+    pyramid_counts : list of int
+        Number of particles scored at each pyramid level in the last update, coarsest first
+        (only if pyramid_levels > 1).
+    n_pruned : int
+        Number of particles a bounded weight function (such as `BoundedSquaredError`) stopped
+        evaluating early in the last update, as they were bound to have negligible weight
+        (None if the weight function does not report it, or in parallel observation).
     """
 
     def __init__(
@@ -219,6 +466,27 @@ class ParticleFilter(object):
         internal_weight_fn=None,
         transform_fn=None,
         n_eff_threshold=1.0,
+        log_weight_fn=None,
+        rng=None,
+        chunk_size=None,
+        chunk_memory=None,
+        summaries=None,
+        in_place=False,
+        n_workers=None,
+        kld_bin_size=None,
+        min_particles=None,
+        max_particles=None,
+        kld_epsilon=0.05,
+        kld_delta=0.01,
+        profile=None,
+        gate_internal_weight=False,
+        prior_pool=None,
+        dtype=None,
+        backend="numpy",
+        pyramid_levels=1,
+        pyramid_factor=2,
+        pyramid_keep=0.25,
+        pyramid_threshold=None,
     ):
         """
         
@@ -232,6 +500,7 @@ class ParticleFilter(object):
                     transformation function from the internal state to the sensor state. Takes an (N,D) array of states 
                     and returns the expected sensor output as an array (e.g. a (N,W,H) tensor if generating W,H dimension images).
         resample_fn: A resampling function weights (N,) => indices (N,)
+                    Defaults to `resample`; see `pfilter.resampling` for the alternatives.
         n_particles : int 
                      number of particles in the filter
         dynamics_fn : function(states) => states
@@ -243,11 +512,19 @@ class ParticleFilter(object):
                     a an array of N hypothesised sensor outputs (e.g. array of dimension (N,W,H)) and the observed output (e.g. array of dimension (W,H)) and 
                     returns a strictly positive weight for the each hypothesis as an N-element vector. 
                     This should be a *similarity* measure, with higher values meaning more similar, for example from an RBF kernel.
+                    If it takes an `observation_key` argument, it is passed a token that is the same
+                    for all the calls scoring one update's observation (see `DiskLikelihood`).
+        log_weight_fn :  function(hypothesized, real) => log_weights
+                    log-domain alternative to weight_fn, returning the *log* similarity of each hypothesis
+                    (e.g. `log_squared_error`). If specified, weight_fn is ignored and the filter keeps its weights
+                    as log-weights (attribute `log_weights`), normalising with log-sum-exp. Use this when the
+                    similarities would underflow to zero, e.g. when comparing large images.
         internal_weight_fn :  function(states, observed) => weights
                     Reweights the particles based on their *internal* state. This is function which takes
                     an (N,D) array of internal states and the observation and 
                     returns a strictly positive weight for the each state as an N-element vector. 
                     Typically used to force particles inside of bounds, etc.       
+                    If it gives every particle zero weight, it is ignored for that update.
         transform_fn: function(states, weights) => transformed_states
                     Applied at the very end of the update step, if specified. Updates the attribute
                     `transformed_particles`. Useful when the particle state needs to be projected
@@ -260,12 +537,130 @@ class ParticleFilter(object):
                     the effective sample size (n_eff) drops below the specified threshold.
         column_names : list of strings
                     names of each the columns of the state vector
+        rng : np.random.Generator, int or None
+                    source of randomness for the filter, or a seed to create one from (see `make_rng`).
+                    The filter's Generator is passed as `rng` to every prior_fn, dynamics_fn, noise_fn
+                    and resample_fn that has an explicit `rng` parameter (all of the built-in noise,
+                    prior and resampling functions do), e.g.
+                        noise_fn=lambda x, rng=None: gaussian_noise(x, sigmas, rng=rng)
+                    Filters given separate streams from `spawn_rngs` can safely run in parallel.
+        chunk_size : int, optional
+                    if given, observe_fn and weight_fn (or log_weight_fn) are applied to this many particles
+                    at a time, and the mean and MAP hypotheses are accumulated chunk by chunk, so that
+                    only one chunk of hypotheses is ever held in memory. The `hypotheses` attribute is
+                    then None. Requires weight_fn to score each hypothesis independently.
+        chunk_memory : int, optional
+                    alternative to chunk_size: a budget in bytes for one chunk of hypotheses, from which
+                    the chunk size is worked out (by observing a single particle on the first update).
+        summaries : iterable of strings, optional
+                    the posterior summaries that will be read, from `ParticleFilter.SUMMARIES`. Summaries
+                    are only computed when first read after an update (and then cached until the next
+                    update), so unread summaries cost nothing. Declaring them also lets chunked observation
+                    skip accumulating mean_hypothesis/map_hypothesis when they are not wanted; reading an
+                    undeclared summary raises an AttributeError. None (default) makes all of them available.
+        in_place : bool
+                    if True, the filter keeps double-buffered particle and weight arrays and updates
+                    them in place, so that steady-state updates make no large allocations. dynamics_fn,
+                    noise_fn, observe_fn and weight_fn (or log_weight_fn) that take an `out` argument
+                    (as the built-in `linear_dynamics`, noise functions and kernels do) write their result
+                    into a preallocated array, resampling gathers into the spare particle buffer, and
+                    replenishment draws only as many prior samples as it needs. Arrays read from the
+                    filter (particles, weights, hypotheses, ...) are overwritten by later updates, so copy
+                    them if they need to be kept. What is still allocated on each update is O(N) or
+                    bounded, never O(N*D) or O(N*P): the resampler's positions, cumulative weights and
+                    indices, the likelihood cleaning and the replenishment mask (N-element vectors each),
+                    and the scratch block of at most 2**16 values that `squared_error` and
+                    `log_squared_error` compute their differences in when writing into `out`.
+        n_workers : int, optional
+                    if given, observe_fn and weight_fn (or log_weight_fn) are evaluated on a persistent pool of
+                    this many worker processes (see `ProcessPoolObserver`), for observation models written as
+                    Python loops that would otherwise run on a single core. The particles are shared with
+                    the workers through shared memory, and only the weights are sent back, so `hypotheses`
+                    is None. The functions must be picklable (e.g. module-level functions, not lambdas),
+                    and are sent to the workers when the pool starts. Call `close()` to stop the pool.
+        kld_bin_size : float or array, optional
+                    if given, the number of particles is adapted at every resampling step by KLD-sampling:
+                    the state space is divided into bins of this width (for all columns, or a D-element
+                    vector of widths per column), and enough particles are drawn that the KL divergence
+                    between the particle approximation and the posterior is below kld_epsilon with
+                    probability 1 - kld_delta. A concentrated posterior occupies few bins and needs few
+                    particles; a spread out one (e.g. a lost target) needs many. n_particles is then
+                    the initial number of particles.
+        min_particles, max_particles : int, optional
+                    bounds on the number of particles when adapting it; default to n_particles // 10
+                    and 10 * n_particles.
+        kld_epsilon : float
+                    bound on the KL divergence when adapting the number of particles (see kld_bin_size).
+        kld_delta : float
+                    probability of exceeding kld_epsilon when adapting the number of particles.
+        profile : bool or StageProfiler, optional
+                    if True (or a `StageProfiler`, to set its capacity, memory tracking and callbacks),
+                    the wall time of each stage of every update (dynamics_fn, noise_fn, observe_fn,
+                    weight_fn, ..., resample_fn) is recorded in the ring buffer of the `profiler`
+                    attribute; see `stage_percentiles`. Profiling is off by default, and then costs
+                    next to nothing. With n_workers, observe_fn and weight_fn run together on the
+                    workers, and their combined time is recorded as the "observe" stage.
+        gate_internal_weight : bool
+                    if True, internal_weight_fn is used as a gate on the observation model: particles
+                    it gives zero weight (e.g. ones inside a wall) are not passed to observe_fn and
+                    weight_fn (or log_weight_fn) at all, as their weight will be zero anyway. The
+                    functions are applied to the surviving particles only, and the results are
+                    scattered back, with zero hypotheses and likelihoods for the pruned particles.
+                    observe_fn and weight_fn must therefore accept any number of particles.
+        prior_pool : int or PriorPool, optional
+                    if given, the particles replenished from the prior (resample_proportion) are taken
+                    from a `PriorPool` of this many pre-drawn samples (or the given pool, e.g. one
+                    created with background=True to refill it on a helper thread), rather than by
+                    calling prior_fn on every update. Exactly as many samples as are replaced are
+                    used. The initial particles are still drawn directly from prior_fn.
+        dtype : numpy dtype, optional
+                    floating point type of the particles, e.g. np.float32 to halve the memory traffic of
+                    large filters. The particles are converted to it after prior_fn, dynamics_fn and
+                    noise_fn, and floating point observations are converted to it before weighting.
+                    The built-in noise, dynamics and kernel functions keep single precision inputs in
+                    single precision; for image observations, observe_fn should render in dtype too.
+                    The weights, their normalisation and the state summaries (mean_state, cov_state)
+                    are always computed in float64. None (default) leaves the arrays as the model
+                    functions return them.
+        backend : "numpy" or "numba"
+                    implementation of the built-in functions. With "numba", a resample_fn, dynamics_fn or
+                    noise_fn that is one of the built-in resampling, noise or collision dynamics functions
+                    (or a `functools.partial` of one, e.g. partial(gaussian_noise, sigmas=[...])) is replaced
+                    by its compiled equivalent from `pfilter.compiled`, which draws the same random numbers.
+                    Lambdas that call a built-in are left alone; call the `pfilter.compiled` version from
+                    them instead. Falls back to "numpy", with a warning, if Numba is not installed; the
+                    backend in use is in the `backend` attribute.
+        pyramid_levels : int
+                    if greater than 1, image observations (arrays whose last two axes are the image) are
+                    weighted coarse to fine: the observation is downsampled into an image pyramid of this
+                    many levels, each pyramid_factor times smaller than the one below (see
+                    `pfilter.pyramid`), all the particles are scored at the coarsest level, and only the
+                    best of them are scored again at each finer level. Particles dropped at a coarse
+                    level get zero likelihood and zero hypotheses, as they would be negligible at full
+                    resolution. An observe_fn that takes a `scale` argument is asked for hypotheses
+                    downsampled by that factor (e.g. rendering at 1/4 of the size), and only the
+                    particles that reach the finest level are rendered at full size; otherwise the full
+                    hypotheses are downsampled. The same weight_fn (or log_weight_fn) is used at every
+                    level. Not available with chunk_size, chunk_memory, n_workers or sparse observations.
+        pyramid_factor : int
+                    downsampling factor between successive pyramid levels.
+        pyramid_keep : float
+                    fraction of the particles scored at each pyramid level that are passed on to the
+                    next, ranked by their weight at that level (at least one is always kept).
+        pyramid_threshold : float, optional
+                    alternative to pyramid_keep: the particles passed on are those whose log-weight at
+                    a pyramid level is within this margin of the best.
         
         """
+        self.rng = make_rng(rng)
+        self.dtype = None if dtype is None else np.dtype(dtype)
         self.resample_fn = resample_fn or resample
         self.column_names = column_names
         self.prior_fn = prior_fn
         self.n_particles = n_particles
+        if isinstance(prior_pool, int):
+            prior_pool = PriorPool(prior_fn, size=prior_pool, rng=self.spawn_rngs(1)[0])
+        self.prior_pool = prior_pool
         self.init_filter()
         self.n_eff_threshold = n_eff_threshold
         self.d = self.particles.shape[1]
@@ -274,11 +669,216 @@ class ParticleFilter(object):
         self.noise_fn = noise_fn or identity
         self.weight_fn = weight_fn or squared_error
         self.weights = np.ones(self.n_particles) / self.n_particles
+        self.log_weight_fn = log_weight_fn
+        if self.log_weight_fn is not None:
+            self.log_weights = np.log(self.weights)
         self.transform_fn = transform_fn
         self.transformed_particles = None
         self.resample_proportion = resample_proportion or 0.0
         self.internal_weight_fn = internal_weight_fn
-        self.original_particles = np.array(self.particles)
+        self.gate_internal_weight = gate_internal_weight
+        self.original_particles = self.particles
+        self.chunk_size = chunk_size
+        self.chunk_memory = chunk_memory
+        self._chunk_size_from_memory = None
+        if summaries is not None:
+            summaries = frozenset(summaries)
+            unknown = summaries.difference(self.SUMMARIES)
+            if unknown:
+                raise ValueError(
+                    "Unknown summaries {}; expected some of {}".format(
+                        sorted(unknown), self.SUMMARIES
+                    )
+                )
+        self.summaries = summaries
+        self.original_weights = self.weights
+        if self.log_weight_fn is not None:
+            self._original_log_weights = self.log_weights
+        self.hypotheses = None
+        # set by predict: the hypotheses of the particles are computed only if they are read
+        self._hypotheses_deferred = False
+        self._summaries = {}
+        self.in_place = in_place
+        self._buffers = {}
+        self.n_workers = n_workers
+        self._observer = None
+        self._observe_kwargs = {}
+        # flat indices the hypotheses are gathered at before weighting (sparse observations)
+        self._gather = None
+        # this update's observation, and a token identifying it to weight functions
+        self._observation = self._observation_key = None
+        self.kld_bin_size = kld_bin_size
+        self.min_particles = max(1, n_particles // 10) if min_particles is None else min_particles
+        self.max_particles = 10 * n_particles if max_particles is None else max_particles
+        self.kld_epsilon = kld_epsilon
+        self.kld_delta = kld_delta
+        if profile is True:
+            profile = StageProfiler()
+        self.profiler = profile or None
+        if pyramid_levels > 1 and (
+            chunk_size is not None or chunk_memory is not None or n_workers is not None
+        ):
+            raise ValueError(
+                "pyramid_levels cannot be combined with chunk_size, chunk_memory or n_workers"
+            )
+        self.pyramid_levels = pyramid_levels
+        self.pyramid_factor = pyramid_factor
+        self.pyramid_keep = pyramid_keep
+        self.pyramid_threshold = pyramid_threshold
+        self.pyramid_counts = None
+        self.n_pruned = None
+        self.backend = "numpy"
+        if backend != "numpy":
+            # imported here, as the compiled module wraps the functions of this one
+            from .compiled import backend_function, resolve_backend
+
+            self.backend = resolve_backend(backend)
+            self.resample_fn = backend_function(self.resample_fn, self.backend)
+            self.dynamics_fn = backend_function(self.dynamics_fn, self.backend)
+            self.noise_fn = backend_function(self.noise_fn, self.backend)
+
+    # posterior summaries of the last update, computed lazily when first read
+    SUMMARIES = (
+        "mean_state",
+        "cov_state",
+        "map_state",
+        "mean_hypothesis",
+        "map_hypothesis",
+        "weight_entropy",
+    )
+
+    def _summary_needed(self, name):
+        return self.summaries is None or name in self.summaries
+
+    def _summary(self, name):
+        """Return the named summary of the last update, computing and caching it on first use."""
+        try:
+            return self._summaries[name]
+        except KeyError:
+            pass
+        if not self._summary_needed(name):
+            raise AttributeError(
+                "{} is not among the declared summaries {}".format(
+                    name, sorted(self.summaries)
+                )
+            )
+        with self._stage("summaries"):
+            value = self._summaries[name] = getattr(self, "_compute_" + name)()
+        return value
+
+    def _hypotheses_for_summary(self, name):
+        if self.hypotheses is None and self._hypotheses_deferred:
+            self.hypotheses = self.observe_fn(self.original_particles, **self._observe_kwargs)
+            self._hypotheses_deferred = False
+        if self.hypotheses is None:
+            raise AttributeError(
+                "{} is not available: no hypotheses were kept by the last update".format(name)
+            )
+        return self.hypotheses
+
+    def _compute_mean_state(self):
+        return np.sum(self.original_particles.T * self.original_weights, axis=-1).T
+
+    def _compute_cov_state(self):
+        return np.cov(self.original_particles, rowvar=False, aweights=self.original_weights)
+
+    def _compute_map_state(self):
+        return self.original_particles[np.argmax(self.original_weights)]
+
+    def _compute_mean_hypothesis(self):
+        if self._hypotheses_deferred and (
+            self.n_workers is not None or self._chunk_size(**self._observe_kwargs) is not None
+        ):
+            return self._streamed_mean_hypothesis()
+        hypotheses = self._hypotheses_for_summary("mean_hypothesis")
+        if hypotheses.dtype == np.float32:
+            # a single pass over the hypotheses, without promoting them to float64
+            return np.tensordot(_weights_like(self.original_weights, hypotheses), hypotheses, 1)
+        return np.sum(hypotheses.T * self.original_weights, axis=-1).T
+
+    def _compute_map_hypothesis(self):
+        map_index = np.argmax(self.original_weights)
+        if self.hypotheses is None:
+            # hypotheses were not kept (chunked or parallel observation): observe the MAP state
+            return self.observe_fn(
+                self.original_particles[map_index : map_index + 1], **self._observe_kwargs
+            )[0]
+        return self.hypotheses[map_index]
+
+    def _streamed_mean_hypothesis(self):
+        """The mean hypothesis of the current particles, observing them a chunk at a time
+        (for filters that do not hold all the hypotheses at once)."""
+        log_domain = self.log_weight_fn is not None
+        log_weights = self._log_prior(None)
+        chunk_size = self._chunk_size(**self._observe_kwargs) or self.n_particles
+        hypothesis_sum = _WeightedHypothesisSum(log_domain)
+        for start in range(0, self.n_particles, chunk_size):
+            stop = min(start + chunk_size, self.n_particles)
+            hypothesis_sum.add(
+                log_weights[start:stop],
+                self.observe_fn(self.original_particles[start:stop], **self._observe_kwargs),
+            )
+        return hypothesis_sum.mean()
+
+    def _compute_weight_entropy(self):
+        # zero-weight particles contribute nothing
+        if self.log_weight_fn is not None:
+            log_weights = self._original_log_weights
+        else:
+            with np.errstate(divide="ignore"):
+                log_weights = np.log(self.original_weights)
+        with np.errstate(invalid="ignore"):
+            return np.sum(
+                self.original_weights * log_weights, where=self.original_weights > 0
+            )
+
+    @property
+    def mean_state(self):
+        """The current mean hypothesized internal state D"""
+        return self._summary("mean_state")
+
+    @property
+    def cov_state(self):
+        """The (D,D) weighted covariance of the internal state"""
+        return self._summary("cov_state")
+
+    @property
+    def map_state(self):
+        """The current most likely hypothesized state"""
+        return self._summary("map_state")
+
+    @property
+    def mean_hypothesis(self):
+        """The current mean hypothesized observation"""
+        return self._summary("mean_hypothesis")
+
+    @property
+    def map_hypothesis(self):
+        """The current most likely hypothesized observation"""
+        return self._summary("map_hypothesis")
+
+    @property
+    def weight_entropy(self):
+        """Entropy of the weight distribution (in nats)"""
+        return self._summary("weight_entropy")
+
+    def _stage(self, name):
+        """Context manager timing the named stage of the update, if profiling is on."""
+        if self.profiler is None:
+            return _NOT_PROFILED
+        return self.profiler.stage(name)
+
+    def stage_percentiles(self, q=(50, 90, 99), memory=False):
+        """Percentiles of the time (in seconds) spent in each stage over the recent updates,
+        as {stage: array of len(q)}; see `StageProfiler.percentiles`. Requires profile=True."""
+        if self.profiler is None:
+            raise ValueError("profiling is off: create the filter with profile=True")
+        return self.profiler.percentiles(q, memory=memory)
+
+    def spawn_rngs(self, n):
+        """Split n independent Generators off this filter's random stream, e.g. to seed
+        further filters that will run in parallel threads or processes."""
+        return spawn_rngs(self.rng, n)
 
     def init_filter(self, mask=None):
         """Initialise the filter by drawing samples from the prior.
@@ -289,14 +889,408 @@ class ParticleFilter(object):
             boolean mask specifying the elements of the particle array to draw from the prior. None (default)
             implies all particles will be resampled (i.e. a complete reset)
         """
-        new_sample = self.prior_fn(self.n_particles)
+        prior_kwargs = _rng_kwargs(self.prior_fn, self.rng, {})
 
         # resample from the prior
         if mask is None:
-            self.particles = new_sample
+            self.particles = self.prior_fn(self.n_particles, **prior_kwargs)
+            if self.dtype is not None:
+                self.particles = np.asarray(self.particles, dtype=self.dtype)
+            return
+
+        if self.particles is getattr(self, "original_particles", None):
+            # copy rather than overwrite the sample set of the last update
+            if self.in_place:
+                spare = self._next_buffer("particles", self.particles)
+                np.copyto(spare, self.particles)
+                self.particles = spare
+            else:
+                self.particles = np.array(self.particles)
+        if self.prior_pool is not None:
+            n_masked = np.count_nonzero(mask)
+            if n_masked > 0:
+                self.particles[mask, :] = self.prior_pool.draw(n_masked)
+        elif self.in_place:
+            # draw only as many samples as will be used
+            n_masked = np.count_nonzero(mask)
+            if n_masked > 0:
+                self.particles[mask, :] = self.prior_fn(n_masked, **prior_kwargs)
         else:
+            new_sample = self.prior_fn(self.n_particles, **prior_kwargs)
             self.particles[mask, :] = new_sample[mask, :]
 
+    def _internal_weights(self, observed, **kwargs):
+        """Weights from internal_weight_fn forced to be positive, or None if it is not used,
+        or if every particle has zero weight (which would leave no weight to normalise), so
+        that the weights fall back to the likelihood alone."""
+        if self.internal_weight_fn is None:
+            return None
+        internal_weights = np.clip(
+            self.internal_weight_fn(self.particles, observed, **kwargs), 0, np.inf
+        )
+        if not np.any(internal_weights > 0):
+            return None
+        return internal_weights
+
+    def _next_buffer(self, name, current):
+        """One of the named pair of preallocated buffers (used in in_place mode): whichever
+        does not hold `current`, so it can be written without disturbing it. The pair is
+        (re)allocated to match `current` when missing or of the wrong shape."""
+        pair = self._buffers.get(name)
+        if pair is None or pair[0].shape != current.shape or pair[0].dtype != current.dtype:
+            pair = self._buffers[name] = (np.empty_like(current), np.empty_like(current))
+        return pair[1] if current is pair[0] else pair[0]
+
+    def _propagate(self, fn, **kwargs):
+        """Apply a dynamics or noise function to the particles. In in_place mode, functions
+        that take an `out` argument write into the spare particle buffer."""
+        kwargs = _rng_kwargs(fn, self.rng, kwargs)
+        if self.in_place and _accepts_keyword(fn, "out"):
+            kwargs = dict(kwargs, out=self._next_buffer("particles", self.particles))
+        particles = fn(self.particles, **kwargs)
+        if self.dtype is not None:
+            particles = np.asarray(particles, dtype=self.dtype)
+        return particles
+
+    def _observe(self, **kwargs):
+        """Hypothesise the observations of all particles. In in_place mode, an observe_fn
+        that takes an `out` argument reuses the hypotheses array of the previous update, as
+        long as the number of particles and (for a sparse observation computed by observe_fn)
+        the number of observed values are the same; otherwise a new one is allocated."""
+        if self.in_place and _accepts_keyword(self.observe_fn, "out"):
+            shape = (self.n_particles, np.shape(kwargs.get("indices")))
+            buffer, buffer_shape = self._buffers.get("hypotheses", (None, None))
+            if buffer is not None and buffer_shape == shape:
+                return self.observe_fn(self.particles, out=buffer, **kwargs)
+            buffer = self.observe_fn(self.particles, **kwargs)
+            self._buffers["hypotheses"] = (buffer, shape)
+            return buffer
+        return self.observe_fn(self.particles, **kwargs)
+
+    def _likelihood(self, hypotheses, observed, kwargs, in_place=False):
+        """Similarity of each of the flattened (n,P) hypotheses to the observation, from
+        weight_fn, or the log similarity from log_weight_fn in the log domain. For a sparse
+        observation, the hypotheses are first gathered at its indices. With in_place,
+        a weight function that takes an `out` argument writes into a preallocated array.
+        A weight function that takes an `observation_key` argument is passed a token that
+        is the same for every call comparing to this update's observation (e.g. chunk by
+        chunk), so that it can reuse what it computes from the observation."""
+        log_domain = self.log_weight_fn is not None
+        fn = self.log_weight_fn if log_domain else self.weight_fn
+        if self._gather is not None:
+            hypotheses = hypotheses[:, self._gather]
+        if observed is self._observation and _accepts_keyword(fn, "observation_key"):
+            kwargs = dict(kwargs, observation_key=self._observation_key)
+        if in_place and _accepts_keyword(fn, "out"):
+            out = self._buffers.get("likelihood")
+            if out is None or len(out) != len(hypotheses):
+                out = self._buffers["likelihood"] = np.empty(len(hypotheses))
+            likelihood = np.asarray(
+                fn(hypotheses, observed.reshape(1, -1), out=out, **kwargs), dtype=float
+            )
+        else:
+            likelihood = np.array(
+                fn(hypotheses, observed.reshape(1, -1), **kwargs),
+                dtype=float if log_domain else None,
+            )
+        # bounded weight functions report how many particles they stopped evaluating
+        n_pruned = getattr(fn, "n_pruned", None)
+        if n_pruned is not None:
+            self.n_pruned = (self.n_pruned or 0) + n_pruned
+        return _clean_likelihood(likelihood, log_domain)
+
+    def _weight(self, likelihood, internal_weights):
+        """Reweight the particles in the linear domain, multiplying the previous weights
+        by the likelihood (and internal weights), then normalising."""
+        out = self._next_buffer("weights", self.weights) if self.in_place else None
+        if likelihood is not None:
+            # force to be positive
+            weights = np.multiply(self.weights, likelihood, out=out)
+            np.clip(weights, 0, np.inf, out=weights)
+        else:
+            # we have no observation, so all particles weighted the same
+            weights = np.multiply(self.weights, 1.0, out=out)
+
+        # apply weighting based on the internal state
+        # most filters don't use this, but can be a useful way of combining
+        # forward and inverse models
+        if internal_weights is not None:
+            weights *= internal_weights
+            weights /= np.sum(internal_weights)
+
+        # normalise weights to resampling probabilities
+        self.weight_normalisation = np.sum(weights)
+        weights /= self.weight_normalisation
+        self.weights = weights
+
+        # Compute effective sample size.
+        # This is a useful statistic for adaptive particle filtering.
+        self.n_eff = (1.0 / np.dot(weights, weights)) / self.n_particles
+
+    def _log_weight(self, log_likelihood, internal_weights):
+        """Reweight the particles in the log domain, adding the log-likelihood (and the log
+        of the internal weights) to the previous log-weights, then normalising with
+        log-sum-exp so that no weight underflows before normalisation."""
+        if self.in_place:
+            log_weights = self._next_buffer("log_weights", self.log_weights)
+            weights = self._next_buffer("weights", self.weights)
+        else:
+            log_weights = np.empty_like(self.log_weights)
+            weights = np.empty_like(self.log_weights)
+        np.copyto(log_weights, self.log_weights)
+        if log_likelihood is not None:
+            log_weights += log_likelihood
+
+        if internal_weights is not None:
+            with np.errstate(divide="ignore"):
+                log_weights += np.log(internal_weights)
+
+        # normalise with log-sum-exp, using the weights array as scratch space
+        shift = np.max(log_weights)
+        log_normalisation = shift
+        if np.isfinite(shift):
+            np.subtract(log_weights, shift, out=weights)
+            np.exp(weights, out=weights)
+            log_normalisation = shift + np.log(np.sum(weights))
+        if not np.isfinite(log_normalisation):
+            # every particle has zero probability: fall back to uniform weights
+            log_weights.fill(0.0)
+            log_normalisation = np.log(self.n_particles)
+
+        self.log_weight_normalisation = log_normalisation
+        self.weight_normalisation = np.exp(log_normalisation)
+        log_weights -= log_normalisation
+        self.log_weights = log_weights
+        self.weights = np.exp(log_weights, out=weights)
+
+        # effective sample size 1 / sum(w^2); safe in the linear domain once normalised,
+        # as the largest weight is at least 1/N
+        self.n_eff = (1.0 / np.dot(weights, weights)) / self.n_particles
+
+    def _chunk_size(self, **kwargs):
+        """Number of particles to observe at once, or None to observe them all together.
+        With a chunk_memory budget, the size is measured from one hypothesis the first time
+        it is needed."""
+        if self.chunk_size is not None or self.chunk_memory is None:
+            return self.chunk_size
+        if self._chunk_size_from_memory is None:
+            hypothesis_bytes = self.observe_fn(self.particles[:1], **kwargs).nbytes
+            self._chunk_size_from_memory = max(
+                1, int(self.chunk_memory // max(hypothesis_bytes, 1))
+            )
+        return self._chunk_size_from_memory
+
+    def _log_prior(self, internal_weights):
+        """Unnormalised log-weights of the particles before the likelihood is applied."""
+        with np.errstate(divide="ignore"):
+            log_prior = (
+                self.log_weights if self.log_weight_fn is not None else np.log(self.weights)
+            )
+            if internal_weights is not None:
+                log_prior = log_prior + np.log(internal_weights)
+        return log_prior
+
+    def _chunked_likelihood(self, observed, internal_weights, chunk_size, live=None, **kwargs):
+        """Stream the particles through observe_fn and weight_fn (or log_weight_fn) chunk_size
+        particles at a time, so that at most one chunk of hypotheses is ever held in memory.
+        The weighted mean hypothesis is accumulated as the chunks go past (if it is among the
+        declared summaries); the MAP hypothesis is recomputed from the MAP state when read.
+
+        Returns the N-element vector of (log) likelihoods, or None if there is no observation."""
+        particles = self.particles if live is None else self.particles[live]
+        n = len(particles)
+        log_domain = self.log_weight_fn is not None
+        likelihood = None if observed is None else np.empty(n)
+        hypothesis_sum = None
+        if self._summary_needed("mean_hypothesis"):
+            hypothesis_sum = _WeightedHypothesisSum(log_domain)
+            log_prior = self._log_prior(internal_weights)
+            if live is not None:
+                log_prior = log_prior[live]
+
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            with self._stage("observe"):
+                hypotheses = self.observe_fn(particles[start:stop], **self._observe_kwargs)
+            chunk_likelihood = None
+            if observed is not None:
+                with self._stage("weight"):
+                    chunk_likelihood = self._likelihood(
+                        hypotheses.reshape(stop - start, -1), observed, kwargs
+                    )
+                likelihood[start:stop] = chunk_likelihood
+            if hypothesis_sum is not None:
+                hypothesis_sum.add(
+                    _log_posterior(log_prior[start:stop], chunk_likelihood, log_domain),
+                    hypotheses,
+                )
+
+        if hypothesis_sum is not None:
+            self._summaries["mean_hypothesis"] = hypothesis_sum.mean()
+        self.hypotheses = None
+        return self._scatter_likelihood(likelihood, live)
+
+    def _parallel_likelihood(self, observed, internal_weights, live=None, **kwargs):
+        """Evaluate observe_fn and weight_fn (or log_weight_fn) on the process pool. Only the
+        likelihoods (and, if it is among the declared summaries, the partial sums for the
+        mean hypothesis) come back from the workers; the hypotheses themselves never do.
+
+        Returns the N-element vector of (log) likelihoods, or None if there is no observation."""
+        if self._observer is None:
+            # imported here, as the parallel module builds on the helpers in this one
+            from .parallel import ProcessPoolObserver
+
+            log_domain = self.log_weight_fn is not None
+            self._observer = ProcessPoolObserver(
+                self.observe_fn,
+                self.log_weight_fn if log_domain else self.weight_fn,
+                log_domain=log_domain,
+                n_workers=self.n_workers,
+            )
+        particles = self.particles if live is None else self.particles[live]
+        log_prior = None
+        if self._summary_needed("mean_hypothesis"):
+            log_prior = self._log_prior(internal_weights)
+            if live is not None:
+                log_prior = log_prior[live]
+        likelihood, hypothesis_sum = self._observer.likelihood(
+            particles,
+            observed,
+            log_prior=log_prior,
+            kwargs=kwargs,
+            observe_kwargs=self._observe_kwargs,
+            indices=self._gather,
+        )
+        if hypothesis_sum is not None:
+            self._summaries["mean_hypothesis"] = hypothesis_sum.mean()
+        self.hypotheses = None
+        return self._scatter_likelihood(likelihood, live)
+
+    def _live_particles(self, internal_weights):
+        """Indices of the particles with non-zero internal weight, when gate_internal_weight
+        is set and some particles have zero weight; otherwise None (observe every particle)."""
+        if not self.gate_internal_weight or internal_weights is None:
+            return None
+        live = np.flatnonzero(internal_weights > 0)
+        if len(live) == self.n_particles:
+            return None
+        return live
+
+    def _scatter(self, values, live, fill):
+        """Expand values computed for the live particles to all N particles."""
+        full = np.full((self.n_particles,) + values.shape[1:], fill, dtype=values.dtype)
+        full[live] = values
+        return full
+
+    def _scatter_likelihood(self, likelihood, live):
+        if likelihood is None or live is None:
+            return likelihood
+        return self._scatter(likelihood, live, -np.inf if self.log_weight_fn is not None else 0.0)
+
+    def _pyramid_survivors(self, likelihood, log_prior):
+        """Indices of the particles scored at a pyramid level that go on to the next: the
+        pyramid_keep fraction with the highest weights, or those within pyramid_threshold of
+        the highest log-weight."""
+        with np.errstate(divide="ignore"):
+            if self.log_weight_fn is None:
+                likelihood = np.log(likelihood)
+            log_weights = log_prior + likelihood
+        if self.pyramid_threshold is not None:
+            best = np.max(log_weights)
+            if not np.isfinite(best):
+                return np.arange(len(log_weights))
+            return np.flatnonzero(log_weights >= best - self.pyramid_threshold)
+        n_keep = max(1, int(np.ceil(self.pyramid_keep * len(log_weights))))
+        if n_keep >= len(log_weights):
+            return np.arange(len(log_weights))
+        return np.sort(np.argpartition(-log_weights, n_keep - 1)[:n_keep])
+
+    def _pyramid_likelihood(self, observed, internal_weights, live=None, **kwargs):
+        """Weight the particles coarse to fine on an image pyramid of the observation,
+        dropping all but the best particles at each level before the next. Sets `hypotheses`
+        (the full resolution hypotheses of the particles that reached the finest level, and
+        zeros for the others) and `pyramid_counts`.
+
+        Returns the N-element vector of (log) likelihoods."""
+        observed = np.asarray(observed)
+        pyramid = image_pyramid(observed, self.pyramid_levels, self.pyramid_factor)
+        scales = pyramid_scales(self.pyramid_levels, self.pyramid_factor)
+        rendered = _accepts_keyword(self.observe_fn, "scale")
+        candidates = np.arange(self.n_particles) if live is None else live
+        log_prior = self._log_prior(internal_weights)
+        full = None
+        if not rendered:
+            with self._stage("observe"):
+                full = self.observe_fn(self.particles[candidates], **kwargs)
+        self.pyramid_counts = []
+        for scale, observed_level in zip(scales[:-1], pyramid[:-1]):
+            self.pyramid_counts.append(len(candidates))
+            with self._stage("observe"):
+                if rendered:
+                    hypotheses = self.observe_fn(
+                        self.particles[candidates], scale=scale, **kwargs
+                    )
+                else:
+                    hypotheses = downsample(full, scale)
+            with self._stage("weight"):
+                likelihood = self._likelihood(
+                    hypotheses.reshape(len(candidates), -1), observed_level, kwargs
+                )
+            survivors = self._pyramid_survivors(likelihood, log_prior[candidates])
+            candidates = candidates[survivors]
+            if full is not None:
+                full = full[survivors]
+        self.pyramid_counts.append(len(candidates))
+        with self._stage("observe"):
+            if full is None:
+                full = self.observe_fn(self.particles[candidates], **kwargs)
+            self.hypotheses = self._scatter(full, candidates, 0)
+        with self._stage("weight"):
+            likelihood = self._likelihood(full.reshape(len(candidates), -1), observed, kwargs)
+        return self._scatter_likelihood(likelihood, candidates)
+
+    def _kld_resample(self):
+        """Draw the indices of a new particle set, whose size is chosen by KLD-sampling.
+        resample_fn is applied repeatedly, each time drawing as many particles as there are
+        now, until the draws satisfy the KLD bound for the number of bins they occupy (or
+        max_particles is reached). The draws are then shuffled, and the shortest prefix that
+        satisfies the bound (within min_particles and max_particles) is kept."""
+        bins = state_bins(self.particles, self.kld_bin_size)
+        occupied = np.zeros(np.max(bins) + 1, dtype=bool)
+        resample_kwargs = _rng_kwargs(self.resample_fn, self.rng, {})
+        draws, n_drawn = [], 0
+        while True:
+            draw = self.resample_fn(self.weights, **resample_kwargs)
+            draws.append(draw)
+            n_drawn += len(draw)
+            occupied[bins[draw]] = True
+            target = np.clip(
+                kld_bound(np.count_nonzero(occupied), self.kld_epsilon, self.kld_delta),
+                self.min_particles,
+                self.max_particles,
+            )
+            if n_drawn >= target:
+                break
+        indices = self.rng.permutation(np.concatenate(draws))[: self.max_particles]
+        n = kld_sample_size(
+            bins[indices],
+            self.kld_epsilon,
+            self.kld_delta,
+            min_n=self.min_particles,
+            max_n=self.max_particles,
+        )
+        return indices[:n]
+
+    def close(self):
+        """Shut down the worker processes used when n_workers is set, and the background thread
+        of the prior pool. The filter can still be updated afterwards; a new pool of workers is
+        started when needed, and the prior pool then refills itself synchronously."""
+        if self.prior_pool is not None:
+            self.prior_pool.close()
+        if self._observer is not None:
+            self._observer.close()
+            self._observer = None
+
     def update(self, observed=None, **kwargs):
         """Update the state of the particle filter given an observation.
         
@@ -306,96 +1300,224 @@ class ParticleFilter(object):
         observed: array
             The observed output, in the same format as observe_fn() will produce. This is typically the
             input from the sensor observing the process (e.g. a camera image in optical tracking).
-            If None, then the observation step is skipped, and the filter will run one step in prediction-only mode.
+            If None, then the observation step is skipped, and the filter will run one step in prediction-only mode
+            (observe_fn is still applied, to compute the hypotheses; use `predict` to skip it).
+            A partial observation (e.g. a frame with occluded regions) can be given as a
+            `SparseObservation` of the valid values and their flat indices, or as a masked array,
+            which is converted to one. Only the valid values are then compared: the hypotheses are
+            gathered at the indices before weight_fn is called with plain arrays, or, if observe_fn
+            takes an `indices` argument, it is passed the indices and should return just those
+            values (as an (N,K) array, which `hypotheses` then holds). internal_weight_fn is
+            passed the observation as given (the masked array, or the SparseObservation).
 
         kwargs: any keyword arguments specified will be passed on to:
             observe_fn(y, **kwargs)
             weight_fn(x, **kwargs)
+            log_weight_fn(x, **kwargs)
             dynamics_fn(x, **kwargs)
             noise_fn(x, **kwargs)
             internal_weight_function(x, y, **kwargs)
             transform_fn(x, **kwargs)
         """
 
-        # apply dynamics and noise
-        self.particles = self.noise_fn(
-            self.dynamics_fn(self.particles, **kwargs), **kwargs
-        )
+        # reject an update that cannot be weighted before anything about the filter changes
+        if self.pyramid_levels > 1 and (
+            isinstance(observed, SparseObservation) or np.ma.is_masked(observed)
+        ):
+            raise ValueError("sparse observations cannot be weighted on an image pyramid")
+        if self.profiler is None:
+            self._update(observed, **kwargs)
+            return
+        self.profiler.begin_update()
+        with self.profiler.stage("update"):
+            self._update(observed, **kwargs)
 
-        # hypothesise observations
-        self.hypotheses = self.observe_fn(self.particles, **kwargs)
+    def predict(self, k=1, **kwargs):
+        """Advance the particles k time steps without an observation, e.g. to estimate the
+        state between the frames of a slower sensor.
 
-        if observed is not None:
-            # compute similarity to observations
-            # force to be positive
+        Only dynamics_fn and noise_fn are applied: observe_fn is not called, and the weights
+        are left as they are (so there is no resampling or replenishment). The summaries
+        describe the predicted particles; the hypotheses are computed only if mean_hypothesis
+        or map_hypothesis is read before the next update, and `hypotheses` is None until then.
+        transform_fn, if given, is applied once at the end.
 
-            weights = np.clip(
-                self.weights * np.array(
-                    self.weight_fn(
-                        self.hypotheses.reshape(self.n_particles, -1),
-                        observed.reshape(1, -1),
-                        **kwargs
-                    )
-                ),
-                0,
-                np.inf,
-            )
+        Parameters:
+        ----------
+
+        k : int
+            number of time steps to predict
+        kwargs: any keyword arguments specified will be passed on to dynamics_fn, noise_fn,
+            transform_fn and (if the hypotheses are read) observe_fn
+        """
+        if self.profiler is None:
+            self._predict(k, **kwargs)
+            return
+        self.profiler.begin_update()
+        with self.profiler.stage("update"):
+            self._predict(k, **kwargs)
+
+    def _predict(self, k, **kwargs):
+        for _ in range(k):
+            self._advance(**kwargs)
+        self.hypotheses = None
+        self._hypotheses_deferred = True
+        self._observe_kwargs = kwargs
+        self.original_particles = self.particles
+        self.original_weights = self.weights
+        if self.log_weight_fn is not None:
+            self._original_log_weights = self.log_weights
+        if self.transform_fn:
+            with self._stage("transform"):
+                self.transformed_particles = self.transform_fn(
+                    self.original_particles, self.weights, **kwargs
+                )
         else:
-            # we have no observation, so all particles weighted the same
-            weights = self.weights * np.ones((self.n_particles,))
+            self.transformed_particles = self.original_particles
 
-        # apply weighting based on the internal state
-        # most filters don't use this, but can be a useful way of combining
-        # forward and inverse models
-        if self.internal_weight_fn is not None:
-            internal_weights = self.internal_weight_fn(
-                self.particles, observed, **kwargs
-            )
-            internal_weights = np.clip(internal_weights, 0, np.inf)
-            internal_weights = internal_weights / np.sum(internal_weights)
-            weights *= internal_weights
+    def _advance(self, **kwargs):
+        """Apply dynamics and noise to the particles, invalidating the summaries."""
+        with self._stage("dynamics"):
+            self.particles = self._propagate(self.dynamics_fn, **kwargs)
+        with self._stage("noise"):
+            self.particles = self._propagate(self.noise_fn, **kwargs)
 
-        # normalise weights to resampling probabilities
-        self.weight_normalisation = np.sum(weights)
-        self.weights = weights / self.weight_normalisation
+        # the summaries of the previous step are no longer valid
+        self._summaries = {}
+
+    def _sparse_observation(self, sparse, kwargs):
+        """Set up the observation of a sparse observation's values for this update: an
+        observe_fn that takes `indices` computes only the observed values, and otherwise the
+        hypotheses are gathered at the indices before weighting."""
+        self._observe_kwargs = kwargs
+        self._gather = None
+        if sparse is None:
+            return
+        if _accepts_keyword(self.observe_fn, "indices"):
+            self._observe_kwargs = dict(kwargs, indices=sparse.indices)
+        else:
+            self._gather = sparse.indices
 
-        # Compute effective sample size and entropy of weighting vector.
-        # These are useful statistics for adaptive particle filtering.
-        self.n_eff = (1.0 / np.sum(self.weights ** 2)) / self.n_particles
-        self.weight_entropy = np.sum(self.weights * np.log(self.weights))
+    def _update(self, observed=None, **kwargs):
+        given = observed
+        observed, sparse = _split_observation(observed)
+        observed = _cast_floating(observed, self.dtype)
+        self._observation, self._observation_key = observed, object()
+        self._advance(**kwargs)
+        self._hypotheses_deferred = False
 
-        # preserve current sample set before any replenishment
-        self.original_particles = np.array(self.particles)
+        # weighting based on the internal state, which needs no hypotheses
+        with self._stage("internal_weight"):
+            internal_weights = self._internal_weights(
+                observed if sparse is None else given, **kwargs
+            )
+
+        # hypothesise observations and compare them to the observation, skipping the
+        # particles the internal weights have already ruled out if gating is on
+        self._sparse_observation(sparse, kwargs)
+        self.n_pruned = None
+        live = self._live_particles(internal_weights)
+        chunk_size = self._chunk_size(**kwargs)
+        if self.pyramid_levels > 1 and observed is not None:
+            likelihood = self._pyramid_likelihood(
+                observed, internal_weights, live=live, **kwargs
+            )
+        elif self.n_workers is not None:
+            with self._stage("observe"):
+                likelihood = self._parallel_likelihood(
+                    observed, internal_weights, live=live, **kwargs
+                )
+        elif chunk_size is None and live is not None:
+            with self._stage("observe"):
+                hypotheses = self.observe_fn(self.particles[live], **self._observe_kwargs)
+                self.hypotheses = self._scatter(hypotheses, live, 0)
+            likelihood = None
+            if observed is not None:
+                with self._stage("weight"):
+                    likelihood = self._scatter_likelihood(
+                        self._likelihood(hypotheses.reshape(len(live), -1), observed, kwargs),
+                        live,
+                    )
+        elif chunk_size is None:
+            with self._stage("observe"):
+                self.hypotheses = self._observe(**self._observe_kwargs)
+            likelihood = None
+            if observed is not None:
+                with self._stage("weight"):
+                    likelihood = self._likelihood(
+                        self.hypotheses.reshape(self.n_particles, -1),
+                        observed,
+                        kwargs,
+                        in_place=self.in_place,
+                    )
+        else:
+            likelihood = self._chunked_likelihood(
+                observed, internal_weights, chunk_size, live=live, **kwargs
+            )
 
-        # store mean (expected) hypothesis
-        self.mean_hypothesis = np.sum(self.hypotheses.T * self.weights, axis=-1).T
-        self.mean_state = np.sum(self.particles.T * self.weights, axis=-1).T
-        self.cov_state = np.cov(self.particles, rowvar=False, aweights=self.weights)
+        with self._stage("normalise"):
+            if self.log_weight_fn is not None:
+                self._log_weight(likelihood, internal_weights)
+            else:
+                self._weight(likelihood, internal_weights)
 
-        # store MAP estimate
-        argmax_weight = np.argmax(self.weights)
-        self.map_state = self.particles[argmax_weight]
-        self.map_hypothesis = self.hypotheses[argmax_weight]
-        self.original_weights = np.array(self.weights) # before any resampling
+        # preserve current sample set and weights before any resampling or replenishment;
+        # the summaries (mean_state, etc.) are computed from these when first read
+        self.original_particles = self.particles
+        self.original_weights = self.weights
+        if self.log_weight_fn is not None:
+            self._original_log_weights = self.log_weights
 
         # apply any post-processing
         if self.transform_fn:
-            self.transformed_particles = self.transform_fn(
-                self.original_particles, self.weights, **kwargs
-            )
+            with self._stage("transform"):
+                self.transformed_particles = self.transform_fn(
+                    self.original_particles, self.weights, **kwargs
+                )
         else:
             self.transformed_particles = self.original_particles
 
         # resampling (systematic resampling) step
         if self.n_eff < self.n_eff_threshold:
-            indices = self.resample_fn(self.weights)
-            self.particles = self.particles[indices, :]
-            self.weights = np.ones(self.n_particles) / self.n_particles
+            with self._stage("resample"):
+                self._resample()
 
         # randomly resample some particles from the prior
         if self.resample_proportion > 0:
-            random_mask = (
-                np.random.random(size=(self.n_particles,)) < self.resample_proportion
+            with self._stage("replenish"):
+                random_mask = (
+                    self.rng.random(size=(self.n_particles,)) < self.resample_proportion
+                )
+                self.resampled_particles = random_mask
+                self.init_filter(mask=random_mask)
+
+    def _resample(self):
+        """Replace the particles by a resampled set with uniform weights."""
+        if self.kld_bin_size is not None:
+            indices = self._kld_resample()
+            self.n_particles = len(indices)
+        else:
+            indices = self.resample_fn(
+                self.weights, **_rng_kwargs(self.resample_fn, self.rng, {})
             )
-            self.resampled_particles = random_mask
-            self.init_filter(mask=random_mask)
+        if self.in_place and len(indices) == len(self.particles):
+            # gather into the spare buffer, leaving original_particles intact
+            # (a set resized by KLD-sampling is gathered into a new array instead)
+            self.particles = np.take(
+                self.particles,
+                indices,
+                axis=0,
+                out=self._next_buffer("particles", self.particles),
+                mode="clip",
+            )
+            self.weights = self._next_buffer("weights", self.weights)
+            self.weights.fill(1.0 / self.n_particles)
+            if self.log_weight_fn is not None:
+                self.log_weights = self._next_buffer("log_weights", self.log_weights)
+                self.log_weights.fill(-np.log(self.n_particles))
+        else:
+            self.particles = self.particles[indices, :]
+            self.weights = np.ones(self.n_particles) / self.n_particles
+            if self.log_weight_fn is not None:
+                self.log_weights = np.log(self.weights)
+
@@ -0,0 +1,116 @@
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .rng import _rng_kwargs, make_rng
+
+# A pool of pre-drawn prior samples for replenishing particles (resample_proportion). Each
+# update replaces a small random fraction of the particles with fresh prior samples; drawing
+# them from prior_fn one update at a time pays its per-call overhead (for `independent_sample`,
+# one scipy `rvs` call per column) on every update, for only a handful of samples. The pool
+# instead draws `size` samples in one call, hands them out in order until they run out, and
+# then switches to the next batch. With background=True, the next batch is drawn on a helper
+# thread while the current one is being used (numpy releases the GIL in most of its random
+# samplers), so replenishment only copies rows out of a buffer. Samples are never handed out
+# twice.
+
+
+def _draw_batch(prior_fn, size, rng):
+    batch = np.asarray(prior_fn(size, **_rng_kwargs(prior_fn, rng, {})))
+    return batch.reshape(size, -1)
+
+
+def _shutdown(executor):
+    executor.shutdown(wait=True)
+
+
+class PriorPool(object):
+    """Buffer of samples from a prior, drawn in large batches and handed out a few at a time.
+
+    Parameters:
+    -----------
+        prior_fn : function(n) => states
+            draws an (n,D) array of samples from the prior, as for ParticleFilter
+        size : int
+            number of samples drawn in each batch
+        background : bool
+            if True, the next batch is drawn on a helper thread while the current one is used.
+            prior_fn must then be safe to call from another thread; it is, if it takes an `rng`
+            (which then has a Generator that only the pool uses), or uses the global np.random
+            state (which is locked, although the order of draws is then no longer reproducible).
+        rng : np.random.Generator, int or None
+            source of randomness passed to prior_fn if it takes an `rng` argument
+
+    The pool must be shut down with `close()` (or by using it as a context manager) when
+    background is True.
+    """
+
+    def __init__(self, prior_fn, size=4096, background=False, rng=None):
+        self.prior_fn = prior_fn
+        self.size = size
+        self.background = background
+        self.rng = make_rng(rng)
+        self.n_batches = 0
+        self._batch = None
+        self._position = 0
+        self._next = None
+        self._executor = None
+        if background:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._finalizer = weakref.finalize(self, _shutdown, self._executor)
+            self._next = self._executor.submit(_draw_batch, prior_fn, size, self.rng)
+
+    @property
+    def available(self):
+        """Number of samples left in the current batch."""
+        return 0 if self._batch is None else len(self._batch) - self._position
+
+    def _next_batch(self):
+        """Replace the current batch with the next one, and start drawing the one after."""
+        if self._next is None:
+            self._batch = _draw_batch(self.prior_fn, self.size, self.rng)
+        else:
+            self._batch = self._next.result()
+            self._next = self._executor.submit(
+                _draw_batch, self.prior_fn, self.size, self.rng
+            )
+        self._position = 0
+        self.n_batches += 1
+
+    def draw(self, n, out=None):
+        """Take the next n samples from the pool.
+        Parameters:
+        -----------
+            n : int
+                number of samples
+            out : array (n,D), optional
+                array to copy the samples into
+        Returns:
+        -------
+            samples : array (n,D)
+        """
+        if self._batch is None:
+            self._next_batch()
+        if out is None:
+            out = np.empty((n,) + self._batch.shape[1:], dtype=self._batch.dtype)
+        filled = 0
+        while filled < n:
+            if self.available == 0:
+                self._next_batch()
+            take = min(n - filled, self.available)
+            out[filled : filled + take] = self._batch[self._position : self._position + take]
+            self._position += take
+            filled += take
+        return out
+
+    def close(self):
+        """Stop the background thread, if there is one."""
+        if self._executor is not None:
+            self._finalizer()
+            self._next = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
@@ -0,0 +1,164 @@
+import time
+import tracemalloc
+import numpy as np
+
+# Per-stage profiling of ParticleFilter.update. The filter brackets each stage of an update
+# (dynamics, noise, observation, weighting, ...) with `StageProfiler.stage(name)`, and the
+# profiler adds the wall time (and optionally the bytes allocated) of the stage to the row of
+# a ring buffer that belongs to the current update, so the last `capacity` updates are kept.
+# A filter without a profiler skips all of this, at the cost of one attribute check per stage.
+
+STAGES = (
+    "dynamics",
+    "noise",
+    "internal_weight",
+    "observe",
+    "weight",
+    "normalise",
+    "summaries",
+    "transform",
+    "resample",
+    "replenish",
+    "update",
+)
+
+
+class _Stage(object):
+    """Context manager timing one stage; one instance per stage is reused for every update."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.column = STAGES.index(name)
+        # the stages nest inside "update", whose allocation peak they would reset
+        self.track_memory = profiler.track_memory and name != "update"
+
+    def __enter__(self):
+        if self.track_memory:
+            # the peak belongs to whoever started tracemalloc: only reset it if that was us
+            if self.profiler._owns_tracemalloc:
+                tracemalloc.reset_peak()
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        allocated = None
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.profiler._owns_tracemalloc:
+                allocated = peak - self.start_bytes
+            else:
+                allocated = max(current - self.start_bytes, 0)
+        self.profiler._record(self.name, self.column, elapsed, allocated)
+        return False
+
+
+class StageProfiler(object):
+    """Records the wall time spent in each stage of the last `capacity` updates of a filter.
+
+    Parameters:
+    -----------
+        capacity : int
+            number of updates kept in the ring buffer
+        track_memory : bool
+            if True, also record the peak number of bytes allocated within each stage, using
+            tracemalloc (which is started if it is not running). This slows the filter down
+            considerably, so is for diagnosis rather than for monitoring. If tracemalloc was
+            already running (e.g. in a memory profiling session of your own), its peak is left
+            alone, and the net number of bytes each stage leaves allocated is recorded instead.
+        callbacks : list of functions(stage, seconds, allocated_bytes)
+            called at the end of every stage (allocated_bytes is None unless track_memory is set),
+            e.g. to log when a stage overruns its share of a frame budget.
+
+    Stages (see `STAGES`), in the order update runs them:
+        dynamics, noise : dynamics_fn and noise_fn
+        internal_weight : internal_weight_fn
+        observe, weight : observe_fn and weight_fn (or log_weight_fn); with n_workers, the
+                          workers run both for each shard, so their combined wall time is recorded
+                          as observe and weight stays at zero
+        normalise       : combining and normalising the weights, and n_eff
+        summaries       : mean_state, cov_state, ... (computed when first read, so the time is
+                          added to the update they summarise)
+        transform       : transform_fn
+        resample        : resample_fn and gathering the resampled particles
+        replenish       : drawing from the prior for resample_proportion
+        update          : the whole update (excluding summaries read afterwards); no allocated
+                          bytes are recorded for it
+    """
+
+    def __init__(self, capacity=1000, track_memory=False, callbacks=None):
+        self.capacity = capacity
+        self.track_memory = track_memory
+        self.callbacks = list(callbacks or [])
+        self.times = np.zeros((capacity, len(STAGES)))
+        self.allocated = np.zeros((capacity, len(STAGES)), dtype=np.int64)
+        self.n_updates = 0
+        self._row = 0
+        self._stages = {name: _Stage(self, name) for name in STAGES}
+        self._owns_tracemalloc = False
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+
+    def stage(self, name):
+        """Context manager recording the time spent in the named stage of the current update."""
+        return self._stages[name]
+
+    def begin_update(self):
+        """Start a new row of the ring buffer, overwriting the oldest update if it is full."""
+        self._row = self.n_updates % self.capacity
+        self.n_updates += 1
+        self.times[self._row] = 0.0
+        self.allocated[self._row] = 0
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _record(self, name, column, seconds, allocated):
+        self.times[self._row, column] += seconds
+        if allocated is not None:
+            self.allocated[self._row, column] += allocated
+        for callback in self.callbacks:
+            callback(name, seconds, allocated)
+
+    def _chronological(self, array):
+        """The rows of the ring buffer that hold updates, oldest first."""
+        if self.n_updates <= self.capacity:
+            return array[: self.n_updates]
+        return np.roll(array, -(self._row + 1), axis=0)
+
+    def history(self, stage, memory=False):
+        """The time (or allocated bytes) of the given stage in each recorded update, oldest first."""
+        array = self.allocated if memory else self.times
+        return self._chronological(array)[:, STAGES.index(stage)]
+
+    def percentiles(self, q=(50, 90, 99), memory=False):
+        """Percentiles of the time (in seconds), or allocated bytes if memory is True, of each
+        stage over the recorded updates.
+        Parameters:
+        -----------
+            q : sequence of floats
+                percentiles to compute, in [0, 100]
+            memory : bool
+                summarise the allocated bytes (requires track_memory) rather than the times
+        Returns:
+        -------
+            percentiles : dict
+                {stage: array of len(q)} for every stage; empty if nothing was recorded
+        """
+        if memory and not self.track_memory:
+            raise ValueError("memory percentiles need a profiler created with track_memory=True")
+        rows = self._chronological(self.allocated if memory else self.times)
+        if len(rows) == 0:
+            return {}
+        values = np.percentile(rows, q, axis=0)
+        return {name: values[:, i] for i, name in enumerate(STAGES)}
+
+    def reset(self):
+        """Discard all recorded updates."""
+        self.n_updates = 0
+        self._row = 0
+        self.times[:] = 0.0
+        self.allocated[:] = 0
@@ -0,0 +1,41 @@
+import numpy as np
+
+# Image pyramids for coarse-to-fine weighting (the pyramid_levels option of ParticleFilter).
+# Most particles of an image tracker are far from the target, and a comparison at a fraction of
+# the resolution is enough to tell. Level 0 of a pyramid is the image itself, and each level
+# above it averages factor x factor blocks of the one below (any rows or columns left over
+# at the bottom and right edges are dropped), so that every coarse pixel is the mean of the
+# fine pixels it covers. An observe_fn that takes a `scale` argument renders its hypotheses
+# directly at a coarse level (e.g. a disk of radius r at (x, y) becomes one of radius r / s
+# at (x / s, y / s) in an image 1/s the size); otherwise its full resolution hypotheses are
+# downsampled in the same way as the observation.
+
+
+def downsample(images, factor):
+    """Average factor x factor blocks of pixels over the last two axes of images."""
+    images = np.asarray(images)
+    if factor == 1:
+        return images
+    height, width = images.shape[-2] // factor, images.shape[-1] // factor
+    if height == 0 or width == 0:
+        raise ValueError(
+            "cannot downsample {} images by {}".format(images.shape[-2:], factor)
+        )
+    blocks = images[..., : height * factor, : width * factor].reshape(
+        images.shape[:-2] + (height, factor, width, factor)
+    )
+    return blocks.mean(axis=(-3, -1), dtype=np.result_type(images.dtype, np.float32))
+
+
+def pyramid_scales(levels, factor=2):
+    """Downsampling factor of each level, coarsest first: factor**(levels-1), ..., factor, 1."""
+    return [factor ** level for level in reversed(range(levels))]
+
+
+def image_pyramid(image, levels, factor=2):
+    """The image at each of the pyramid_scales, coarsest first (the last is image itself).
+    Each level is computed from the one below it."""
+    pyramid = [np.asarray(image)]
+    for _ in range(levels - 1):
+        pyramid.append(downsample(pyramid[-1], factor))
+    return pyramid[::-1]
@@ -0,0 +1,224 @@
+from statistics import NormalDist
+import numpy as np
+
+# Vectorized resampling functions. Each takes an N-element vector of normalised weights and
+# returns an N-element integer array of particle indices. Every resampler builds a single
+# cumulative sum and locates its sample positions with `np.searchsorted`, so the cost is
+# O(N log N) with no per-particle Python loop. The original loop-based implementations are
+# kept in `pfilter.reference` for equivalence testing. The random resamplers take an optional
+# `rng` (a np.random.Generator); if it is None they use the global np.random state.
+
+
+def _cumulative_weights(weights):
+    """Cumulative sum of the weights, with the final entry pinned to exactly 1.0 so that
+    positions in [0, 1) can never fall off the end due to rounding."""
+    cumsum = np.cumsum(weights)
+    cumsum[-1] = 1.0
+    return cumsum
+
+
+def create_indices(positions, weights):
+    """Map sorted positions in [0, 1) to the indices of the weights whose
+    cumulative interval contains them.
+    Parameters:
+    -----------
+        positions : array
+            N-element sorted vector of positions in [0, 1)
+        weights : array
+            N-element vector of normalised weights
+    Returns:
+    -------
+        indices : array
+            N-element integer array of selected particle indices
+    """
+    cumsum = _cumulative_weights(weights)
+    indices = np.searchsorted(cumsum, positions, side="right")
+    return np.minimum(indices, len(weights) - 1)
+
+
+def systematic_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = (np.arange(n) + rng.uniform(0, 1)) / n
+    return create_indices(positions, weights)
+
+
+def stratified_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = (rng.uniform(0, 1, n) + np.arange(n)) / n
+    return create_indices(positions, weights)
+
+
+def residual_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    scaled = n * np.asarray(weights)
+    # take int(N*w) copies of each weight
+    num_copies = np.floor(scaled).astype(np.intp)
+    indices = np.repeat(np.arange(n), num_copies)[:n]
+    k = len(indices)
+    if k == n:
+        return indices
+    # use multinomial resample on the residual to fill up the rest.
+    residual = scaled - num_copies  # get fractional part
+    cumsum = np.cumsum(residual)
+    cumsum /= cumsum[-1]
+    cumsum[-1] = 1.0
+    fill = np.searchsorted(cumsum, rng.uniform(0, 1, n - k), side="right")
+    return np.concatenate([indices, np.minimum(fill, n - 1)])
+
+
+def multinomial_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    positions = np.sort(rng.uniform(0, 1, n))
+    return create_indices(positions, weights)
+
+
+# resample function from http://scipy-cookbook.readthedocs.io/items/ParticleFilter.html
+def resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    n = len(weights)
+    u0 = rng.random()
+    positions = (u0 + np.arange(n)) / n
+    cumsum = _cumulative_weights(weights)
+    indices = np.searchsorted(cumsum, positions, side="left")
+    return np.minimum(indices, n - 1)
+
+
+# Batched resampling, for a bank of K independent filters. Each takes a (K,N) array of
+# weights (each row normalised) and returns a (K,N) array of row-local particle indices.
+# All K filters are resampled with a single searchsorted: offsetting row k of both the
+# cumulative weights and the positions by k makes the flattened arrays globally sorted.
+
+
+def batch_create_indices(positions, weights, side="right"):
+    """Row-wise version of `create_indices`.
+    Parameters:
+    -----------
+        positions : array
+            (K,N) array of positions in [0, 1), each row sorted
+        weights : array
+            (K,N) array of weights, each row normalised
+        side : "right" or "left"
+            whether a position exactly on a cumulative boundary selects the next particle
+            ("right", as in `create_indices`) or the previous one ("left", as in `resample`)
+    Returns:
+    -------
+        indices : array
+            (K,N) integer array of selected particle indices within each row
+    """
+    k, n = weights.shape
+    cumsum = np.cumsum(weights, axis=1)
+    cumsum[:, -1] = 1.0
+    offsets = np.arange(k)[:, None]
+    flat = np.searchsorted(
+        (cumsum + offsets).ravel(), (positions + offsets).ravel(), side=side
+    ).reshape(k, n)
+    # clip, as a position on a row boundary can land on the last entry of the previous row
+    return np.clip(flat - offsets * n, 0, n - 1)
+
+
+def batch_systematic_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    k, n = weights.shape
+    positions = (np.arange(n) + rng.uniform(0, 1, (k, 1))) / n
+    return batch_create_indices(positions, weights)
+
+
+def batch_stratified_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    k, n = weights.shape
+    positions = (rng.uniform(0, 1, (k, n)) + np.arange(n)) / n
+    return batch_create_indices(positions, weights)
+
+
+def batch_multinomial_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    positions = np.sort(rng.uniform(0, 1, weights.shape), axis=1)
+    return batch_create_indices(positions, weights)
+
+
+def batch_resample(weights, rng=None):
+    rng = np.random if rng is None else rng
+    k, n = weights.shape
+    positions = (rng.random((k, 1)) + np.arange(n)) / n
+    return batch_create_indices(positions, weights, side="left")
+
+
+# KLD-sampling (Fox, "Adapting the sample size in particle filters through KLD-sampling", 2003):
+# the number of particles is chosen so that, with probability 1 - delta, the KL divergence
+# between the sample-based posterior and the true posterior is below epsilon, where the
+# posterior is approximated by a histogram over bins of the state space. The more bins the
+# samples occupy, the more particles are needed.
+
+
+def kld_bound(k, epsilon=0.05, delta=0.01):
+    """Number of samples needed when they occupy k bins, from the Wilson-Hilferty
+    approximation of the chi-square quantile. k may be an array; k <= 1 needs no samples.
+    Parameters:
+    -----------
+        k : int or array
+            number of occupied bins
+        epsilon : float
+            bound on the KL divergence between the sample and the true posterior
+        delta : float
+            probability that the bound is exceeded
+    Returns:
+    -------
+        n : float or array
+            required number of samples
+    """
+    z = NormalDist().inv_cdf(1.0 - delta)
+    dof = np.maximum(np.asarray(k, dtype=float) - 1.0, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = 2.0 / (9.0 * dof)
+        n = dof / (2.0 * epsilon) * (1.0 - a + np.sqrt(a) * z) ** 3
+    return np.where(dof > 0, n, 0.0)
+
+
+def state_bins(states, bin_size):
+    """Index of the histogram bin each state falls in, for counting occupied bins.
+    Parameters:
+    -----------
+        states : array
+            (N,D) array of states
+        bin_size : float or array
+            width of the bins, either for all state columns or as a D-element vector
+    Returns:
+    -------
+        bins : array
+            N-element integer array; states in the same bin have the same index
+    """
+    cells = np.floor(np.asarray(states) / bin_size).astype(np.int64)
+    return np.unique(cells, axis=0, return_inverse=True)[1].reshape(-1)
+
+
+def kld_sample_size(bins, epsilon=0.05, delta=0.01, min_n=1, max_n=None):
+    """Number of the given draws to keep: the length of the shortest prefix (of at least min_n
+    draws) that is at least as long as the KLD bound for the bins it occupies, so the draws
+    should be in random order.
+    Parameters:
+    -----------
+        bins : array
+            M-element integer array, the bin of each posterior draw (see `state_bins`)
+        epsilon, delta : float
+            as for `kld_bound`
+        min_n, max_n : int
+            bounds on the sample size (max_n defaults to M)
+    Returns:
+    -------
+        n : int
+            number of draws to keep, in [min_n, max_n]; M if no prefix satisfies the bound
+    """
+    m = len(bins)
+    max_n = m if max_n is None else max_n
+    # number of distinct bins in each prefix of the draws
+    first = np.zeros(m, dtype=np.intp)
+    first[np.unique(bins, return_index=True)[1]] = 1
+    occupied = np.cumsum(first)
+    sizes = np.arange(1, m + 1)
+    satisfied = (sizes >= min_n) & (sizes >= kld_bound(occupied, epsilon, delta))
+    n = np.argmax(satisfied) + 1 if np.any(satisfied) else m
+    return int(np.clip(n, min_n, max_n))
@@ -0,0 +1,90 @@
+import inspect
+import weakref
+import numpy as np
+
+
+def make_rng(seed=None):
+    """Create a `np.random.Generator` (PCG64) from a seed.
+    Parameters:
+    -----------
+        seed : None, int, array of ints, SeedSequence or Generator
+            None draws fresh entropy from the OS; a Generator is returned unchanged.
+    """
+    return np.random.default_rng(seed)
+
+
+def _seed_sequence(rng):
+    """The SeedSequence a Generator was created from, used to derive child streams."""
+    bit_generator = rng.bit_generator
+    seed_seq = getattr(bit_generator, "seed_seq", None)  # public from numpy 1.25
+    if seed_seq is None:
+        seed_seq = bit_generator._seed_seq
+    return seed_seq
+
+
+def spawn_rngs(rng, n):
+    """Split a random stream into n statistically independent child Generators,
+    e.g. one per filter when running filters in parallel threads or processes.
+    The children use the same bit generator type as the parent (PCG64, Philox, ...), and
+    spawning is deterministic: the same parent seed always gives the same children.
+    Parameters:
+    -----------
+        rng : Generator, or anything accepted by `make_rng`
+            the parent stream (or the seed to create it from)
+        n : int
+            number of child streams
+    Returns:
+    -------
+        rngs: list of n Generators
+    """
+    rng = make_rng(rng)
+    bit_generator_type = type(rng.bit_generator)
+    return [
+        np.random.Generator(bit_generator_type(child))
+        for child in _seed_sequence(rng).spawn(n)
+    ]
+
+
+def _has_keyword(fn, name):
+    """True if fn has an explicit parameter called name (a **kwargs catch-all does not count)."""
+    try:
+        parameters = inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return False
+    parameter = parameters.get(name)
+    return parameter is not None and parameter.kind in (
+        inspect.Parameter.POSITIONAL_OR_KEYWORD,
+        inspect.Parameter.KEYWORD_ONLY,
+    )
+
+
+# signature inspection is slow, and the same functions are checked on every update. The
+# results are keyed weakly (on the function of a bound method), so that caching them does not
+# keep the model functions, or the filters and models they are bound to, alive.
+_keyword_cache = weakref.WeakKeyDictionary()
+
+
+def _accepts_keyword(fn, name):
+    key = getattr(fn, "__func__", fn)
+    try:
+        found = _keyword_cache.get(key)
+        if found is None:
+            found = _keyword_cache[key] = {}
+    except TypeError:  # not weakly referenceable (or unhashable)
+        return _has_keyword(fn, name)
+    if name not in found:
+        found[name] = _has_keyword(fn, name)
+    return found[name]
+
+
+def _accepts_rng(fn):
+    """True if fn takes an explicit `rng` parameter, so the filter's Generator can be passed to it."""
+    return _accepts_keyword(fn, "rng")
+
+
+def _rng_kwargs(fn, rng, kwargs):
+    """The keyword arguments for a call to fn, with rng added if fn accepts it
+    (an explicit `rng` in kwargs takes precedence)."""
+    if _accepts_rng(fn):
+        return {"rng": rng, **kwargs}
+    return kwargs
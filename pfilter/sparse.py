@@ -0,0 +1,71 @@
+import numpy as np
+
+# Observations with missing values (e.g. camera frames with occluded regions). Rather than
+# carrying a mask through every comparison (numpy.ma is many times slower than plain numpy,
+# even where nothing is masked), a partial observation is converted once per frame into the
+# flat indices of its valid values and a plain array of those values. The filter then
+# compares only those values: the hypotheses are gathered at the indices before weight_fn sees
+# them, or, if observe_fn accepts an `indices` argument, observe_fn computes just those
+# values in the first place. weight_fn receives plain arrays either way.
+
+
+class SparseObservation(object):
+    """An observation of some of the values of a sensor output.
+
+    Parameters:
+    -----------
+        indices : int array (K,)
+            flat indices (into the flattened sensor output) of the observed values
+        values : array (K,)
+            the observed values
+        shape : tuple, optional
+            shape of the full sensor output (e.g. (H,W) for an image)
+    """
+
+    def __init__(self, indices, values, shape=None):
+        self.indices = np.asarray(indices, dtype=np.intp).ravel()
+        self.values = np.asarray(values).ravel()
+        if len(self.indices) != len(self.values):
+            raise ValueError(
+                "{} indices for {} values".format(len(self.indices), len(self.values))
+            )
+        self.shape = shape
+
+    @classmethod
+    def from_mask(cls, observed, valid):
+        """The values of observed where the boolean array valid is True."""
+        observed = np.asarray(observed)
+        indices = np.flatnonzero(np.asarray(valid, dtype=bool))
+        return cls(indices, observed.ravel()[indices], observed.shape)
+
+    @classmethod
+    def from_masked(cls, observed):
+        """The unmasked values of a numpy masked array."""
+        return cls.from_mask(np.ma.getdata(observed), ~np.ma.getmaskarray(observed))
+
+    def __len__(self):
+        return len(self.values)
+
+    def dense(self, fill=np.nan):
+        """The full sensor output, with fill in place of the missing values."""
+        if self.shape is None:
+            raise ValueError("the shape of the full observation is not known")
+        full = np.full(
+            int(np.prod(self.shape)), fill, dtype=np.result_type(self.values, fill)
+        )
+        full[self.indices] = self.values
+        return full.reshape(self.shape)
+
+
+def _split_observation(observed):
+    """The plain array of observed values, and the SparseObservation it came from (None for
+    a complete observation). Masked arrays become sparse observations, unless nothing in
+    them is masked."""
+    if isinstance(observed, SparseObservation):
+        return observed.values, observed
+    if isinstance(observed, np.ma.MaskedArray):
+        if not np.ma.is_masked(observed):
+            return np.ma.getdata(observed), None
+        sparse = SparseObservation.from_masked(observed)
+        return sparse.values, sparse
+    return observed, None
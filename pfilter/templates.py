@@ -0,0 +1,227 @@
+from collections import OrderedDict
+import numpy as np
+
+# Cached rasterisation of circular sprites (filled disks, cones and outlines) and a vectorized
+# routine that stamps many of them into a stack of images at once. Observation models and
+# renderers draw the same few shapes for every particle on every frame; a template holds the
+# pixel offsets (and values) of one shape for one radius and one sub-pixel position of the
+# centre, so it is computed once and reused. Radii and centres are quantised (by default to
+# 1/8 pixel) to keep the number of distinct templates small, and the cache evicts the least
+# recently used templates beyond maxsize.
+#
+# Template kinds, for a centre c and radius R (d is the distance of a pixel centre from c):
+#     disk      : d < R, value 1 (pixels strictly inside the circle, as skimage.draw.disk)
+#     cone      : d <= R, value 1 - d / R (a disk fading out towards its edge)
+#     ring      : R - 1 <= d <= R, value 1 (a circle outline one pixel wide, inclusive)
+#     perimeter : round(d) == round(R), value 1 (a thin outline, like skimage.draw.circle_perimeter)
+
+
+def _disk(d, radius):
+    return d < radius, np.ones_like(d)
+
+
+def _cone(d, radius):
+    if radius <= 0:
+        return np.zeros(d.shape, dtype=bool), d
+    return d <= radius, 1.0 - d / radius
+
+
+def _ring(d, radius):
+    return (d >= radius - 1) & (d <= radius), np.ones_like(d)
+
+
+def _perimeter(d, radius):
+    return np.round(d) == np.round(radius), np.ones_like(d)
+
+
+TEMPLATE_KINDS = {"disk": _disk, "cone": _cone, "ring": _ring, "perimeter": _perimeter}
+
+
+class TemplateCache(object):
+    """LRU cache of rasterised circular templates.
+
+    Parameters:
+    -----------
+        maxsize : int
+            number of templates kept; the least recently used are evicted beyond this
+        radius_step : float
+            radii are rounded to a multiple of this
+        subpixel : int
+            centres are rounded to 1/subpixel of a pixel (1 puts every centre on a pixel)
+
+    Attributes:
+    -----------
+        hits, misses : int
+            number of template lookups served from the cache, and computed
+    """
+
+    def __init__(self, maxsize=2048, radius_step=0.125, subpixel=8):
+        self.maxsize = maxsize
+        self.radius_step = radius_step
+        self.subpixel = subpixel
+        self._templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantise_position(self, positions):
+        """Split positions into the integer pixel the template is anchored at and the
+        quantised sub-pixel phase (an integer in [0, subpixel))."""
+        steps = np.round(np.asarray(positions, dtype=float) * self.subpixel).astype(np.intp)
+        return steps // self.subpixel, steps % self.subpixel
+
+    def quantise_radius(self, radii):
+        return np.round(np.asarray(radii, dtype=float) / self.radius_step).astype(np.intp)
+
+    def _lookup(self, kind, radius_key, phase_row, phase_col):
+        key = (kind, int(radius_key), int(phase_row), int(phase_col))
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            self.hits += 1
+            return template
+        self.misses += 1
+        template = self._rasterise(kind, *key[1:])
+        self._templates[key] = template
+        if len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+        return template
+
+    def _rasterise(self, kind, radius_key, phase_row, phase_col):
+        radius = radius_key * self.radius_step
+        reach = int(np.ceil(max(radius, 0))) + 1
+        offsets = np.arange(-reach, reach + 1)
+        d_rows, d_cols = np.meshgrid(offsets, offsets, indexing="ij")
+        d = np.hypot(
+            d_rows - phase_row / self.subpixel, d_cols - phase_col / self.subpixel
+        )
+        inside, values = TEMPLATE_KINDS[kind](d, radius)
+        return d_rows[inside], d_cols[inside], values[inside]
+
+    def template(self, kind, radius, centre_row=0.0, centre_col=0.0):
+        """The pixels of one template, relative to the pixel it is anchored at.
+        Parameters:
+        -----------
+            kind : str
+                one of TEMPLATE_KINDS
+            radius : float
+                radius of the shape
+            centre_row, centre_col : float
+                position of the centre; only its sub-pixel part matters
+        Returns:
+        -------
+            d_rows, d_cols : int arrays
+                offsets of the template's pixels from its anchor pixel
+            values : float array
+                the template's value at each pixel
+        """
+        _, phase_row = self.quantise_position(centre_row)
+        _, phase_col = self.quantise_position(centre_col)
+        return self._lookup(kind, self.quantise_radius(radius), phase_row, phase_col)
+
+    def clear(self):
+        self._templates.clear()
+        self.hits = self.misses = 0
+
+
+# shared by every stamp call that is not given a cache of its own
+default_cache = TemplateCache()
+
+
+def stamp(
+    images,
+    rows,
+    cols,
+    radii,
+    kind="disk",
+    index=None,
+    weights=None,
+    mode="set",
+    edge="drop",
+    cache=None,
+):
+    """Draw N circular templates into a stack of images, in place.
+    Parameters:
+    -----------
+        images : array (M,H,W)
+            images to draw into (e.g. M=N hypothesis images, or a single image as images[None])
+        rows, cols, radii : array (N,)
+            centre and radius of each template (scalars broadcast)
+        kind : str
+            template shape, one of TEMPLATE_KINDS ("disk", "cone", "ring", "perimeter")
+        index : array (N,), optional
+            the image each template is drawn into; defaults to template i into image i
+        weights : float or array (N,), optional
+            factor applied to the values of each template (e.g. a per-particle intensity)
+        mode : "set", "max" or "add"
+            whether drawn pixels are overwritten with the template value, keep the maximum
+            of the two, or accumulate (overlapping templates combine in the same way)
+        edge : "drop" or "clip"
+            pixels outside the image are dropped, or moved onto the nearest edge pixel
+        cache : TemplateCache, optional
+            template cache to use (default: the shared `default_cache`)
+    Returns:
+    -------
+        images : the same array, drawn into
+    """
+    cache = default_cache if cache is None else cache
+    rows, cols, radii = np.broadcast_arrays(
+        np.ravel(rows), np.ravel(cols), np.ravel(radii)
+    )
+    n = len(rows)
+    if n == 0:
+        return images
+    index = np.arange(n) if index is None else np.broadcast_to(index, (n,))
+    if weights is not None:
+        weights = np.broadcast_to(weights, (n,))
+    height, width = images.shape[1:3]
+
+    anchor_rows, phase_rows = cache.quantise_position(rows)
+    anchor_cols, phase_cols = cache.quantise_position(cols)
+    keys = np.column_stack([cache.quantise_radius(radii), phase_rows, phase_cols])
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(unique_keys) + 1))
+
+    # gather the pixels of every template, one group of identical templates at a time
+    target_images, target_rows, target_cols, target_values = [], [], [], []
+    for k, (radius_key, phase_row, phase_col) in enumerate(unique_keys):
+        members = order[bounds[k] : bounds[k + 1]]
+        d_rows, d_cols, values = cache._lookup(kind, radius_key, phase_row, phase_col)
+        target_images.append(np.repeat(index[members], len(values)))
+        target_rows.append((anchor_rows[members, None] + d_rows).ravel())
+        target_cols.append((anchor_cols[members, None] + d_cols).ravel())
+        if weights is None:
+            target_values.append(np.tile(values, len(members)))
+        else:
+            target_values.append((weights[members, None] * values).ravel())
+    target_images = np.concatenate(target_images)
+    target_rows = np.concatenate(target_rows)
+    target_cols = np.concatenate(target_cols)
+    target_values = np.concatenate(target_values)
+
+    if edge == "clip":
+        np.clip(target_rows, 0, height - 1, out=target_rows)
+        np.clip(target_cols, 0, width - 1, out=target_cols)
+    else:
+        inside = (
+            (target_rows >= 0)
+            & (target_rows < height)
+            & (target_cols >= 0)
+            & (target_cols < width)
+        )
+        target_images = target_images[inside]
+        target_rows = target_rows[inside]
+        target_cols = target_cols[inside]
+        target_values = target_values[inside]
+
+    where = (target_images, target_rows, target_cols)
+    if mode == "set":
+        images[where] = target_values
+    elif mode == "max":
+        np.maximum.at(images, where, target_values)
+    elif mode == "add":
+        np.add.at(images, where, target_values)
+    else:
+        raise ValueError("Unknown stamp mode {}; expected set, max or add".format(mode))
+    return images
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from pfilter import ParticleFilter, ParticleFilterBank, log_squared_error, squared_error
+
+# A bank of K filters weights each filter's particles exactly as a ParticleFilter given the
+# same particles and observation would.
+
+K, N, D = 3, 150, 2
+
+
+def prior(n, rng=None):
+    return rng.normal(0, 2, size=(n, D))
+
+
+def observe(x):
+    return np.concatenate([x, x ** 2], axis=-1)
+
+
+def dynamics(x):
+    return 0.9 * x + 0.1
+
+
+def filters(log_domain):
+    weights = dict(log_weight_fn=log_squared_error) if log_domain else dict(weight_fn=squared_error)
+    options = dict(observe_fn=observe, n_particles=N, dynamics_fn=dynamics, n_eff_threshold=0.0)
+    options.update(weights)
+    bank = ParticleFilterBank(prior, K, rng=0, **options)
+    singles = []
+    for k in range(K):
+        pf = ParticleFilter(prior_fn=prior, rng=k, **options)
+        pf.particles = bank.particles[k].copy()
+        singles.append(pf)
+    return bank, singles
+
+
+@pytest.mark.parametrize("log_domain", [False, True])
+def test_bank_matches_separate_filters(log_domain):
+    bank, singles = filters(log_domain)
+    targets = np.array([[0.5, -0.5], [1.0, 1.0], [-1.0, 0.0]])
+    for step in range(4):
+        observed = observe(targets + 0.1 * step)
+        bank.update(observed)
+        for k, pf in enumerate(singles):
+            pf.update(observed[k])
+            np.testing.assert_allclose(bank.weights[k], pf.weights)
+            np.testing.assert_allclose(bank.particles[k], pf.particles)
+            np.testing.assert_allclose(bank.mean_state[k], pf.mean_state)
+            np.testing.assert_allclose(bank.n_eff[k], pf.n_eff)
+
+
+def test_bank_shapes():
+    bank = ParticleFilterBank(prior, K, observe_fn=observe, n_particles=N, rng=0)
+    bank.update(observe(np.zeros((K, D))))
+    assert bank.particles.shape == (K, N, D)
+    assert bank.weights.shape == (K, N)
+    assert bank.hypotheses.shape == (K, N, 2 * D)
+    np.testing.assert_allclose(bank.weights.sum(axis=1), 1.0)
@@ -0,0 +1,171 @@
+import functools
+import warnings
+import numpy as np
+import pytest
+from pfilter import ParticleFilter, collision, compiled, reference, resampling
+
+# The compiled kernels against the NumPy implementations (and the loop-based references):
+# both draw the same random numbers, so they must agree exactly (noise up to rounding).
+# Without Numba the kernels run as plain Python, which checks the same code.
+
+RESAMPLERS = [
+    "systematic_resample",
+    "stratified_resample",
+    "residual_resample",
+    "multinomial_resample",
+    "resample",
+]
+NOISE = ["gaussian_noise", "t_noise", "cauchy_noise"]
+
+
+def weights(n, seed=0):
+    return np.random.default_rng(seed).dirichlet(np.full(n, 0.3))
+
+
+@pytest.mark.parametrize("n", [1, 7, 100, 1001])
+@pytest.mark.parametrize("name", RESAMPLERS)
+def test_resamplers_match_numpy(name, n):
+    numpy_fn, compiled_fn = compiled._IMPLEMENTATIONS[name]
+    w = weights(n, n)
+    np.testing.assert_array_equal(
+        compiled_fn(w, rng=np.random.default_rng(7)), numpy_fn(w, rng=np.random.default_rng(7))
+    )
+
+
+@pytest.mark.parametrize("name", ["systematic_resample", "stratified_resample", "resample"])
+def test_resamplers_match_reference(name):
+    w = weights(200, 3)
+    np.random.seed(11)
+    expected = np.asarray(getattr(reference, name)(w))
+    np.random.seed(11)
+    np.testing.assert_array_equal(compiled._IMPLEMENTATIONS[name][1](w), expected)
+
+
+def test_create_indices_matches_reference():
+    w = weights(500, 5)
+    positions = np.sort(np.random.default_rng(5).uniform(0, 1, 500))
+    expected = reference.create_indices(positions, w)
+    np.testing.assert_array_equal(compiled._IMPLEMENTATIONS["create_indices"][1](positions, w), expected)
+    np.testing.assert_array_equal(resampling.create_indices(positions, w), expected)
+
+
+def test_create_indices_on_boundaries():
+    w = np.full(4, 0.25)
+    positions = np.array([0.0, 0.25, 0.5, 0.75])
+    np.testing.assert_array_equal(
+        compiled._create_indices(positions, w), resampling.create_indices(positions, w)
+    )
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("name", NOISE)
+def test_noise_matches_numpy(name, dtype):
+    numpy_fn, compiled_fn = compiled._IMPLEMENTATIONS[name]
+    x = np.random.default_rng(0).random((50, 3)).astype(dtype)
+    expected = numpy_fn(x, [1, 2, 3], rng=np.random.default_rng(7))
+    actual = compiled_fn(x, [1, 2, 3], rng=np.random.default_rng(7))
+    assert actual.dtype == expected.dtype
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+    out = np.empty_like(x)
+    compiled_fn(x, [1, 2, 3], rng=np.random.default_rng(7), out=out)
+    np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+
+def collision_map():
+    walls = collision.CollisionMap((60, 60))
+    walls.add_line(10, 10, 50, 40, 2)
+    walls.add_line(30, 0, 30, 59, 1)
+    return walls
+
+
+def states(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack(
+        [
+            rng.uniform(-2, 62, n),
+            rng.uniform(-2, 62, n),
+            rng.uniform(0, 6, n),
+            rng.normal(0, 2, n),
+            rng.normal(0, 2, n),
+            rng.normal(0, 1, n),
+        ]
+    )
+
+
+def test_collision_dynamics_matches_numpy():
+    walls = collision_map()
+    x = states(3000)
+    expected = collision.collision_dynamics(x, walls)
+    np.testing.assert_array_equal(compiled._collision_dynamics(x, walls), expected)
+    # some particles must actually have bounced for the test to mean anything
+    assert np.any(expected[:, 0] != x[:, 0] + x[:, 3])
+
+
+def test_collision_dynamics_grows_the_map():
+    x = states(500, 1)
+    x[0, 2] = 20.4
+    np.testing.assert_array_equal(
+        compiled._collision_dynamics(x, collision_map(), min_radius=0.5),
+        collision.collision_dynamics(x, collision_map(), min_radius=0.5),
+    )
+
+
+def test_backend_function_swaps_partials():
+    noise = functools.partial(compiled._IMPLEMENTATIONS["gaussian_noise"][0], sigmas=[1])
+    assert compiled.backend_function(noise, "numpy").func is noise.func
+    if compiled.HAVE_NUMBA:
+        assert compiled.backend_function(noise, "numba").func is compiled._gaussian_noise
+    with pytest.raises(ValueError):
+        compiled.resolve_backend("cuda")
+
+
+def test_numba_backend_falls_back_without_numba():
+    if compiled.HAVE_NUMBA:
+        pytest.skip("numba is installed")
+    with pytest.warns(RuntimeWarning):
+        pf = ParticleFilter(prior_fn=lambda n: np.zeros((n, 2)), backend="numba")
+    assert pf.backend == "numpy"
+
+
+def run_filter(backend, steps=5):
+    walls = collision_map()
+    pf = ParticleFilter(
+        prior_fn=lambda n, rng=None: states(n, 3),
+        n_particles=500,
+        dynamics_fn=functools.partial(collision.collision_dynamics, collision_map=walls),
+        noise_fn=functools.partial(
+            compiled._IMPLEMENTATIONS["gaussian_noise"][0], sigmas=[0.5, 0.5, 0.1, 0.1, 0.1, 0.1]
+        ),
+        resample_fn=resampling.systematic_resample,
+        observe_fn=lambda x: x[:, :2],
+        resample_proportion=0.05,
+        rng=0,
+        backend=backend,
+    )
+    for _ in range(steps):
+        pf.update(np.array([30.0, 20.0]))
+    return pf
+
+
+def test_filter_numba_backend_matches_numpy():
+    pytest.importorskip("numba")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        fast = run_filter("numba")
+    assert fast.backend == "numba"
+    reference_run = run_filter("numpy")
+    np.testing.assert_allclose(fast.particles, reference_run.particles, rtol=1e-10)
+    np.testing.assert_allclose(fast.weights, reference_run.weights, rtol=1e-10)
+
+
+def test_filter_backend_swap_matches_numpy(monkeypatch):
+    # pretend Numba is installed, so the filter swaps in the (uncompiled) kernels
+    monkeypatch.setattr(compiled, "HAVE_NUMBA", True)
+    swapped = run_filter("numba", steps=2)
+    assert swapped.backend == "numba"
+    assert swapped.dynamics_fn.func is compiled._collision_dynamics
+    assert swapped.noise_fn.func is compiled._gaussian_noise
+    assert swapped.resample_fn is compiled._systematic_resample
+    reference_run = run_filter("numpy", steps=2)
+    np.testing.assert_allclose(swapped.particles, reference_run.particles, rtol=1e-10)
+    np.testing.assert_allclose(swapped.weights, reference_run.weights, rtol=1e-10)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from pfilter import DiskLikelihood, ParticleFilter, log_squared_error
+from pfilter import disk
+
+
+def prior(n, rng=None):
+    return np.column_stack([rng.uniform(0, 50, (n, 2)), rng.uniform(2, 8, n)])
+
+
+def test_matches_rendered_squared_error():
+    model = DiskLikelihood((50, 50), sigma=2)
+    frame = model.render(np.array([[20.0, 25.0, 6.0]]))[0]
+    x = prior(300, np.random.default_rng(0))
+    expected = log_squared_error(
+        model.render(x).reshape(len(x), -1), frame.reshape(1, -1), sigma=2
+    )
+    np.testing.assert_allclose(model.log_weight(model.observe(x), frame.reshape(1, -1)), expected)
+
+
+def test_tables_built_once_per_update_when_chunked(monkeypatch):
+    built = []
+    row_tables = disk._row_tables
+    monkeypatch.setattr(disk, "_row_tables", lambda frames: built.append(1) or row_tables(frames))
+    model = DiskLikelihood((50, 50), sigma=2)
+    frame = model.render(np.array([[20.0, 25.0, 6.0]]))[0]
+    pf = ParticleFilter(
+        prior_fn=prior,
+        n_particles=400,
+        observe_fn=model.observe,
+        log_weight_fn=model.log_weight,
+        chunk_size=50,
+        rng=0,
+    )
+    pf.update(frame)
+    assert len(built) == 1
+    pf.update(frame.copy())
+    assert len(built) == 2
+
+
+@pytest.mark.parametrize("chunk_size", [None, 100])
+def test_reused_frame_buffer(chunk_size):
+    # a capture loop that overwrites one frame buffer in place
+    model = DiskLikelihood((50, 50), sigma=2)
+    frames = model.render(np.array([[20.0, 25.0, 6.0], [30.0, 20.0, 5.0], [35.0, 15.0, 6.0]]))
+    filters = [
+        ParticleFilter(
+            prior_fn=prior,
+            n_particles=300,
+            observe_fn=model.observe,
+            log_weight_fn=model.log_weight,
+            chunk_size=chunk_size,
+            rng=0,
+        )
+        for _ in range(2)
+    ]
+    buffer = np.empty((50, 50))
+    for frame in frames:
+        buffer[:] = frame
+        filters[0].update(buffer)
+        filters[1].update(frame.copy())
+        np.testing.assert_allclose(filters[0].weights, filters[1].weights)
+
+
+def test_tables_rebuilt_without_a_key():
+    model = DiskLikelihood((50, 50))
+    disks = model.observe(prior(20, np.random.default_rng(1)))
+    frame = model.render(np.array([[20.0, 25.0, 6.0]]))[0]
+    model.squared_errors(disks, frame)
+    frame[:] = 0
+    np.testing.assert_allclose(
+        model.squared_errors(disks, frame), model.render(disks).reshape(20, -1).sum(axis=1)
+    )
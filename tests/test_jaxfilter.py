@@ -0,0 +1,100 @@
+import warnings
+import numpy as np
+import pytest
+from pfilter import ParticleFilter, gaussian_noise, independent_sample, jaxfilter, jit_filter
+
+# jit_filter picks JaxParticleFilter when it can, and otherwise falls back to ParticleFilter
+# with a warning. Only the fallback without JAX runs when JAX is not installed.
+
+D = 2
+
+
+def prior(n, rng=None):
+    return rng.normal(0, 1, size=(n, D))
+
+
+def observe(x, scale=1.0):
+    return x * scale
+
+
+# update kwargs are passed to every model function
+def dynamics(x, **kwargs):
+    return x
+
+
+def noise(x, rng=None, **kwargs):
+    return gaussian_noise(x, sigmas=[0.1] * D, rng=rng)
+
+
+def log_weight(x, y, **kwargs):
+    return -0.5 * ((x - y) ** 2).sum(axis=-1) / 0.25
+
+
+def options(**kwargs):
+    return dict(
+        observe_fn=observe,
+        n_particles=500,
+        dynamics_fn=dynamics,
+        noise_fn=noise,
+        log_weight_fn=log_weight,
+        resample_proportion=0.05,
+        rng=0,
+        **kwargs
+    )
+
+
+def created(**kwargs):
+    """The filter jit_filter creates, and the messages of the warnings it gave."""
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        pf = jit_filter(prior, **kwargs)
+    return pf, [str(w.message) for w in caught if issubclass(w.category, RuntimeWarning)]
+
+
+def test_falls_back_without_jax(monkeypatch):
+    monkeypatch.setattr(jaxfilter, "HAVE_JAX", False)
+    pf, messages = created(**options())
+    assert type(pf) is ParticleFilter
+    assert any("jax is not installed" in message for message in messages)
+    pf.update(np.zeros(D), scale=2.0)
+    assert pf.hypotheses.shape == (500, D)
+
+
+def test_tracks_with_jax():
+    pytest.importorskip("jax")
+    pf, messages = created(**options())
+    assert isinstance(pf, jaxfilter.JaxParticleFilter)
+    assert messages == []
+    for _ in range(10):
+        pf.update(np.array([1.0, -1.0]))
+    np.testing.assert_allclose(np.asarray(pf.mean_state), [1.0, -1.0], atol=0.2)
+    pf.update()
+    assert np.isclose(float(np.asarray(pf.weights).sum()), 1.0)
+
+
+def test_update_kwargs_reach_the_model_with_jax():
+    pytest.importorskip("jax")
+    pf, _ = created(**options())
+    pf.update(np.array([1.0, -1.0]), scale=2.0)
+    np.testing.assert_allclose(
+        np.asarray(pf.hypotheses), 2.0 * np.asarray(pf.original_particles), rtol=1e-6
+    )
+
+
+def test_numpy_only_options_fall_back_with_jax():
+    pytest.importorskip("jax")
+    pf, messages = created(**options(in_place=True))
+    assert type(pf) is ParticleFilter
+    assert any("does not support in_place" in message for message in messages)
+
+
+def test_untraceable_prior_falls_back_with_jax():
+    pytest.importorskip("jax")
+    # independent_sample writes the (traced) replenishment samples into a NumPy array
+    sample = independent_sample([lambda n, rng=None: rng.normal(0, 1, size=n)] * D)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        pf = jit_filter(sample, **options())
+    assert type(pf) is ParticleFilter
+    assert any("cannot be traced" in str(w.message) for w in caught)
+    pf.update(np.zeros(D))
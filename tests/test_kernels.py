@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from pfilter import BoundedSquaredError, log_squared_error
+from pfilter.kernels import log_rbf
+
+# BoundedSquaredError against the direct log_squared_error: the particles it keeps have exact
+# log-likelihoods, and the ones it drops are more than margin nats below the best.
+
+
+def hypotheses(n=400, p=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    target = rng.uniform(0, 1, p)
+    spread = rng.uniform(0, 0.3, n)[:, None]
+    return target + spread * rng.standard_normal((n, p)), target
+
+
+def masked(y, seed=1):
+    return np.ma.masked_array(y, mask=np.random.default_rng(seed).uniform(size=len(y)) < 0.3)
+
+
+@pytest.mark.parametrize("mask", [False, True])
+def test_kept_particles_are_exact(mask):
+    x, y = hypotheses()
+    if mask:
+        y = masked(y)
+    kernel = BoundedSquaredError(sigma=2.0, margin=10.0, block_size=256)
+    scores = kernel(x, y)
+    expected = log_squared_error(x, y.reshape(1, -1), sigma=2.0)
+    kept = np.isfinite(scores)
+    assert 0 < kernel.n_pruned < len(x)
+    np.testing.assert_allclose(scores[kept], expected[kept])
+    assert np.all(expected[~kept] < expected.max() - 10.0)
+
+
+def test_matches_log_rbf_without_pruning():
+    x, y = hypotheses(50, 500)
+    y = masked(y)
+    kernel = BoundedSquaredError(sigma=1.0, margin=np.inf, block_size=64)
+    np.testing.assert_allclose(kernel(x, y), log_rbf(x, y, sigma=1.0))
+    assert kernel.n_pruned == 0
+
+
+def test_likelihood_domain():
+    x, y = hypotheses(100, 400)
+    kernel = BoundedSquaredError(sigma=3.0, margin=5.0, block_size=50, log_domain=False)
+    scores = kernel(x, y)
+    expected = np.exp(log_squared_error(x, y.reshape(1, -1), sigma=3.0))
+    kept = scores > 0
+    np.testing.assert_allclose(scores[kept], expected[kept])
+
+
+def test_bound_tightens_after_the_first_block():
+    # the seeds (closest on the first block) are poor matches overall; the best particle
+    # only looks best after the second block
+    p, block = 40, 10
+    y = np.zeros(p)
+    x = np.ones((6, p))
+    x[:2, :block] = 0.0  # seeds: exact on block 0, far elsewhere
+    x[2] = 0.1  # the best particle overall
+    x[3:] = 0.5
+    kernel = BoundedSquaredError(sigma=1.0, margin=1.0, block_size=block, n_seeds=2)
+    distances, dropped = kernel.distances(x, y)
+    # with only the seeds' bound (30), every particle would be kept
+    assert dropped[:2].all() and dropped[3:].all()
+    assert not dropped[2]
+    assert distances[2] == pytest.approx(p * 0.01)
@@ -0,0 +1,173 @@
+import functools
+import numpy as np
+import pytest
+from pfilter import (
+    ParticleFilter,
+    gaussian_noise,
+    linear_dynamics,
+    log_squared_error,
+    squared_error,
+)
+
+# The ParticleFilter options that change how an update is computed, not what it computes,
+# against the plain update with the same seed.
+
+D = 2
+
+
+def prior(n, rng=None):
+    return rng.normal(0, 2, size=(n, D))
+
+
+def observe(x):
+    return np.concatenate([x, x ** 2], axis=1)
+
+
+def noise(x, rng=None):
+    return gaussian_noise(x, [0.2] * D, rng=rng)
+
+
+def observations(steps=5):
+    return [observe(np.array([[0.1 * t, -0.2 * t]]))[0] for t in range(steps)]
+
+
+def make_filter(**kwargs):
+    options = dict(
+        prior_fn=prior,
+        observe_fn=observe,
+        n_particles=300,
+        noise_fn=noise,
+        weight_fn=squared_error,
+        resample_proportion=0.02,
+        rng=4,
+    )
+    options.update(kwargs)
+    return ParticleFilter(**options)
+
+
+@pytest.mark.parametrize("log_domain", [False, True])
+@pytest.mark.parametrize("gate", [False, True])
+def test_all_zero_internal_weights_are_ignored(log_domain, gate):
+    zero = [False]
+
+    def internal_weight(x, y):
+        return np.zeros(len(x)) if zero[0] else np.ones(len(x))
+
+    kwargs = dict(internal_weight_fn=internal_weight, gate_internal_weight=gate)
+    if log_domain:
+        kwargs.update(weight_fn=None, log_weight_fn=log_squared_error)
+    pf = make_filter(**kwargs)
+    for step, observed in enumerate(observations()):
+        zero[0] = step == 1
+        pf.update(observed)
+        assert np.all(np.isfinite(pf.weights))
+        assert np.isclose(np.sum(pf.weights), 1.0)
+
+
+def run(pf, steps=5):
+    for observed in observations(steps):
+        pf.update(observed)
+    return pf
+
+
+def assert_same(pf, reference):
+    np.testing.assert_allclose(pf.weights, reference.weights)
+    np.testing.assert_allclose(pf.particles, reference.particles)
+    np.testing.assert_allclose(pf.original_particles, reference.original_particles)
+    np.testing.assert_allclose(pf.mean_hypothesis, reference.mean_hypothesis)
+    np.testing.assert_allclose(pf.map_hypothesis, reference.map_hypothesis)
+
+
+@pytest.mark.parametrize("log_domain", [False, True])
+@pytest.mark.parametrize(
+    "chunking", [dict(chunk_size=37), dict(chunk_size=300), dict(chunk_memory=2000)]
+)
+def test_chunked_matches_plain(chunking, log_domain):
+    kwargs = dict(weight_fn=None, log_weight_fn=log_squared_error) if log_domain else {}
+    reference = run(make_filter(**kwargs))
+    assert_same(run(make_filter(**dict(kwargs, **chunking))), reference)
+
+
+def observe_into(x, out=None):
+    if out is None:
+        out = np.empty((len(x), 2 * D))
+    np.copyto(out[:, :D], x)
+    np.square(x, out=out[:, D:])
+    return out
+
+
+@pytest.mark.parametrize("log_domain", [False, True])
+def test_in_place_matches_plain(log_domain):
+    kwargs = dict(
+        observe_fn=observe_into,
+        dynamics_fn=functools.partial(linear_dynamics, transition=0.95 * np.eye(D)),
+        noise_fn=functools.partial(gaussian_noise, sigmas=[0.2] * D),
+    )
+    if log_domain:
+        kwargs.update(weight_fn=None, log_weight_fn=log_squared_error)
+    # replenishment draws only the samples it uses in place, so it is left out here
+    kwargs.update(resample_proportion=0)
+    reference, in_place = make_filter(**kwargs), make_filter(in_place=True, **kwargs)
+    for observed in observations(8):
+        reference.update(observed)
+        in_place.update(observed)
+        np.testing.assert_allclose(in_place.hypotheses, reference.hypotheses)
+        assert_same(in_place, reference)
+
+
+def test_in_place_replenishment():
+    reference, in_place = make_filter(), make_filter(in_place=True)
+    observed = observations(1)[0]
+    reference.update(observed)
+    in_place.update(observed)
+    np.testing.assert_allclose(in_place.weights, reference.weights)
+    np.testing.assert_allclose(in_place.original_particles, reference.original_particles)
+    # the replenished particles come from a different draw, the others are the same
+    kept = ~in_place.resampled_particles & ~reference.resampled_particles
+    np.testing.assert_allclose(in_place.particles[kept], reference.particles[kept])
+
+
+def test_kld_particle_count_stays_within_bounds():
+    pf = make_filter(kld_bin_size=1.0, min_particles=50, max_particles=800)
+    counts = []
+    for observed in observations(8) + [None] * 4:
+        pf.update(observed)
+        counts.append(pf.n_particles)
+        assert 50 <= pf.n_particles <= 800
+        assert pf.particles.shape == (pf.n_particles, D)
+        assert pf.weights.shape == (pf.n_particles,)
+        assert np.isclose(np.sum(pf.weights), 1.0)
+    assert len(set(counts)) > 1
+
+
+@pytest.mark.parametrize("bin_size, count", [(0.01, 800), (100.0, 300)])
+def test_kld_particle_count_is_clamped(bin_size, count):
+    pf = make_filter(kld_bin_size=bin_size, min_particles=300, max_particles=800)
+    run(pf, 3)
+    assert pf.n_particles == count
+
+
+def test_predict_does_not_observe():
+    calls = []
+
+    def counted_observe(x):
+        calls.append(len(x))
+        return observe(x)
+
+    options = dict(observe_fn=counted_observe, n_eff_threshold=0.0, resample_proportion=0)
+    pf, reference = make_filter(**options), make_filter(**options)
+    pf.update(observations(1)[0])
+    reference.update(observations(1)[0])
+    del calls[:]
+    pf.predict(3)
+    assert calls == [] and pf.hypotheses is None
+    # the same particles as three prediction-only updates, which do observe
+    for _ in range(3):
+        reference.update()
+    np.testing.assert_allclose(pf.particles, reference.particles)
+    np.testing.assert_allclose(pf.weights, reference.weights)
+    np.testing.assert_allclose(pf.mean_state, reference.mean_state)
+    del calls[:]
+    # the hypotheses are computed when they are first needed
+    np.testing.assert_allclose(pf.mean_hypothesis, reference.mean_hypothesis)
+    assert calls
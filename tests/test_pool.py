@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from pfilter import ParticleFilter
+from pfilter.pool import PriorPool
+
+# PriorPool hands out the prior's samples in the order they were drawn, a batch at a time,
+# whether the batches are drawn on demand or on a background thread.
+
+D = 3
+
+
+def prior(n, rng=None):
+    return rng.normal(0, 1, size=(n, D))
+
+
+def expected_samples(seed, size, n):
+    rng = np.random.default_rng(seed)
+    batches = [prior(size, rng) for _ in range(-(-n // size))]
+    return np.concatenate(batches)[:n]
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_draws_follow_the_batches(background):
+    with PriorPool(prior, size=7, background=background, rng=3) as pool:
+        draws = [pool.draw(3), pool.draw(5), pool.draw(10), pool.draw(0)]
+        out = np.empty((4, D))
+        assert pool.draw(4, out=out) is out
+        draws.append(out)
+    np.testing.assert_array_equal(np.concatenate(draws), expected_samples(3, 7, 22))
+    assert pool.n_batches == 4
+
+
+def test_filter_replenishes_from_the_pool():
+    pool = PriorPool(prior, size=50, rng=5)
+    pf = ParticleFilter(
+        prior_fn=prior, n_particles=200, resample_proportion=0.1, prior_pool=pool, rng=0
+    )
+    replaced = []
+    for _ in range(4):
+        pf.update(np.zeros(D))
+        replaced.append(pf.particles[pf.resampled_particles])
+    replaced = np.concatenate(replaced)
+    assert len(replaced) > 0
+    np.testing.assert_array_equal(replaced, expected_samples(5, 50, len(replaced)))
+
+
+def test_filter_pool_size():
+    pf = ParticleFilter(
+        prior_fn=prior, n_particles=100, resample_proportion=0.2, prior_pool=64, rng=0
+    )
+    pf.update(np.zeros(D))
+    assert isinstance(pf.prior_pool, PriorPool)
+    assert pf.prior_pool.size == 64
+    assert pf.prior_pool.n_batches >= 1
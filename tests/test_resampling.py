@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from pfilter import reference, resampling
+
+# The vectorized resamplers against the loop-based originals in `pfilter.reference`, which
+# draw from the global np.random state: both are run from the same seed.
+
+SEEDS = range(5)
+
+
+def random_weights(seed, n=200):
+    weights = np.random.default_rng(seed).dirichlet(np.ones(n))
+    return weights / np.sum(weights)
+
+
+def seeded(fn, weights, seed):
+    np.random.seed(seed)
+    return np.asarray(fn(weights))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize(
+    "name", ["systematic_resample", "stratified_resample", "resample"]
+)
+def test_matches_reference(name, seed):
+    weights = random_weights(seed)
+    expected = seeded(getattr(reference, name), weights, seed)
+    actual = seeded(getattr(resampling, name), weights, seed)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_multinomial_matches_reference(seed):
+    # np.random.choice draws the same uniforms, but does not sort them
+    weights = random_weights(seed)
+    expected = seeded(reference.multinomial_resample, weights, seed)
+    actual = seeded(resampling.multinomial_resample, weights, seed)
+    np.testing.assert_array_equal(actual, np.sort(expected))
+
+
+def test_residual_matches_reference_on_whole_copies():
+    # with N * w all integers there is no residual, and both are deterministic
+    weights = np.array([1, 3, 0, 2, 2, 0, 0, 0]) / 8.0
+    expected = seeded(reference.residual_resample, weights, 0)
+    actual = seeded(resampling.residual_resample, weights, 0)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_residual_matches_reference_copies(seed):
+    # the reference normalises the wrong residual (weights - copies rather than
+    # N * weights - copies), so only the whole copies are compared; the rest must be drawn
+    # from particles with a non-zero residual
+    weights = random_weights(seed)
+    n = len(weights)
+    copies = np.floor(n * weights).astype(int)
+    k = int(np.sum(copies))
+    expected = seeded(reference.residual_resample, weights, seed)
+    actual = seeded(resampling.residual_resample, weights, seed)
+    np.testing.assert_array_equal(actual[:k], expected[:k])
+    assert len(actual) == n
+    assert np.all(n * weights[actual[k:]] - copies[actual[k:]] > 0)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_create_indices_matches_reference(seed):
+    weights = random_weights(seed)
+    positions = np.sort(np.random.default_rng(seed + 100).uniform(0, 1, len(weights)))
+    np.testing.assert_array_equal(
+        resampling.create_indices(positions, weights),
+        reference.create_indices(positions, weights),
+    )
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize(
+    "name",
+    ["systematic_resample", "stratified_resample", "multinomial_resample", "resample"],
+)
+def test_batch_matches_rows(name, seed):
+    # the batched versions draw the same numbers, row by row, as K separate calls
+    weights = np.stack([random_weights(seed * 10 + row, n=50) for row in range(6)])
+    batched = getattr(resampling, "batch_" + name)(weights, rng=np.random.default_rng(seed))
+    rng = np.random.default_rng(seed)
+    rows = [getattr(resampling, name)(row, rng=rng) for row in weights]
+    np.testing.assert_array_equal(batched, np.stack(rows))
+
+
+def test_batch_create_indices_matches_rows():
+    rng = np.random.default_rng(0)
+    weights = np.stack([random_weights(row, n=50) for row in range(4)])
+    positions = np.sort(rng.uniform(0, 1, weights.shape), axis=1)
+    np.testing.assert_array_equal(
+        resampling.batch_create_indices(positions, weights),
+        np.stack([resampling.create_indices(p, w) for p, w in zip(positions, weights)]),
+    )
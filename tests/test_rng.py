@@ -0,0 +1,50 @@
+import functools
+import gc
+import weakref
+import numpy as np
+from pfilter import ParticleFilter, gaussian_noise, spawn_rngs
+from pfilter.rng import _accepts_keyword
+
+# The random streams, and the keyword checks that decide which model functions get them.
+
+
+class Model(object):
+    def prior(self, n, rng=None):
+        return rng.normal(0, 1, size=(n, 2))
+
+    def observe(self, x):
+        return x
+
+    def __call__(self, x, out=None):
+        return x
+
+
+def test_accepts_keyword():
+    model = Model()
+    assert _accepts_keyword(model.prior, "rng")
+    assert not _accepts_keyword(model.observe, "rng")
+    assert _accepts_keyword(model, "out")
+    assert _accepts_keyword(functools.partial(gaussian_noise, sigmas=[1.0]), "rng")
+    assert not _accepts_keyword(lambda x, **kwargs: x, "rng")
+    assert not _accepts_keyword(np.exp, "rng")
+
+
+def test_keyword_cache_does_not_keep_models_alive():
+    refs = []
+    for _ in range(5):
+        model = Model()
+        pf = ParticleFilter(
+            prior_fn=model.prior, observe_fn=model.observe, noise_fn=model, n_particles=10, rng=0
+        )
+        pf.update(np.zeros(2))
+        refs.append(weakref.ref(model))
+    del model, pf
+    gc.collect()
+    assert all(ref() is None for ref in refs)
+
+
+def test_spawned_streams_are_reproducible_and_distinct():
+    first = [rng.random(3) for rng in spawn_rngs(1, 3)]
+    second = [rng.random(3) for rng in spawn_rngs(1, 3)]
+    np.testing.assert_array_equal(first, second)
+    assert not np.allclose(first[0], first[1])
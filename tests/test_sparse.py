@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from pfilter import ParticleFilter, SparseObservation, gaussian_noise, log_squared_error
+
+# Partial observations: only the valid values are compared, whether the observation is a
+# masked array or a SparseObservation, and however the hypotheses are computed.
+
+H = W = 12
+
+
+def render(x, indices=None, out=None):
+    yy, xx = np.mgrid[:H, :W]
+    images = np.exp(
+        -((xx[None] - x[:, 0, None, None]) ** 2 + (yy[None] - x[:, 1, None, None]) ** 2) / 8.0
+    ).reshape(len(x), -1)
+    if indices is not None:
+        images = images[:, indices]
+    if out is None:
+        return images
+    out[...] = images
+    return out
+
+
+def prior(n, rng=None):
+    return rng.uniform(0, W, (n, 2))
+
+
+def noise(x, rng=None):
+    return gaussian_noise(x, [0.3, 0.3], rng=rng)
+
+
+def masked_frames():
+    frame = render(np.array([[6.0, 5.0]]))[0].reshape(H, W)
+    frames = []
+    for columns in [3, 5, 2]:
+        mask = np.zeros((H, W), dtype=bool)
+        mask[:, :columns] = True
+        frames.append(np.ma.masked_array(frame, mask=mask))
+    return frames
+
+
+def make_filter(**kwargs):
+    options = dict(
+        prior_fn=prior,
+        observe_fn=render,
+        n_particles=200,
+        noise_fn=noise,
+        log_weight_fn=log_squared_error,
+        rng=3,
+    )
+    options.update(kwargs)
+    return ParticleFilter(**options)
+
+
+def test_sparse_and_masked_agree():
+    frames = masked_frames()
+    masked, sparse = make_filter(), make_filter()
+    for frame in frames:
+        masked.update(frame)
+        sparse.update(SparseObservation.from_masked(frame))
+    np.testing.assert_allclose(sparse.weights, masked.weights)
+
+
+def test_internal_weight_fn_gets_the_observation_as_given():
+    given = []
+
+    def internal_weight(x, y):
+        given.append(y)
+        return np.ones(len(x))
+
+    frame = masked_frames()[0]
+    pf = make_filter(internal_weight_fn=internal_weight)
+    pf.update(frame)
+    sparse = SparseObservation.from_masked(frame)
+    pf.update(sparse)
+    assert np.ma.isMaskedArray(given[0]) and given[0] is frame
+    assert given[1] is sparse
+
+
+def test_in_place_reallocates_when_the_observed_values_change():
+    frames = masked_frames()
+    reference, in_place = make_filter(), make_filter(in_place=True)
+    for frame in frames:
+        reference.update(frame)
+        in_place.update(frame)
+        assert in_place.hypotheses.shape == (200, np.count_nonzero(~frame.mask))
+        np.testing.assert_allclose(in_place.weights, reference.weights)
+
+
+def test_pyramid_rejects_sparse_observations_before_moving_the_particles():
+    def render_image(x):
+        return render(x).reshape(len(x), H, W)
+
+    pf = make_filter(observe_fn=render_image, pyramid_levels=2)
+    particles, state = pf.particles.copy(), pf.rng.bit_generator.state
+    with pytest.raises(ValueError):
+        pf.update(masked_frames()[0])
+    np.testing.assert_array_equal(pf.particles, particles)
+    assert pf.rng.bit_generator.state == state